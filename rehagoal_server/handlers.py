@@ -0,0 +1,80 @@
+"""
+WSGI handler with a reduced middleware stack for token-authenticated REST API requests.
+
+Tablet clients authenticate every request to the REST API with a token (JWT) or HTTP basic authentication,
+therefore they do not need sessions, CSRF protection, messages or clickjacking protection. Such requests are
+processed with settings.API_MIDDLEWARE, all other requests (admin, browsable API, session authentication)
+with the full settings.MIDDLEWARE.
+"""
+import django
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.base import BaseHandler
+from django.core.handlers.exception import convert_exception_to_response
+from django.core.handlers.wsgi import WSGIHandler
+from django.utils.module_loading import import_string
+
+
+def is_token_api_request(request):
+    """
+    Whether the request is a token-authenticated REST API request, which is not rendered as browsable API.
+    """
+    return (request.path_info.startswith(settings.API_FAST_PATH_PREFIX)
+            and 'HTTP_AUTHORIZATION' in request.META
+            and 'text/html' not in request.META.get('HTTP_ACCEPT', '')
+            and request.GET.get('format') != 'api')
+
+
+class APIHandler(BaseHandler):
+    """
+    Synchronous handler, which processes requests with the middleware stack settings.API_MIDDLEWARE.
+    """
+
+    def __init__(self):
+        super(APIHandler, self).__init__()
+        self.load_middleware()
+
+    def load_middleware(self, is_async=False):
+        # Simplified (synchronous) version of BaseHandler.load_middleware, which loads settings.API_MIDDLEWARE
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._exception_middleware = []
+
+        handler = convert_exception_to_response(self._get_response)
+        for middleware_path in reversed(settings.API_MIDDLEWARE):
+            middleware = import_string(middleware_path)
+            try:
+                mw_instance = middleware(handler)
+            except MiddlewareNotUsed:
+                continue
+            if hasattr(mw_instance, 'process_view'):
+                self._view_middleware.insert(0, mw_instance.process_view)
+            if hasattr(mw_instance, 'process_template_response'):
+                self._template_response_middleware.append(mw_instance.process_template_response)
+            if hasattr(mw_instance, 'process_exception'):
+                self._exception_middleware.append(mw_instance.process_exception)
+            handler = convert_exception_to_response(mw_instance)
+        self._middleware_chain = handler
+
+
+class APIFastPathWSGIHandler(WSGIHandler):
+    """
+    WSGIHandler, which delegates token-authenticated REST API requests to an APIHandler.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(APIFastPathWSGIHandler, self).__init__(*args, **kwargs)
+        self.api_handler = APIHandler()
+
+    def get_response(self, request):
+        if is_token_api_request(request):
+            return self.api_handler.get_response(request)
+        return super(APIFastPathWSGIHandler, self).get_response(request)
+
+
+def get_wsgi_application():
+    """
+    Equivalent of django.core.wsgi.get_wsgi_application, returning an APIFastPathWSGIHandler.
+    """
+    django.setup(set_prefix=False)
+    return APIFastPathWSGIHandler()
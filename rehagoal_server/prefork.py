@@ -0,0 +1,381 @@
+"""
+Pre-forking WSGI server (see the serve management command).
+
+The master process loads the application once, and then forks the worker processes, which accept connections on the
+shared listening socket. The workers share most of the memory of the loaded application with the master
+(copy-on-write), which is why the garbage collector is frozen before forking: otherwise collections in the workers
+would write to (and therefore copy) the memory pages of all objects.
+
+Each worker handles one connection at a time, so connections which do not send or receive data within the request
+timeout are closed, as idle or slow clients would otherwise block the workers. For the same reason, long-polling
+requests for workflow changes are answered right away (see rehagoal_server_app/notifications.py).
+
+Signals of the master process:
+- SIGTERM, SIGINT: Graceful shutdown, workers finish their current request (up to the graceful timeout).
+- SIGHUP: Graceful reload, the master re-executes itself (loading the current code and settings) with the same PID
+  and listening socket, forks new workers and then gracefully stops the old ones. The application is loaded by a
+  separate process before, so that the old workers keep serving if it fails to load (e.g. due to invalid settings).
+- SIGUSR1: Report the memory usage of the workers.
+"""
+import gc
+import io
+import logging
+import os
+import resource
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+from django.db import connections
+from django.urls import get_resolver
+
+#: Environment variables, which are passed to the master process when re-executing it on reload
+LISTEN_FD_ENV = 'REHAGOAL_SERVE_LISTEN_FD'
+OLD_WORKERS_ENV = 'REHAGOAL_SERVE_OLD_WORKERS'
+#: Environment variable of the process, which checks whether the application loads before reloading
+CHECK_ENV = 'REHAGOAL_SERVE_CHECK'
+
+#: Seconds the check before reloading may take to load the application
+RELOAD_CHECK_TIMEOUT = 60
+
+#: Interval (seconds), in which the master reaps exited workers and the workers check whether to stop
+POLL_INTERVAL = 0.5
+
+MEMORY_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty')
+
+LOG = logging.getLogger(__name__)
+server_logger = logging.getLogger('django.server')
+
+
+def memory_usage(pid):
+    """
+    Return the memory usage of the given process in KiB, as dict of MEMORY_FIELDS.
+    :return: memory usage, or None if it is not available (requires Linux >= 4.14)
+    """
+    usage = {}
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in MEMORY_FIELDS:
+                    usage[key] = int(value.split()[0])
+    except OSError:
+        return None
+    return usage
+
+
+class SendfileServerHandler(ServerHandler):
+    """
+    ServerHandler, which transmits file responses (wsgi.file_wrapper, used by Django's FileResponse)
+    with socket.sendfile(), instead of reading the file into Python buffers.
+    """
+
+    def sendfile(self):
+        file = self.result.filelike
+        try:
+            file.fileno()
+            offset = file.tell()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        self.bytes_sent += self.request_handler.connection.sendfile(file, offset)
+        return True
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    WSGIRequestHandler (HTTP/1.0, one request per connection), which logs requests like the development server,
+    and transmits file responses with sendfile (see SendfileServerHandler).
+    """
+
+    def setup(self):
+        # Timeout of every blocking operation on the connection (see StreamRequestHandler.setup)
+        self.timeout = self.server.request_timeout
+        super(RequestHandler, self).setup()
+
+    def handle(self):
+        # See WSGIRequestHandler.handle
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        handler = SendfileServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+                                        multithread=False)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def log_message(self, format, *args):
+        server_logger.info(format, *args)
+
+
+class WorkerServer(WSGIServer):
+    """
+    WSGIServer, which accepts connections on the (non-blocking) listening socket shared with the other workers.
+    Connections are closed, if reading or writing blocks longer than request_timeout (seconds, None for no timeout).
+    """
+
+    def __init__(self, listen_socket, application, request_timeout=None):
+        self.request_timeout = request_timeout
+        self.address_family = listen_socket.family
+        super(WorkerServer, self).__init__(listen_socket.getsockname(), RequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listen_socket
+        # See HTTPServer.server_bind and WSGIServer.server_bind
+        host, port = listen_socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(application)
+
+    def serve_until(self, stopped):
+        """
+        Handle requests until stopped() returns True, which is checked at least every POLL_INTERVAL seconds.
+        """
+        with selectors.DefaultSelector() as selector:
+            selector.register(self, selectors.EVENT_READ)
+            while not stopped():
+                if selector.select(POLL_INTERVAL):
+                    self._handle_request_noblock()
+
+    def get_request(self):
+        # Another worker might have accepted the connection first, which raises BlockingIOError (handled by the caller)
+        connection, address = self.socket.accept()
+        connection.setblocking(True)
+        return connection, address
+
+    def handle_error(self, request, client_address):
+        # The connection is closed afterwards (see BaseServer._handle_request_noblock)
+        if isinstance(sys.exc_info()[1], socket.timeout):
+            server_logger.info("Connection from %s timed out", client_address[0])
+            return
+        super(WorkerServer, self).handle_error(request, client_address)
+
+
+class PreforkServer(object):
+    """
+    Master process of the pre-forking server, see the module documentation.
+    """
+
+    def __init__(self, load_application, address, workers, graceful_timeout, stdout, request_timeout=None):
+        """
+        :param load_application: callable returning the WSGI application
+        :param address: (host, port) to listen on, if no listening socket is inherited
+        :param workers: number of worker processes
+        :param graceful_timeout: seconds to wait for workers to finish their current request, before killing them
+        :param stdout: stream for status messages
+        :param request_timeout: seconds a connection may block reading or writing, before it is closed
+        """
+        self.load_application = load_application
+        self.address = address
+        self.worker_count = workers
+        self.graceful_timeout = graceful_timeout
+        self.stdout = stdout
+        self.request_timeout = request_timeout
+        self.socket = None
+        self.application = None
+        self.master_pid = os.getpid()
+        self.workers = {}  # PID -> time.perf_counter() at fork
+        self.retiring = set()  # PIDs of workers, which are stopping
+        self.signals = []
+        self.stopping = False
+
+    def log(self, message):
+        self.stdout.write(message)
+        self.stdout.flush()
+
+    def create_socket(self):
+        listen_fd = os.environ.pop(LISTEN_FD_ENV, None)
+        if listen_fd is not None:
+            listen_socket = socket.socket(fileno=int(listen_fd))
+        else:
+            host, port = self.address
+            family = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][0]
+            listen_socket = socket.socket(family, socket.SOCK_STREAM)
+            listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listen_socket.bind((host, port))
+            listen_socket.listen(socket.SOMAXCONN)
+        listen_socket.setblocking(False)
+        return listen_socket
+
+    def run(self):
+        if os.environ.pop(CHECK_ENV, None):
+            self.load_application()
+            get_resolver().url_patterns
+            return
+        self.socket = self.create_socket()
+        self.application = self.load_application()
+        # Import all views, so that the workers do not need to
+        get_resolver().url_patterns
+        # Database connections must not be shared by the workers
+        connections.close_all()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.log("Application loaded using %.0f ms CPU time, listening on %s:%d (master PID %d)" % (
+            (usage.ru_utime + usage.ru_stime) * 1e3, self.socket.getsockname()[0], self.socket.getsockname()[1],
+            self.master_pid))
+
+        if hasattr(gc, 'freeze'):  # Python >= 3.7
+            gc.collect()
+            gc.freeze()
+
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+            signal.signal(signum, self.handle_master_signal)
+        for _ in range(self.worker_count):
+            self.spawn_worker()
+        self.stop_old_workers()
+
+        report_memory_at = time.monotonic() + 2
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop()
+                    return
+                elif signum == signal.SIGHUP:
+                    self.reload()
+                elif signum == signal.SIGUSR1:
+                    self.report_memory()
+            self.reap_workers()
+            if report_memory_at and time.monotonic() >= report_memory_at:
+                report_memory_at = None
+                self.report_memory()
+            time.sleep(POLL_INTERVAL)
+
+    def handle_master_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def stop_old_workers(self):
+        """
+        Gracefully stop the workers of the master process before the reload.
+        """
+        old_workers = os.environ.pop(OLD_WORKERS_ENV, '')
+        for pid in filter(None, old_workers.split(',')):
+            self.retiring.add(int(pid))
+            self.kill(int(pid), signal.SIGTERM)
+
+    def spawn_worker(self):
+        start = time.perf_counter()
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = start
+            return
+        exit_code = 0
+        try:
+            self.run_worker(start)
+        except BaseException:
+            LOG.exception("Worker %d failed", os.getpid())
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def run_worker(self, start):
+        signal.signal(signal.SIGTERM, self.handle_worker_signal)
+        signal.signal(signal.SIGINT, self.handle_worker_signal)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        server = WorkerServer(self.socket, self.application, self.request_timeout)
+        self.log("Worker %d ready in %.1f ms" % (os.getpid(), (time.perf_counter() - start) * 1e3))
+        # Also stop if the master process is gone, e.g. if it failed to load the application on reload
+        server.serve_until(lambda: self.stopping or os.getppid() != self.master_pid)
+        connections.close_all()
+        # Workers exit with os._exit(), queued log records (e.g. of the audit log) have to be written before
+        logging.shutdown()
+
+    def handle_worker_signal(self, signum, frame):
+        # The current request is finished before the worker exits
+        self.stopping = True
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            if pid in self.workers:
+                del self.workers[pid]
+                self.log("Worker %d exited unexpectedly (status %d), starting a new one" % (pid, status))
+                self.spawn_worker()
+            else:
+                self.retiring.discard(pid)
+
+    def report_memory(self):
+        for pid in sorted(self.workers):
+            usage = memory_usage(pid)
+            if usage is None:
+                self.log("Worker %d: memory usage not available" % pid)
+                continue
+            self.log("Worker %d: RSS %d KiB, PSS %d KiB, shared %d KiB, private %d KiB" % (
+                pid, usage.get('Rss', 0), usage.get('Pss', 0),
+                usage.get('Shared_Clean', 0) + usage.get('Shared_Dirty', 0),
+                usage.get('Private_Clean', 0) + usage.get('Private_Dirty', 0)))
+
+    @staticmethod
+    def kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def stop(self):
+        self.log("Shutting down, waiting up to %d s for workers to finish" % self.graceful_timeout)
+        self.retiring.update(self.workers)
+        self.workers.clear()
+        for pid in self.retiring:
+            self.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.retiring and time.monotonic() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+        for pid in self.retiring:
+            self.kill(pid, signal.SIGKILL)
+        while self.retiring:
+            try:
+                self.retiring.discard(os.waitpid(-1, 0)[0])
+            except ChildProcessError:
+                break
+        self.socket.close()
+
+    def check_reload(self):
+        """
+        Load the application in a new process, like the master after the reload.
+        :return: True if the application loaded successfully
+        """
+        start = time.perf_counter()
+        try:
+            result = subprocess.run([sys.executable] + sys.argv, env=dict(os.environ, **{CHECK_ENV: '1'}),
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                    timeout=RELOAD_CHECK_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.log("Reload failed: the application did not load within %d s, keeping the current workers" %
+                     RELOAD_CHECK_TIMEOUT)
+            return False
+        if result.returncode:
+            self.log("Reload failed: the application did not load (exit status %d, see the error output), "
+                     "keeping the current workers" % result.returncode)
+            return False
+        self.log("Application loaded by the reload check in %.0f ms" % ((time.perf_counter() - start) * 1e3))
+        return True
+
+    def reload(self):
+        self.log("Reloading")
+        if not self.check_reload():
+            return
+        self.socket.set_inheritable(True)
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(self.socket.fileno())
+        env[OLD_WORKERS_ENV] = ','.join(str(pid) for pid in set(self.workers) | self.retiring)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execve(sys.executable, [sys.executable] + sys.argv, env)
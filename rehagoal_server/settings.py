@@ -73,7 +73,7 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.BasicAuthentication',
-        'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
+        'rehagoal_server_app.authentication.RehagoalJSONWebTokenAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10
@@ -91,15 +91,30 @@ CORS_ALLOWED_ORIGINS = (
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'rehagoal_server_app.profiling.RequestProfilingMiddleware',
+]
+
+# Reduced middleware stack for token-authenticated (JWT, HTTP basic) requests to the REST API,
+# which do not need sessions, CSRF protection, messages or clickjacking protection (see rehagoal_server.handlers).
+# Note that this is only used by rehagoal_server.wsgi, not by the development server.
+API_FAST_PATH_PREFIX = '/api/v2/'
+API_MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'rehagoal_server_app.profiling.RequestProfilingMiddleware',
 ]
 
+# OpenAPI schema served at /api/v2/schema/, stored by the generate_schema command.
+# If the file does not exist, the schema is generated once per process on the first request.
+API_SCHEMA_FILE = os.path.join(BASE_DIR, 'schema.json')
+
 ROOT_URLCONF = 'rehagoal_server.urls'
 
 TEMPLATES = [
@@ -131,6 +146,31 @@ DATABASES = {
     }
 }
 
+# Sessions are only used by the admin interface and the browsable API (SessionAuthentication).
+# The cached_db engine reads sessions from a cache on the local disk (shared by all worker processes of a host),
+# instead of the database. Sessions are still written to the database, expired ones are deleted by the
+# purge_sessions command.
+# Alternatively use 'django.contrib.sessions.backends.signed_cookies' to avoid storing sessions on the server
+# altogether. Note that signed cookie sessions cannot be invalidated on the server (e.g. on logout).
+# https://docs.djangoproject.com/en/3.2/topics/http/sessions/#configuring-the-session-engine
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'sessions'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'sessions'),
+    },
+}
+
+# Load the RehagoalUser along with the authenticated user (used for ownership checks)
+AUTHENTICATION_BACKENDS = [
+    'rehagoal_server_app.authentication.RehagoalUserBackend',
+]
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -178,7 +218,102 @@ DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
 STATIC_URL = '/static/'
 
+# Compute SHA-256 digests and metadata of uploaded workflow files while receiving them
+FILE_UPLOAD_HANDLERS = [
+    'rehagoal_server_app.uploadhandlers.WorkflowMemoryFileUploadHandler',
+    'rehagoal_server_app.uploadhandlers.WorkflowTemporaryFileUploadHandler',
+]
+
 # https://pypi.org/project/django-private-storage/
 PRIVATE_STORAGE_ROOT = os.path.join(BASE_DIR, 'files/')
 PRIVATE_STORAGE_AUTH_FUNCTION = 'private_storage.permissions.allow_superuser'
 
+# In-memory LRU cache of small workflow contents for downloads (see rehagoal_server_app/blobcache.py).
+# The hit/miss counters of a worker process are available at /api/v2/blob-cache/ (staff only).
+WORKFLOW_BLOB_CACHE = {
+    'MAX_SIZE': 32 * 1024 * 1024,  # total size per process, 0 disables the cache
+    'MAX_ENTRY_SIZE': 256 * 1024,
+    'SHARED_CACHE': None,  # optional alias in CACHES, which is shared by all worker processes
+}
+
+# Default maximum total size (bytes) of the workflow contents of a user, None for unlimited.
+# Can be overridden per user (RehagoalUser.storage_quota, editable in the admin).
+WORKFLOW_STORAGE_QUOTA = None
+
+# Revision history of workflow contents (see rehagoal_server_app/revisions.py), None to disable it, i.e. to delete
+# replaced contents right away. Revisions are stored as deltas, every KEYFRAME_INTERVAL-th revision as whole content,
+# which bounds the cost of restoring a revision. Run the prune_revisions command regularly to apply MAX_AGE, and to
+# delete files of revisions which have not been recorded (e.g. rolled back) after ORPHAN_MAX_AGE.
+# Deltas of end-to-end encrypted contents hardly save anything, i.e. a workflow may use up to MAX_REVISIONS + 1 times
+# its size: raise MAX_REVISIONS only along with a WORKFLOW_STORAGE_QUOTA, which revisions count towards.
+WORKFLOW_REVISIONS = {
+    'MAX_REVISIONS': 3,  # per workflow, None for unlimited
+    'MAX_AGE': 90 * 24 * 60 * 60,  # seconds, None for unlimited
+    'KEYFRAME_INTERVAL': 8,
+    'ORPHAN_MAX_AGE': 24 * 60 * 60,  # seconds
+}
+
+# Validity (seconds) of the signed download URLs of workflow contents (see rehagoal_server_app/signing.py),
+# None to disable them. URLs are valid for at least this time, but less than twice this time.
+WORKFLOW_DOWNLOAD_URL_MAX_AGE = 60 * 60
+
+# Workflow change notifications for long-polling clients (see rehagoal_server_app/notifications.py): directory shared
+# by all worker processes, and the maximum time (seconds) a request waits for changes.
+# Waiting requests occupy a worker thread, so use a threaded server when many clients wait.
+WORKFLOW_CHANGES_DIR = os.path.join(BASE_DIR, 'cache', 'changes')
+WORKFLOW_CHANGES_TIMEOUT = 30
+# Maximum number of waiting requests per process, further requests are answered right away (with Retry-After).
+# Under servers handling one request per process (e.g. the serve command), requests never wait.
+WORKFLOW_CHANGES_MAX_WAITERS = 8
+
+# Admission control of workflow uploads and downloads (see rehagoal_server_app/admission.py), None to disable it.
+# Transfers exceeding the limits of a user are rejected with 429 Too Many Requests (and Retry-After).
+# The state is shared by all worker processes in a local SQLite database.
+WORKFLOW_ADMISSION_CONTROL = {
+    'DATABASE': os.path.join(BASE_DIR, 'cache', 'admission.sqlite3'),
+    'MAX_CONCURRENT_TRANSFERS': 4,  # per user, None for unlimited
+    'REQUEST_RATE': 5.0,  # transfers per second, None for unlimited
+    'REQUEST_BURST': 100,
+    'BYTE_RATE': 20 * 1024 * 1024,  # bytes per second, None for unlimited
+    'BYTE_BURST': 1024 * 1024 * 1024,  # more than twice the maximum upload size (upload and download right away)
+}
+
+# On-demand profiling of requests of staff users with the header "X-Profile: 1" (see rehagoal_server_app/profiling.py),
+# None to disable it. Profiles (stack samples and SQL) can be downloaded in the admin interface.
+REQUEST_PROFILING = {
+    'INTERVAL': 0.001,  # seconds between two stack samples
+    'MAX_PROFILES': 100,  # number of stored profiles, older ones are deleted
+}
+
+# Access and audit log of the workflow API and content downloads (JSON lines, see rehagoal_server_app/auditlog.py).
+# Records are written by a background thread in every process, so that requests do not wait for the disk.
+AUDIT_LOG_FILE = os.path.join(BASE_DIR, 'logs', 'audit.jsonl')
+
+# Runs the tests with the above files in a temporary directory (see rehagoal_server/test_runner.py)
+TEST_RUNNER = 'rehagoal_server.test_runner.TestRunner'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json_lines': {
+            '()': 'rehagoal_server_app.auditlog.JSONLinesFormatter',
+        },
+    },
+    'handlers': {
+        'audit': {
+            'class': 'rehagoal_server_app.auditlog.QueuedRotatingFileHandler',
+            'formatter': 'json_lines',
+            'filename': AUDIT_LOG_FILE,
+            'max_bytes': 50 * 1024 * 1024,
+            'backup_count': 10,
+        },
+    },
+    'loggers': {
+        'rehagoal_server_app.audit': {
+            'handlers': ['audit'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
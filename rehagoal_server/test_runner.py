@@ -0,0 +1,47 @@
+"""
+Test runner, which keeps the state written by the server out of the project directory (see settings.TEST_RUNNER).
+"""
+import copy
+import os
+import tempfile
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Runs the tests with the audit log, the admission control database, the change notifications, the session cache and
+    the private storage (workflow contents and revisions) in a temporary directory, which is deleted afterwards.
+    Otherwise, the tests would write into the project directory, and e.g. the admission control buckets would be
+    carried over from one test run to the next.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super(TestRunner, self).setup_test_environment(**kwargs)
+        self.directory = tempfile.TemporaryDirectory(prefix='rehagoal-tests-')
+        caches = copy.deepcopy(settings.CACHES)
+        for alias, cache in caches.items():
+            if cache['BACKEND'] == 'django.core.cache.backends.filebased.FileBasedCache':
+                cache['LOCATION'] = self.path('cache', alias)
+        admission_control = getattr(settings, 'WORKFLOW_ADMISSION_CONTROL', {})
+        if admission_control is not None:
+            admission_control = dict(admission_control, DATABASE=self.path('admission.sqlite3'))
+        self.settings_override = override_settings(
+            AUDIT_LOG_FILE=self.path('logs', 'audit.jsonl'),
+            WORKFLOW_CHANGES_DIR=self.path('changes'),
+            WORKFLOW_ADMISSION_CONTROL=admission_control,
+            CACHES=caches,
+            PRIVATE_STORAGE_ROOT=self.path('files'),
+        )
+        # The objects created from these settings on startup follow the override (see their setting_changed receivers)
+        self.settings_override.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.settings_override.disable()  # also waits until the queued audit log records are written
+        self.directory.cleanup()
+        super(TestRunner, self).teardown_test_environment(**kwargs)
+
+    def path(self, *names):
+        return os.path.join(self.directory.name, *names)
@@ -18,19 +18,17 @@ from django.conf.urls.static import static
 from django.urls import re_path, include
 from django.http.response import HttpResponseGone
 from django.contrib import admin
-from rest_framework.schemas import get_schema_view
 from rest_framework_jwt.views import obtain_jwt_token, refresh_jwt_token, verify_jwt_token
 
 from rehagoal_server_app import views
-
-schema_view = get_schema_view(title='RehaGoal API', version='2')
+from rehagoal_server_app.schema import CachedSchemaView
 
 urlpatterns = [
     re_path(r'^$', views.index),
     re_path(r'^admin/', admin.site.urls),
     re_path(r'^api/v1/', HttpResponseGone),
     re_path(r'^api/v2/', include('rehagoal_server_app.urls')),
-    re_path(r'^api/v2/schema/$', schema_view),
+    re_path(r'^api/v2/schema/$', CachedSchemaView.as_view()),
     re_path(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     re_path(r'^api-token-auth/', obtain_jwt_token),
     re_path(r'^api-token-refresh/', refresh_jwt_token),
@@ -5,11 +5,13 @@ It exposes the WSGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/wsgi/
+
+Token-authenticated REST API requests are processed with a reduced middleware stack (see handlers.py).
 """
 
 import os
 
-from django.core.wsgi import get_wsgi_application
+from rehagoal_server.handlers import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "rehagoal_server.settings")
 
@@ -1,10 +1,197 @@
 from django.contrib import admin
+from django.contrib.admin.utils import NestedObjects, model_ngettext, quote
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
-from django.db.models import QuerySet
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import Count, Q, QuerySet
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import NoReverseMatch, path, reverse
+from django.utils.html import format_html
+from django.utils.functional import cached_property
+from django.utils.text import capfirst, smart_split, unescape_string_literal
 from django.utils.translation import gettext_lazy as T
 
-from rehagoal_server_app.models import RehagoalUser, SimpleUser, Workflow
+from rehagoal_server_app.models import RehagoalUser, RequestProfile, SimpleUser, Workflow
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator, which uses the table statistics of the database as the number of objects of large unfiltered
+    querysets, instead of counting every row (which requires a full table or index scan).
+    Statistics are available for PostgreSQL (pg_class) and SQLite (sqlite_stat1, after ANALYZE).
+    """
+
+    #: Estimates below this number are replaced by an exact count, as estimates are imprecise for small tables
+    min_estimated_count = 10000
+
+    def estimate_count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None or query.where or query.distinct or query.is_sliced:
+            return None
+        connection = connections[self.object_list.db]
+        table = self.object_list.model._meta.db_table
+        if connection.vendor == 'postgresql':
+            sql = "SELECT reltuples FROM pg_class WHERE relname = %s"
+        elif connection.vendor == 'sqlite':
+            if 'sqlite_stat1' not in connection.introspection.table_names(include_views=False):
+                return None
+            sql = "SELECT CAST(stat AS INTEGER) FROM sqlite_stat1 WHERE tbl = %s LIMIT 1"
+        else:
+            return None
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [table])
+                row = cursor.fetchone()
+        except DatabaseError:
+            return None
+        return int(row[0]) if row and row[0] is not None else None
+
+    @cached_property
+    def count(self):
+        estimate = self.estimate_count()
+        if estimate is not None and estimate >= self.min_estimated_count:
+            return estimate
+        return super(EstimatedCountPaginator, self).count
+
+
+class UsernameSearchMixin(object):
+    """
+    Searches by primary key and by username prefix (see filters.Prefix) of the related user, both answered by an
+    index: the username is searched in a subquery of primary keys, as an OR of conditions on joined tables cannot
+    use the indexes and scans the whole table.
+    """
+
+    #: Relation to the searched user, e.g. 'owner__user'
+    search_user_lookup = None
+
+    def get_search_results(self, request, queryset, search_term):
+        pk_field = self.model._meta.pk
+        for term in smart_split(search_term):
+            if term.startswith(('"', "'")) and term[0] == term[-1]:
+                term = unescape_string_literal(term)
+            matching = self.model._default_manager.filter(**{self.search_user_lookup + '__username__prefix': term})
+            condition = Q(pk__in=matching.values('pk'))
+            try:
+                condition |= Q(pk=pk_field.to_python(term))
+            except ValidationError:  # e.g. not a number
+                pass
+            queryset = queryset.filter(condition)
+        return queryset, False
+
+
+class WorkflowSummary(object):
+    """
+    Node of the related workflows of a deleted object in the graph of WorkflowSummaryCollector.
+    """
+
+    def __init__(self, count):
+        self.count = count
+
+
+class WorkflowSummaryCollector(NestedObjects):
+    """
+    Collects the objects deleted along with the given ones for the delete confirmation like the admin, except for the
+    workflows (and their revisions), which would be loaded one by one. They are added as WorkflowSummary instead.
+    """
+
+    def related_objects(self, related_model, related_fields, objs):
+        if related_model is Workflow:
+            return related_model._base_manager.none()
+        return super(WorkflowSummaryCollector, self).related_objects(related_model, related_fields, objs)
+
+
+class WorkflowBulkDeleteMixin(object):
+    """
+    Deletes the workflows related to the deleted objects with WorkflowQuerySet.bulk_delete,
+    instead of loading every single workflow for the per-instance delete signals.
+    """
+
+    #: Lookup of the workflows related to the deleted objects, e.g. 'owner__in'
+    workflow_lookup = None
+
+    #: Up to this number of related workflows, the default delete confirmation (listing every object) is shown
+    max_listed_workflows = 100
+
+    def get_related_workflows(self, objs):
+        return Workflow.objects.filter(**{self.workflow_lookup: objs})
+
+    def get_workflow_counts(self, objs):
+        """
+        :return: number of related workflows by primary key of the deleted objects, counted in a single query
+        """
+        related_field = self.workflow_lookup[:-len('__in')]
+        return dict(self.get_related_workflows(objs).order_by().values_list(related_field).annotate(Count('pk')))
+
+    def get_deleted_objects(self, objs, request):
+        if self.model is Workflow:
+            workflow_counts = None
+            workflow_count = self.get_related_workflows(objs).count()
+        else:
+            workflow_counts = self.get_workflow_counts(objs)
+            workflow_count = sum(workflow_counts.values())
+        if workflow_count <= self.max_listed_workflows:
+            return super(WorkflowBulkDeleteMixin, self).get_deleted_objects(objs, request)
+        # Only summarize the related workflows, as collecting them would load every single one
+        model_count = {Workflow._meta.verbose_name_plural: workflow_count}
+        workflow_admin = self.admin_site._registry.get(Workflow)
+        perms_needed = set()
+        if workflow_admin and not workflow_admin.has_delete_permission(request):
+            perms_needed.add(Workflow._meta.verbose_name)
+        if self.model is Workflow:
+            return [self.summarize_workflows(workflow_count)], model_count, perms_needed, []
+        collector = WorkflowSummaryCollector(using=router.db_for_write(self.model))
+        collector.collect(objs)
+        for obj in objs:
+            collector.add_edge(obj, WorkflowSummary(workflow_counts.get(obj.pk, 0)))
+
+        def format_callback(obj):
+            if isinstance(obj, WorkflowSummary):
+                return self.summarize_workflows(obj.count)
+            return self.format_deleted_object(obj, request, perms_needed)
+
+        deleted_objects = collector.nested(format_callback)
+        protected = [format_callback(obj) for obj in collector.protected]
+        model_count.update((model._meta.verbose_name_plural, len(instances))
+                           for model, instances in collector.model_objs.items())
+        return deleted_objects, model_count, perms_needed, protected
+
+    def format_deleted_object(self, obj, request, perms_needed):
+        """
+        Format an object of the delete confirmation like the admin (see django.contrib.admin.utils.get_deleted_objects),
+        with a link to its change page, if it is registered in the admin site.
+        """
+        opts = obj._meta
+        no_edit_link = '%s: %s' % (capfirst(opts.verbose_name), obj)
+        model_admin = self.admin_site._registry.get(obj.__class__)
+        if model_admin is None:
+            return no_edit_link
+        if not model_admin.has_delete_permission(request, obj):
+            perms_needed.add(opts.verbose_name)
+        try:
+            admin_url = reverse('%s:%s_%s_change' % (self.admin_site.name, opts.app_label, opts.model_name),
+                                args=(quote(obj.pk),))
+        except NoReverseMatch:
+            return no_edit_link
+        return format_html('{}: <a href="{}">{}</a>', capfirst(opts.verbose_name), admin_url, obj)
+
+    @staticmethod
+    def summarize_workflows(count):
+        return '%d %s' % (count, model_ngettext(Workflow._meta, count))
+
+    def delete_model(self, request, obj):
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            self.get_related_workflows([obj]).bulk_delete()
+            if self.model is not Workflow:
+                super(WorkflowBulkDeleteMixin, self).delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            self.get_related_workflows(queryset).bulk_delete()
+            if self.model is not Workflow:
+                super(WorkflowBulkDeleteMixin, self).delete_queryset(request, queryset)
 
 
 class RehagoalUserInline(admin.StackedInline):
@@ -12,26 +199,101 @@ class RehagoalUserInline(admin.StackedInline):
     can_delete = False
 
 
-class UserAdmin(BaseUserAdmin):
+class UserAdmin(WorkflowBulkDeleteMixin, BaseUserAdmin):
     inlines = (RehagoalUserInline,)
+    workflow_lookup = 'owner__user__in'
 
 
-class SimpleUserAdmin(BaseUserAdmin):
+class SimpleUserAdmin(WorkflowBulkDeleteMixin, BaseUserAdmin):
     fieldsets = (
         (None, {'fields': ('username', 'password')}),
         (T('Personal info'), {'fields': ('first_name', 'last_name', 'email')}),
     )
     list_display = ('username', 'email', 'first_name', 'last_name')
     list_filter = ()
+    workflow_lookup = 'owner__user__in'
 
     def get_queryset(self, request):
         qs = super(SimpleUserAdmin, self).get_queryset(request)  # type: QuerySet
         return qs.filter(is_staff=False, is_superuser=False)
 
 
+class RehagoalUserAdmin(UsernameSearchMixin, WorkflowBulkDeleteMixin, admin.ModelAdmin):
+    list_display = ('id', 'user', 'storage_used', 'storage_quota')
+    list_select_related = ('user',)
+    readonly_fields = ('storage_used',)
+    # Only shows the search box, see UsernameSearchMixin
+    search_fields = ('id', 'user__username')
+    search_user_lookup = 'user'
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    workflow_lookup = 'owner__in'
+
+
+class WorkflowAdmin(UsernameSearchMixin, WorkflowBulkDeleteMixin, admin.ModelAdmin):
+    list_display = ('id', 'owner')
+    list_select_related = ('owner__user',)
+    # Only shows the search box, see UsernameSearchMixin
+    search_fields = ('id', 'owner__user__username')
+    search_user_lookup = 'owner__user'
+    raw_id_fields = ('owner',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    workflow_lookup = 'pk__in'
+
+
+class RequestProfileAdmin(admin.ModelAdmin):
+    """
+    Request profiles (see profiling.py), which are recorded on demand and can only be viewed, downloaded and deleted.
+    """
+    list_display = ('created', 'method', 'path', 'status_code', 'duration', 'query_count', 'sample_count', 'user')
+    list_filter = ('method', 'status_code')
+    fields = ('created', 'user', 'method', 'path', 'status_code', 'duration', 'sample_count', 'query_count',
+              'query_duration', 'downloads', 'queries')
+    readonly_fields = fields
+    #: Downloads of the profile: kind -> (field, file extension)
+    download_kinds = {
+        'stacks': ('stacks', 'folded'),
+        'sql': ('queries', 'sql'),
+    }
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<int:object_id>/download/<str:kind>/', self.admin_site.admin_view(self.download_view),
+                 name='rehagoal_server_app_requestprofile_download'),
+        ] + super(RequestProfileAdmin, self).get_urls()
+
+    @admin.display(description=T('Downloads'))
+    def downloads(self, obj):
+        return format_html(
+            '<a href="{}">{}</a> (flamegraph.pl, speedscope) &middot; <a href="{}">{}</a>',
+            reverse('admin:rehagoal_server_app_requestprofile_download', args=(obj.pk, 'stacks')), T('Stacks'),
+            reverse('admin:rehagoal_server_app_requestprofile_download', args=(obj.pk, 'sql')), T('SQL'),
+        )
+
+    def download_view(self, request, object_id, kind):
+        if kind not in self.download_kinds:
+            raise Http404()
+        profile = get_object_or_404(RequestProfile, pk=object_id)
+        if not self.has_view_permission(request, profile):
+            raise PermissionDenied
+        field, extension = self.download_kinds[kind]
+        response = HttpResponse(getattr(profile, field), content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="profile-%d.%s"' % (profile.pk, extension)
+        return response
+
+
 # Re-register UserAdmin
 admin.site.unregister(User)
 admin.site.register(User, UserAdmin)
 admin.site.register(SimpleUser, SimpleUserAdmin)
-admin.site.register(RehagoalUser)
-admin.site.register(Workflow)
+admin.site.register(RehagoalUser, RehagoalUserAdmin)
+admin.site.register(Workflow, WorkflowAdmin)
+admin.site.register(RequestProfile, RequestProfileAdmin)
@@ -0,0 +1,227 @@
+"""
+Admission control of workflow transfers (uploads and downloads), per user (or owner of the content, for signed
+downloads):
+- a limit of concurrent transfers,
+- token buckets limiting the rate of transfer requests and transferred bytes.
+
+Transfers over the limits are rejected with 429 (and Retry-After) by TransferThrottle, before the request body is
+read. The state is shared by all worker processes in a local SQLite database (settings.WORKFLOW_ADMISSION_CONTROL),
+whose transactions make the checks atomic. Transfers are released when the response is closed, or when the request
+fails (see TransferAdmissionMixin). Transfers of killed processes are released, once their PID is gone.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from rest_framework.throttling import BaseThrottle
+
+from . import signing
+
+#: Default configuration, which can be overridden with settings.WORKFLOW_ADMISSION_CONTROL
+DEFAULT_CONFIG = {
+    'DATABASE': None,  # path of the SQLite database, defaults to cache/admission.sqlite3
+    'MAX_CONCURRENT_TRANSFERS': 4,  # per user, None for unlimited
+    'REQUEST_RATE': 5.0,  # transfer requests per second and user, None for unlimited
+    'REQUEST_BURST': 100,
+    'BYTE_RATE': 20 * 1024 * 1024,  # transferred bytes per second and user, None for unlimited
+    'BYTE_BURST': 1024 * 1024 * 1024,  # more than twice the maximum file size, for an upload and a download
+}
+#: Retry-After (seconds), if the limit of concurrent transfers is reached
+CONCURRENCY_RETRY_AFTER = 1
+#: Maximum time (seconds) to wait for the lock of the database
+BUSY_TIMEOUT = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bucket (key TEXT NOT NULL, kind TEXT NOT NULL, tokens REAL NOT NULL, updated REAL NOT NULL,
+                                   PRIMARY KEY (key, kind));
+CREATE TABLE IF NOT EXISTS lease (id INTEGER PRIMARY KEY, key TEXT NOT NULL, pid INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS lease_key ON lease (key);
+"""
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class AdmissionController(object):
+
+    def __init__(self, path, max_concurrent_transfers=None, request_rate=None, request_burst=1,
+                 byte_rate=None, byte_burst=1):
+        self.path = path
+        self.max_concurrent_transfers = max_concurrent_transfers
+        self.buckets = [
+            (kind, rate, burst) for kind, rate, burst in (('requests', request_rate, request_burst),
+                                                          ('bytes', byte_rate, byte_burst)) if rate
+        ]
+        self._local = threading.local()
+
+    @classmethod
+    def from_settings(cls):
+        config = getattr(settings, 'WORKFLOW_ADMISSION_CONTROL', {})
+        if config is None:  # disabled
+            return None
+        config = dict(DEFAULT_CONFIG, **config)
+        return cls(config['DATABASE'] or os.path.join(settings.BASE_DIR, 'cache', 'admission.sqlite3'),
+                   config['MAX_CONCURRENT_TRANSFERS'], config['REQUEST_RATE'], config['REQUEST_BURST'],
+                   config['BYTE_RATE'], config['BYTE_BURST'])
+
+    @property
+    def connection(self):
+        # One connection per thread (and process, as connections must not be used across fork)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def acquire(self, key, size=0):
+        """
+        Admit a transfer of the given size (bytes), if it is within the limits of the given key.
+        :return: (lease ID, None) if the transfer is admitted, which has to be released when it is finished,
+                 or (None, seconds to wait) otherwise
+        """
+        connection = self.connection
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if self.max_concurrent_transfers is not None and \
+                    self._active_transfers(connection, key) >= self.max_concurrent_transfers:
+                connection.execute('ROLLBACK')
+                return None, CONCURRENCY_RETRY_AFTER
+            updates = []
+            wait = 0
+            for kind, rate, burst in self.buckets:
+                row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ? AND kind = ?',
+                                         (key, kind)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+                # Transfers larger than the burst are admitted with a full bucket
+                cost = min(1 if kind == 'requests' else size, burst)
+                if tokens < cost:
+                    wait = max(wait, (cost - tokens) / rate)
+                updates.append((key, kind, tokens - cost, now))
+            if wait:
+                connection.execute('ROLLBACK')
+                return None, math.ceil(wait)
+            connection.executemany('INSERT OR REPLACE INTO bucket (key, kind, tokens, updated) VALUES (?, ?, ?, ?)',
+                                   updates)
+            lease = connection.execute('INSERT INTO lease (key, pid) VALUES (?, ?)', (key, os.getpid())).lastrowid
+            connection.execute('COMMIT')
+            return lease, None
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+
+    def _active_transfers(self, connection, key):
+        pids = [pid for pid, in connection.execute('SELECT pid FROM lease WHERE key = ?', (key,))]
+        if len(pids) >= self.max_concurrent_transfers:
+            # Release the transfers of killed processes
+            dead = [(pid,) for pid in set(pids) if not pid_exists(pid)]
+            if dead:
+                connection.executemany('DELETE FROM lease WHERE pid = ?', dead)
+                return connection.execute('SELECT COUNT(*) FROM lease WHERE key = ?', (key,)).fetchone()[0]
+        return len(pids)
+
+    def release(self, lease):
+        self.connection.execute('DELETE FROM lease WHERE id = ?', (lease,))
+
+
+admission_controller = AdmissionController.from_settings()
+
+
+@receiver(setting_changed)
+def reload_admission_controller(setting, **_kwargs):
+    # e.g. override_settings in the tests
+    global admission_controller
+    if setting == 'WORKFLOW_ADMISSION_CONTROL':
+        admission_controller = AdmissionController.from_settings()
+
+
+class TransferThrottle(BaseThrottle):
+    """
+    Throttle admitting transfers with the AdmissionController. Views define the transfers with
+    get_transfer_size(request), which returns the size in bytes, or None if the request is not a transfer.
+    The transfer is released when the response is closed (see TransferAdmissionMixin).
+    """
+
+    def __init__(self):
+        self.retry_after = None
+
+    def get_key(self, request, view):
+        # Signed downloads are not authenticated (see ContentFileDownloadView), they are limited per owner of the
+        # content, which is covered by the signature (unlike the client address, see get_ident)
+        if getattr(view, 'signed', None) is not None:
+            return 'user:%s' % request.query_params[signing.OWNER_PARAM]
+        if request.user and request.user.is_authenticated:
+            return 'user:%s' % request.user.rehagoal_user.id
+        return 'address:%s' % self.get_ident(request)
+
+    def allow_request(self, request, view):
+        if admission_controller is None:
+            return True
+        size = view.get_transfer_size(request)
+        if size is None:
+            return True
+        lease, self.retry_after = admission_controller.acquire(self.get_key(request, view), size)
+        if lease is None:
+            return False
+        request.transfer_lease = lease
+        return True
+
+    def wait(self):
+        return self.retry_after
+
+
+def release_transfer(request, response):
+    """
+    Release the transfer admitted for the request (if any), when the response has been sent and is closed.
+    """
+    lease = getattr(request, 'transfer_lease', None)
+    if lease is not None:
+        request.transfer_lease = None
+        close = response.close
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                admission_controller.release(lease)
+
+        response.close = close_and_release
+    return response
+
+
+class TransferAdmissionMixin(object):
+    """
+    Mixin for API views admitting transfers with TransferThrottle, which releases the transfer when the response
+    is closed, or right away if the request fails with an uncaught exception (which APIView.dispatch re-raises
+    without finalizing the response).
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(TransferAdmissionMixin, self).dispatch(request, *args, **kwargs)
+        except BaseException:
+            lease = getattr(getattr(self, 'request', None), 'transfer_lease', None)
+            if lease is not None:
+                self.request.transfer_lease = None
+                admission_controller.release(lease)
+            raise
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(TransferAdmissionMixin, self).finalize_response(request, response, *args, **kwargs)
+        return release_transfer(request, response)
@@ -1,9 +1,74 @@
+import math
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet, ModelViewSet
 
+from .admission import TransferAdmissionMixin, TransferThrottle
+from .auditlog import AuditLogMixin
+from . import delta
+from .filters import PrefixSearchFilter
 from .permissions import IsOwnerOrReadOnly, IsAdminOrDenyList
-from .models import RehagoalUser, Workflow
-from .serializers import RehagoalUserSerializer, WorkflowSerializer
+from .content import ContentInfo
+from .models import RehagoalUser, StorageQuotaExceeded, Workflow
+from .notifications import notifier
+from .revisions import RevisionError, reconstruct_revision
+from .serializers import (
+    RehagoalUserSerializer, WorkflowListSerializer, WorkflowPrecheckSerializer, WorkflowRevisionSerializer,
+    WorkflowSerializer,
+)
+
+#: Allowance (bytes) for the multipart encoding and the other fields of upload requests,
+#: when checking their Content-Length against the available storage
+UPLOAD_OVERHEAD = 64 * 1024
+#: Maximum size (bytes) of delta updates of workflow contents (see patch_content), larger changes are uploaded as whole
+MAX_PATCH_SIZE = 16 * 1024 * 1024
+#: Maximum number of digests per pre-check of workflow uploads (see precheck). Each is a parameter of a query, whose
+#: maximum number is 999 for SQLite before 3.32
+MAX_PRECHECK_ITEMS = 900
+
+
+class StorageQuotaExceededError(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Storage quota exceeded.'
+    default_code = 'storage_quota_exceeded'
+
+
+class PatchTooLargeError(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'The patch is too large, upload the whole content instead.'
+    default_code = 'patch_too_large'
+
+
+class PreconditionRequiredError(APIException):
+    status_code = status.HTTP_428_PRECONDITION_REQUIRED
+    default_detail = 'The If-Match header with the SHA-256 digest (ETag) of the patched content is required.'
+    default_code = 'precondition_required'
+
+
+class PreconditionFailedError(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The content has been changed, the patch does not apply to the current content.'
+    default_code = 'precondition_failed'
+
+
+class WorkflowChangedError(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The workflow has been changed in the meantime. Try again.'
+    default_code = 'workflow_changed'
+
+
+class RevisionUnavailableError(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The revision could not be restored, as the workflow has been changed. Try again.'
+    default_code = 'revision_unavailable'
 
 
 class RehagoalUserViewSet(ReadOnlyModelViewSet):
@@ -23,18 +88,19 @@ class RehagoalUserViewSet(ReadOnlyModelViewSet):
     delete:
     Delete a registered user.
     """
-    queryset = RehagoalUser.objects.all().order_by('-user__date_joined')
+    queryset = RehagoalUser.objects.select_related('user').order_by('-user__date_joined')
     serializer_class = RehagoalUserSerializer
     permission_classes = (IsAuthenticated, IsOwnerOrReadOnly, IsAdminOrDenyList)
 
 
-class WorkflowViewSet(ModelViewSet):
+class WorkflowViewSet(TransferAdmissionMixin, AuditLogMixin, ModelViewSet):
     """
     retrieve:
     Return the given RehaGoal workflow.
 
     list:
     Return a list of all RehaGoal workflows visible to the authenticated user.
+    Use the `search` parameter to filter by a prefix of the workflow name.
 
     create:
     Create a new RehaGoal workflow.
@@ -47,16 +113,277 @@ class WorkflowViewSet(ModelViewSet):
 
     delete:
     Delete an existing RehaGoal workflow.
+
+    patch_content:
+    Update the content of the given RehaGoal workflow with a patch against its current content, whose SHA-256 digest
+    is required in the `If-Match` header (quoted, like the ETag of downloads). The patch is either a JSON Patch
+    (RFC 6902, `application/json-patch+json`) for JSON workflows, or a binary delta
+    (`application/vnd.rehagoal.delta+json`), i.e. an array of `["copy", <offset>, <length>]` and
+    `["insert", "<base64>"]` instructions. Returns `412` if the content has been changed in the meantime.
+
+    precheck:
+    Check which contents need to be uploaded, before uploading them: for every item of the submitted array,
+    `{"sha256": "<hex digest>"}` creates a new workflow and `{"sha256": "<hex digest>", "id": "<workflow ID>"}`
+    updates the given workflow, if one of the workflows of the authenticated user already has a content with this
+    digest. The content is then shared on the server (no upload). Returns an array with the `status` of every item
+    (`created`, `updated`, `unchanged`, `upload_required`, `not_found` or `storage_quota_exceeded`) and the
+    created or updated `workflow`. Contents of other users are never matched.
+
+    copy:
+    Create a copy of the given RehaGoal workflow, which is owned by the authenticated user (e.g. from a template).
+    The content is shared on the server until either workflow is updated, and counts towards the storage quota.
+
+    revisions:
+    Return the former contents (revisions) of the given RehaGoal workflow, newest first.
+
+    restore_revision:
+    Replace the content of the given RehaGoal workflow by the content of one of its revisions.
+    The replaced content becomes a new revision, so that restoring can be undone.
+
+    changes:
+    Wait for changes of the workflows owned by the authenticated user (long-polling).
+    Returns the current `cursor` immediately if the `since` parameter is missing or differs from it,
+    otherwise as soon as a workflow is created, updated or deleted, or after `timeout` seconds.
+    If the server cannot wait (too many waiting requests, or a server handling one request per process), the response
+    is returned right away, with a `Retry-After` header (seconds) if nothing has changed.
     """
     serializer_class = WorkflowSerializer
     queryset = Workflow.objects.all()
     permission_classes = (IsAuthenticated, IsOwnerOrReadOnly)
+    filter_backends = (PrefixSearchFilter,)
+    search_fields = ('^name',)
+    throttle_classes = (TransferThrottle,)
+    audit_event = 'workflow'
 
     def get_queryset(self):
         user = self.request.user
-        if user.is_staff or self.action == "retrieve":
+        if user.is_staff or self.action in ("retrieve", "copy"):
             return Workflow.objects.all()
         return Workflow.objects.filter(owner=user.rehagoal_user)
 
+    def list(self, request, *args, **kwargs):
+        if not WorkflowListSerializer.supports(request, self.format_kwarg):
+            return super(WorkflowViewSet, self).list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset()).values(*WorkflowListSerializer.values)
+        page = self.paginate_queryset(queryset)
+        data = WorkflowListSerializer(request).to_representation(queryset if page is None else page)
+        return self.get_paginated_response(data) if page is not None else Response(data)
+
+    def get_object(self):
+        # Cached, as updates need the stored size for the storage quota check, before the request body is parsed
+        if not hasattr(self, '_object'):
+            self._object = super(WorkflowViewSet, self).get_object()
+        return self._object
+
+    def get_transfer_size(self, request):
+        """
+        Size (bytes) of the upload for the admission control (see admission.py), None for other requests.
+        """
+        if self.action in ('copy', 'precheck', 'restore_revision'):
+            return 0  # counts as transfer, but without receiving a body
+        if self.action not in ('create', 'update', 'partial_update', 'patch_content'):
+            return None
+        try:
+            return int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return 0
+
+    def get_audit_fields(self, request, response):
+        workflow_id = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        data = response.data if isinstance(response.data, dict) else {}
+        if workflow_id is None and response.status_code == status.HTTP_201_CREATED:
+            workflow_id = data.get('id')
+        fields = {'workflow': workflow_id}
+        if self.action in ('create', 'update', 'partial_update', 'patch_content', 'restore_revision') and \
+                status.is_success(response.status_code):
+            fields.update(sha256=data.get('sha256'), size=data.get('size'))
+        if self.action == 'restore_revision':
+            fields['revision'] = self.kwargs.get('number')
+        if self.action == 'copy' and status.is_success(response.status_code):
+            fields.update(copy=data.get('id'), sha256=data.get('sha256'), size=data.get('size'))
+        return fields
+
+    def check_storage_quota(self, replaced_size=0):
+        """
+        Reject uploads, which obviously exceed the storage quota, before the request body is received.
+        The exact check is done when the workflow is saved (see models.add_storage_used).
+        """
+        available = self.request.user.rehagoal_user.get_storage_available()
+        if available is None:
+            return
+        try:
+            content_length = int(self.request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return
+        if content_length - UPLOAD_OVERHEAD > available + replaced_size:
+            raise StorageQuotaExceededError()
+
+    def create(self, request, *args, **kwargs):
+        self.check_storage_quota()
+        return super(WorkflowViewSet, self).create(request, *args, **kwargs)
+
+    def update(self, request, *args, **kwargs):
+        if request.user.rehagoal_user.get_storage_available() is not None:
+            self.check_storage_quota(self.get_object().size or 0)
+        return super(WorkflowViewSet, self).update(request, *args, **kwargs)
+
     def perform_create(self, serializer):
-        serializer.save(owner=self.request.user.rehagoal_user)
+        try:
+            serializer.save(owner=self.request.user.rehagoal_user)
+        except StorageQuotaExceeded:
+            raise StorageQuotaExceededError()
+
+    def perform_update(self, serializer):
+        try:
+            serializer.save()
+        except StorageQuotaExceeded:
+            raise StorageQuotaExceededError()
+
+    @action(detail=True, methods=['patch'], url_path='content',
+            parser_classes=(delta.JSONPatchParser, delta.BinaryDeltaParser))
+    def patch_content(self, request, pk=None):
+        try:
+            if int(request.META.get('CONTENT_LENGTH') or 0) > MAX_PATCH_SIZE:
+                raise PatchTooLargeError()
+        except ValueError:
+            pass
+        etags = parse_etags(request.META.get('HTTP_IF_MATCH', ''))
+        if not etags or etags == ['*']:
+            raise PreconditionRequiredError()
+        workflow = self.get_object()
+        if not workflow.sha256 or quote_etag(workflow.sha256) not in etags:
+            raise PreconditionFailedError()
+        operations = request.data
+        storage = workflow.content.storage
+        try:
+            if request.content_type.startswith(delta.JSONPatchParser.media_type):
+                content = delta.apply_json_patch_to_content(storage, workflow.content.name, operations)
+            else:
+                content = delta.apply_binary_delta(storage, workflow.content.name, operations)
+        except delta.DeltaError as e:
+            raise ValidationError({'patch': [str(e)]})
+        except FileNotFoundError:
+            raise PreconditionFailedError()
+        with content, transaction.atomic():
+            # The content may have been changed while the patch was applied
+            base = Workflow.objects.select_for_update().filter(pk=workflow.pk).values_list('sha256', flat=True).first()
+            if base != workflow.sha256:
+                raise PreconditionFailedError()
+            self.save_content(workflow, content)
+        return Response(self.get_serializer(workflow).data)
+
+    def save_content(self, workflow, content):
+        workflow.content = content
+        try:
+            workflow.save()
+        except StorageQuotaExceeded:
+            raise StorageQuotaExceededError()
+
+    @action(detail=False, methods=['post'], pagination_class=None, filter_backends=())
+    def precheck(self, request):
+        # Checked before the validation, whose cost grows with the number of items
+        if isinstance(request.data, list) and len(request.data) > MAX_PRECHECK_ITEMS:
+            raise ValidationError('At most %d digests can be checked at once.' % MAX_PRECHECK_ITEMS)
+        serializer = WorkflowPrecheckSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data
+        owner = request.user.rehagoal_user
+        # Only contents of the user are matched, so that the digests do not reveal contents of other users
+        known = {}
+        for row in Workflow.objects.filter(owner=owner, sha256__in={item['sha256'] for item in items}).values(
+                'content', 'sha256', 'size', 'name', 'task_count'):
+            known.setdefault(row['sha256'], row)
+        workflows = Workflow.objects.filter(owner=owner, pk__in={item['id'] for item in items if 'id' in item})
+        workflows = {workflow.pk: workflow for workflow in workflows}
+        results = []
+        for item in items:
+            workflow = Workflow(owner=owner) if 'id' not in item else workflows.get(item['id'])
+            item_status = self.precheck_item(workflow, item['sha256'], known.get(item['sha256']))
+            results.append({
+                'sha256': item['sha256'],
+                'status': item_status,
+                'workflow': self.get_serializer(workflow).data if item_status in ('created', 'updated', 'unchanged')
+                else None,
+            })
+        return Response(results)
+
+    @staticmethod
+    def precheck_item(workflow, sha256, known):
+        """
+        Create or update the workflow with the known content (row of a workflow with the given digest, if any).
+        :return: status of the pre-check item
+        """
+        if workflow is None:
+            return 'not_found'
+        if workflow.sha256 == sha256:
+            return 'unchanged'
+        if known is None:
+            return 'upload_required'
+        created = workflow._state.adding
+        try:
+            workflow.save_linked_content(known['content'], ContentInfo(
+                known['sha256'], known['size'], known['name'], known['task_count']))
+        except FileNotFoundError:  # replaced in the meantime
+            return 'upload_required'
+        except StorageQuotaExceeded:
+            if not created:
+                workflow.refresh_from_db()
+            return 'storage_quota_exceeded'
+        return 'created' if created else 'updated'
+
+    @action(detail=True, methods=['post'], permission_classes=(IsAuthenticated,))
+    def copy(self, request, pk=None):
+        # Like retrieve, any workflow can be copied, as it is not modified
+        source = self.get_object()
+        workflow = Workflow(owner=request.user.rehagoal_user)
+        try:
+            workflow.save_linked_content(source.content.name, ContentInfo(
+                source.sha256, source.size, source.name, source.task_count))
+        except FileNotFoundError:  # replaced in the meantime
+            raise WorkflowChangedError()
+        except StorageQuotaExceeded:
+            raise StorageQuotaExceededError()
+        return Response(self.get_serializer(workflow).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['get'], pagination_class=None, filter_backends=())
+    def revisions(self, request, pk=None):
+        workflow = self.get_object()
+        return Response(WorkflowRevisionSerializer(workflow.revisions.all(), many=True).data)
+
+    @action(detail=True, methods=['post'], url_path=r'revisions/(?P<number>[0-9]+)/restore')
+    def restore_revision(self, request, pk=None, number=None):
+        workflow = self.get_object()
+        revision = get_object_or_404(workflow.revisions.all(), number=number)
+        try:
+            content = reconstruct_revision(revision)
+        except RevisionError:
+            raise RevisionUnavailableError()
+        with content:
+            self.save_content(workflow, content)
+        return Response(self.get_serializer(workflow).data)
+
+    @action(detail=False, methods=['get'], pagination_class=None, filter_backends=())
+    def changes(self, request):
+        max_timeout = getattr(settings, 'WORKFLOW_CHANGES_TIMEOUT', 30)
+        try:
+            timeout = min(float(request.query_params.get('timeout', max_timeout)), max_timeout)
+        except ValueError:
+            raise ValidationError({'timeout': 'A number of seconds is required.'})
+        owner_id = request.user.rehagoal_user.id
+        since = request.query_params.get('since')
+        cursor = None
+        # Servers handling one request per process at a time (e.g. the serve command) would be blocked by waiting
+        if since is not None and request.META.get('wsgi.multithread', False):
+            if not connection.in_atomic_block:
+                # Do not keep the database connection open while waiting
+                connection.close()
+            cursor = notifier.wait(owner_id, since, max(timeout, 0))
+        waited = cursor is not None
+        if not waited:
+            cursor = notifier.cursor(owner_id)
+        changed = since is not None and cursor != since
+        headers = {}
+        if since is not None and not waited and not changed:
+            # Not waited, the client should poll again later instead of right away
+            headers['Retry-After'] = str(max(math.ceil(timeout), 1))
+        return Response({'cursor': cursor, 'changed': changed}, headers=headers)
@@ -5,3 +5,9 @@ from django.apps import AppConfig
 
 class RehagoalServerAppConfig(AppConfig):
     name = 'rehagoal_server_app'
+
+    def ready(self):
+        # Register the prefix lookup (used by the searches of the admin and the API)
+        from . import filters  # noqa: F401
+        # Connect the signal receivers recording workflow revisions
+        from . import revisions  # noqa: F401
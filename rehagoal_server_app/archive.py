@@ -0,0 +1,59 @@
+"""
+Format of workflow archives (see the export_workflows and import_workflows commands).
+
+Archives are tar files (optionally compressed), with the following members in this order:
+- snapshot.json: format version, creation time of the snapshot, and the filters used for the export
+- users.jsonl: one JSON object per line with the fields of every exported RehagoalUser (see USER_FIELDS), including
+  users without (changed) workflows
+- workflows.jsonl: one JSON object per line with the fields of every exported Workflow (see WORKFLOW_FIELDS)
+- contents/<content file name>: the content of every exported workflow
+"""
+import json
+import tarfile
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+FORMAT_VERSION = 1
+SNAPSHOT_MEMBER = 'snapshot.json'
+USERS_MEMBER = 'users.jsonl'
+WORKFLOWS_MEMBER = 'workflows.jsonl'
+CONTENTS_PREFIX = 'contents/'
+
+USER_FIELDS = ('id', 'username', 'storage_quota')
+WORKFLOW_FIELDS = ('id', 'owner_id', 'content', 'sha256', 'name', 'task_count', 'size', 'modified')
+
+#: Compression methods supported by tarfile (streaming mode), None for uncompressed archives
+COMPRESSIONS = ('gz', 'bz2', 'xz')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def content_member(name):
+    return CONTENTS_PREFIX + name
+
+
+def dump_line(data):
+    """
+    Encode a row as line of a .jsonl member.
+    """
+    return json.dumps(data, separators=(',', ':'), cls=DjangoJSONEncoder).encode() + b'\n'
+
+
+def read_snapshot(path):
+    """
+    Return the snapshot information (snapshot.json) of the given archive, which is its first member.
+    :raises ArchiveError: if the file is not a workflow archive
+    """
+    try:
+        with tarfile.open(path, 'r|*') as archive:
+            member = archive.next()
+            if member is None or member.name != SNAPSHOT_MEMBER:
+                raise ArchiveError("%s is not a workflow archive" % path)
+            snapshot = json.load(archive.extractfile(member))
+    except (tarfile.TarError, ValueError) as e:
+        raise ArchiveError("%s is not a workflow archive: %s" % (path, e))
+    if snapshot.get('version') != FORMAT_VERSION:
+        raise ArchiveError("Unsupported archive format version %r" % snapshot.get('version'))
+    return snapshot
@@ -0,0 +1,233 @@
+"""
+Structured access and audit logging of the workflow API and content downloads, as JSON lines.
+
+Views with AuditLogMixin log one record per request to the logger 'rehagoal_server_app.audit' (who accessed or changed
+which workflow, with the status and duration). The records are written by QueuedRotatingFileHandler (configured in
+settings.LOGGING), which only formats them and puts them into a bounded queue: a background thread writes them to the
+file in batches (all records queued while the previous batch was written), and rotates the file by size. Requests are
+therefore not blocked by a slow disk. If the queue is full, records are dropped and the number of dropped records
+is logged later, instead of blocking.
+
+For data minimization, users are logged by their ID, and neither client addresses nor query strings are logged.
+"""
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+try:
+    import fcntl
+except ImportError:  # Windows, where rotation is not synchronized between processes
+    fcntl = None
+
+LOGGER_NAME = 'rehagoal_server_app.audit'
+audit_log = logging.getLogger(LOGGER_NAME)
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """
+    Formats records as JSON objects (without line breaks), including the fields of the `audit` extra attribute.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'audit', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, cls=DjangoJSONEncoder, separators=(',', ':'))
+
+
+_STOP = object()
+
+
+class QueuedRotatingFileHandler(logging.Handler):
+    """
+    Handler, which writes formatted records to a file from a background thread (see the module documentation).
+    Several processes can log to the same file, the file is rotated (like RotatingFileHandler, path -> path.1 ...)
+    by the first process noticing that it exceeds max_bytes, the others reopen it.
+    """
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5, queue_size=10000, batch_size=1000):
+        super(QueuedRotatingFileHandler, self).__init__()
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._stream = None
+
+    def _start(self):
+        # Started on the first record of every process, as the thread does not survive fork()
+        self._pid = os.getpid()
+        self._queue = queue.Queue(self.queue_size)
+        self._dropped_lock = threading.Lock()
+        self._stream = None
+        self._thread = threading.Thread(target=self._run, name='audit-log-writer', daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def flush(self):
+        """
+        Wait until the queued records are written.
+        """
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._pid = None
+        super(QueuedRotatingFileHandler, self).close()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = _STOP in batch
+            lines = [line for line in batch if line is not _STOP]
+            # Not self.lock, which is held by logging.shutdown() while waiting for this thread in close()
+            with self._dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                lines.append(json.dumps({
+                    'time': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'level': 'WARNING',
+                    'logger': LOGGER_NAME, 'message': '%d record(s) dropped, the log queue was full' % dropped,
+                }, separators=(',', ':')))
+            try:
+                if lines:
+                    self._write(('\n'.join(lines) + '\n').encode('utf-8'))
+            except Exception:
+                logging.getLogger(__name__).exception("Could not write %d audit log record(s)", len(lines))
+                time.sleep(1)  # e.g. disk full, do not spin
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                if self._stream is not None:
+                    self._stream.close()
+                return
+
+    def _open(self):
+        if self._stream is not None:
+            self._stream.close()
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self._stream = open(self.filename, 'ab')
+
+    def _is_current(self):
+        # Whether the open file is still the file at self.filename, i.e. it was not rotated by another process
+        try:
+            return os.path.samestat(os.stat(self.filename), os.fstat(self._stream.fileno()))
+        except FileNotFoundError:
+            return False
+
+    def _write(self, data):
+        if self._stream is None or not self._is_current():
+            self._open()
+        size = os.fstat(self._stream.fileno()).st_size
+        if self.max_bytes and size and size + len(data) > self.max_bytes:
+            self._rotate()
+        self._stream.write(data)
+        self._stream.flush()
+
+    def _rotate(self):
+        with open(self.filename + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have rotated the file while waiting for the lock
+            if self._is_current():
+                if self.backup_count > 0:
+                    for i in range(self.backup_count - 1, 0, -1):
+                        source = '%s.%d' % (self.filename, i)
+                        if os.path.exists(source):
+                            os.replace(source, '%s.%d' % (self.filename, i + 1))
+                    os.replace(self.filename, self.filename + '.1')
+                else:
+                    os.truncate(self.filename, 0)
+            self._open()
+
+
+@receiver(setting_changed)
+def update_audit_log_file(setting, value, **_kwargs):
+    # The handlers are created from settings.LOGGING on startup, which refers to AUDIT_LOG_FILE. The writer thread
+    # opens the new file with the next batch, like after a rotation (e.g. override_settings in the tests).
+    if setting == 'AUDIT_LOG_FILE':
+        for handler in audit_log.handlers:
+            if isinstance(handler, QueuedRotatingFileHandler):
+                handler.flush()
+                handler.filename = os.path.abspath(value)
+
+
+class AuditLogMixin(object):
+    """
+    Mixin for API views, which logs every request (see the module documentation) as event
+    '<audit_event>.<action or method>'. Views add fields with get_audit_fields().
+    """
+
+    audit_event = None
+
+    def dispatch(self, request, *args, **kwargs):
+        self.audit_started = time.perf_counter()
+        return super(AuditLogMixin, self).dispatch(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(AuditLogMixin, self).finalize_response(request, response, *args, **kwargs)
+        if audit_log.isEnabledFor(logging.INFO):
+            try:
+                self.log_request(request, response)
+            except Exception:
+                logging.getLogger(__name__).exception("Could not log request to the audit log")
+        return response
+
+    def log_request(self, request, response):
+        event = '%s.%s' % (self.audit_event, getattr(self, 'action', None) or request.method.lower())
+        fields = {
+            'event': event,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'user': self.get_audit_user_id(request),
+            'duration_ms': round((time.perf_counter() - self.audit_started) * 1000, 3),
+        }
+        fields.update(self.get_audit_fields(request, response))
+        audit_log.info(event, extra={'audit': fields})
+
+    def get_audit_user_id(self, request):
+        user = request.user
+        return user.pk if user is not None and user.is_authenticated else None
+
+    def get_audit_fields(self, request, response):
+        return {}
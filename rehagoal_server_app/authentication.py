@@ -0,0 +1,69 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from rest_framework import exceptions
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.compat import gettext_lazy as _
+
+
+def get_users():
+    """
+    Users are always loaded together with their RehagoalUser, so that ownership checks
+    (e.g. IsOwnerOrReadOnly) do not require an additional query per request.
+    """
+    return get_user_model()._default_manager.select_related('rehagoal_user')
+
+
+class RehagoalUserBackend(ModelBackend):
+    """
+    ModelBackend (used for session and HTTP basic authentication), which loads the RehagoalUser along with the user.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        user_model = get_user_model()
+        if username is None:
+            username = kwargs.get(user_model.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = get_users().get(**{user_model.USERNAME_FIELD: username})
+        except user_model.DoesNotExist:
+            # Run the default password hasher once to reduce the timing
+            # difference between an existing and a nonexistent user (see ModelBackend).
+            user_model().set_password(password)
+        else:
+            if user.check_password(password) and self.user_can_authenticate(user):
+                return user
+        return None
+
+    def get_user(self, user_id):
+        try:
+            user = get_users().get(pk=user_id)
+        except get_user_model().DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
+
+
+class RehagoalJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+    """
+    JSONWebTokenAuthentication, which loads the RehagoalUser along with the user.
+    """
+
+    def authenticate_credentials(self, payload):
+        username = self.jwt_get_username_from_payload(payload)
+
+        if not username:
+            msg = _('Invalid payload.')
+            raise exceptions.AuthenticationFailed(msg)
+
+        user_model = get_user_model()
+        try:
+            user = get_users().get(**{user_model.USERNAME_FIELD: username})
+        except user_model.DoesNotExist:
+            msg = _('Invalid token.')
+            raise exceptions.AuthenticationFailed(msg)
+
+        if not user.is_active:
+            msg = _('User account is disabled.')
+            raise exceptions.AuthenticationFailed(msg)
+
+        return user
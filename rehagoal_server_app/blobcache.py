@@ -0,0 +1,145 @@
+"""
+In-memory cache of small workflow contents, which are downloaded repeatedly by many devices.
+
+Content files are never modified: every upload is stored under a new random name, and the file of replaced or deleted
+content is deleted. Therefore cached contents cannot become stale, entries only need to be removed to free memory
+(see Workflow.delete_content and delete_content_files). Deleted contents are not served from the cache of other
+worker processes either, as the download view checks that the file exists, before the cache is used.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+#: Default configuration, which can be overridden with settings.WORKFLOW_BLOB_CACHE
+DEFAULT_CONFIG = {
+    # Maximum total size of the cached contents (bytes) per process, 0 disables the cache
+    'MAX_SIZE': 32 * 1024 * 1024,
+    # Larger contents are not cached (bytes)
+    'MAX_ENTRY_SIZE': 256 * 1024,
+    # Alias of a Django cache (settings.CACHES) shared by all worker processes, which is used in addition
+    # to the per-process cache, e.g. memcached or a file-based cache in /dev/shm
+    'SHARED_CACHE': None,
+}
+
+CachedBlob = namedtuple('CachedBlob', ['content', 'modified_time'])
+
+
+class BlobCache(object):
+    """
+    Thread-safe LRU cache of CachedBlob entries, limited by the total size of the cached contents.
+    Hits and misses are counted for tuning, see stats().
+    """
+
+    def __init__(self, max_size, max_entry_size, shared_cache=None):
+        """
+        :param max_size: maximum total size of the cached contents (bytes)
+        :param max_entry_size: maximum size of a single cached content (bytes)
+        :param shared_cache: optional alias of a Django cache, which is shared by all worker processes
+        """
+        self.max_size = max_size
+        self.max_entry_size = min(max_entry_size, max_size)
+        self.shared_cache = shared_cache
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls):
+        config = dict(DEFAULT_CONFIG, **getattr(settings, 'WORKFLOW_BLOB_CACHE', {}))
+        return cls(config['MAX_SIZE'], config['MAX_ENTRY_SIZE'], config['SHARED_CACHE'])
+
+    @staticmethod
+    def shared_key(name):
+        return 'workflow-blob:%s' % name
+
+    def accepts(self, size):
+        """
+        Whether a content of the given size (bytes) can be cached.
+        """
+        return self.max_size > 0 and size <= self.max_entry_size
+
+    def get(self, name):
+        """
+        Return the CachedBlob of the content file with the given name, or None.
+        """
+        with self._lock:
+            blob = self._entries.get(name)
+            if blob is not None:
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return blob
+        if self.shared_cache:
+            blob = caches[self.shared_cache].get(self.shared_key(name))
+            if blob is not None:
+                blob = CachedBlob(*blob)
+                self._set_local(name, blob)
+                with self._lock:
+                    self.shared_hits += 1
+                return blob
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, name, content, modified_time):
+        """
+        Cache the content (bytes) of the content file with the given name, if it is small enough.
+        """
+        if not self.accepts(len(content)):
+            return
+        blob = CachedBlob(bytes(content), modified_time)
+        self._set_local(name, blob)
+        if self.shared_cache:
+            caches[self.shared_cache].set(self.shared_key(name), tuple(blob))
+
+    def _set_local(self, name, blob):
+        with self._lock:
+            old_blob = self._entries.pop(name, None)
+            if old_blob is not None:
+                self._size -= len(old_blob.content)
+            self._entries[name] = blob
+            self._size += len(blob.content)
+            while self._size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.content)
+
+    def delete_many(self, names):
+        with self._lock:
+            for name in names:
+                blob = self._entries.pop(name, None)
+                if blob is not None:
+                    self._size -= len(blob.content)
+        if self.shared_cache:
+            caches[self.shared_cache].delete_many([self.shared_key(name) for name in names])
+
+    def delete(self, name):
+        self.delete_many([name])
+
+    def clear(self):
+        """
+        Remove all entries of this process (but not of the shared cache) and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.shared_hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_size': self.max_size,
+                'max_entry_size': self.max_entry_size,
+                'shared_cache': self.shared_cache,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+            }
+
+
+blob_cache = BlobCache.from_settings()
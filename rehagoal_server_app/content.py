@@ -0,0 +1,287 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.core.files import File
+
+
+#: Top-level keys of JSON workflow contents, which are extracted as metadata
+NAME_KEY = 'name'
+TASKS_KEY = 'tasks'
+NAME_MAX_LENGTH = 255
+#: Maximum number of (raw, possibly escaped) bytes captured of a string, an escaped character takes up to 6 bytes
+MAX_CAPTURE_LENGTH = 6 * NAME_MAX_LENGTH
+#: Maximum nesting depth of JSON arrays/objects, before giving up on parsing
+MAX_DEPTH = 512
+#: Size of the slices of memory-mapped contents fed to the ContentInspector
+MAPPED_CHUNK_SIZE = 1024 * 1024
+
+STRUCTURAL_TOKEN = re.compile(rb'[{}\[\],:"]')
+# Within nested values, only the nesting and strings need to be tracked
+NESTED_TOKEN = re.compile(rb'[{}\[\]"]')
+STRING_TOKEN = re.compile(rb'["\\]')
+
+ContentInfo = namedtuple('ContentInfo', ['sha256', 'size', 'name', 'task_count'])
+
+
+class WorkflowMetadataParser(object):
+    """
+    Incremental parser, which extracts the metadata (name and number of tasks) of JSON workflow contents,
+    while they are fed in chunks. Memory usage is bounded, as only the nesting of arrays/objects and short strings
+    are kept, instead of the parsed document. The content is not fully validated, but parsing stops as soon as the
+    metadata is known, or the content turns out not to be a JSON object (e.g. for encrypted workflows).
+    """
+
+    def __init__(self):
+        self.name = None
+        self.task_count = None
+        self.failed = False
+        self.done = False
+        self._stack = bytearray()  # types of the enclosing arrays/objects ('[' or '{')
+        self._expect_key = False  # whether the next string in the top-level object is a key
+        self._key = None  # last key of the top-level object
+        self._in_string = False
+        self._escape = False  # whether the last byte of the previous chunk started an escape sequence
+        self._capture = None  # raw bytes of the current string, if it is a key or the name
+        self._capture_target = None
+        self._in_tasks = False
+        self._tasks_empty = True
+        self._task_separators = 0
+
+    def feed(self, data):
+        pos = 0
+        length = len(data)
+        while pos < length and not (self.done or self.failed):
+            if self._in_string:
+                pos = self._scan_string(data, pos)
+                continue
+            depth = len(self._stack)
+            if depth > 2 or (depth == 2 and not self._in_tasks):
+                match = NESTED_TOKEN.search(data, pos)
+                if match is None:
+                    break
+                self._structural_token(match.group())
+                pos = match.end()
+                continue
+            match = STRUCTURAL_TOKEN.search(data, pos)
+            end = match.start() if match else length
+            if end > pos and data[pos:end].strip():
+                # Scalar value (number, true, false or null)
+                self._value_started(None)
+            if match is None:
+                break
+            self._structural_token(match.group())
+            pos = match.end()
+
+    def close(self):
+        """
+        Signal the end of the content.
+        :return: extracted metadata (name, task_count), both are None if the content is not a (complete) JSON object
+        """
+        if self.failed or not self.done:
+            return None, None
+        return self.name, self.task_count
+
+    def _fail(self):
+        self.failed = True
+        self.name = self.task_count = None
+
+    def _value_started(self, token):
+        depth = len(self._stack)
+        if depth == 0:
+            if token != b'{':
+                self._fail()
+        elif depth == 1 and not self._expect_key:
+            if self._key == NAME_KEY and token == b'"':
+                self._capture, self._capture_target = bytearray(), 'name'
+            elif self._key == TASKS_KEY and token == b'[':
+                self._in_tasks, self._tasks_empty, self._task_separators = True, True, 0
+        elif depth == 2 and self._in_tasks:
+            self._tasks_empty = False
+
+    def _structural_token(self, token):
+        depth = len(self._stack)
+        if token in b'{[':
+            self._value_started(token)
+            if len(self._stack) >= MAX_DEPTH:
+                self._fail()
+            self._stack += token
+            self._expect_key = depth == 0
+        elif token in b'}]':
+            if not self._stack or self._stack[-1] != (ord('{') if token == b'}' else ord('[')):
+                self._fail()
+                return
+            self._stack.pop()
+            if depth == 2 and self._in_tasks:
+                self._in_tasks = False
+                self.task_count = 0 if self._tasks_empty else self._task_separators + 1
+            if not self._stack or (self.name is not None and self.task_count is not None):
+                self.done = True
+        elif token == b',':
+            if depth == 1:
+                self._expect_key = True
+            elif depth == 2 and self._in_tasks:
+                self._task_separators += 1
+        elif token == b':':
+            if depth == 1:
+                self._expect_key = False
+        else:  # token == b'"'
+            if depth == 1 and self._expect_key:
+                self._capture, self._capture_target = bytearray(), 'key'
+            else:
+                self._value_started(token)
+            self._in_string = True
+
+    def _scan_string(self, data, pos):
+        if self._escape:
+            self._escape = False
+            self._capture_bytes(data[pos:pos + 1])
+            return pos + 1
+        match = STRING_TOKEN.search(data, pos)
+        if match is None:
+            self._capture_bytes(data[pos:])
+            return len(data)
+        self._capture_bytes(data[pos:match.start()])
+        if match.group() == b'\\':
+            self._capture_bytes(b'\\')
+            self._escape = True
+            return match.end()
+        self._in_string = False
+        self._string_complete()
+        return match.end()
+
+    def _capture_bytes(self, data):
+        if self._capture is not None:
+            self._capture += data[:MAX_CAPTURE_LENGTH + 1 - len(self._capture)]
+
+    def _string_complete(self):
+        if self._capture is None:
+            return
+        value = self._decode_capture()
+        if self._capture_target == 'key':
+            self._key = value
+        elif value is not None:
+            self.name = value[:NAME_MAX_LENGTH]
+        self._capture = self._capture_target = None
+        if self.name is not None and self.task_count is not None:
+            self.done = True
+
+    def _decode_capture(self):
+        raw = bytes(self._capture)
+        truncated = len(raw) > MAX_CAPTURE_LENGTH
+        if truncated:
+            if self._capture_target == 'key':
+                return None
+            raw = raw[:MAX_CAPTURE_LENGTH]
+        # A truncated string might end within an escape sequence or a multi-byte character
+        for end in range(len(raw), max(len(raw) - 12, 0) - 1, -1):
+            try:
+                return json.loads(b'"' + raw[:end] + b'"')
+            except ValueError:
+                if not truncated:
+                    return None
+        return None
+
+
+class ContentInspector(object):
+    """
+    Computes the ContentInfo (SHA-256 digest, size and metadata) of workflow contents fed in chunks.
+    """
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.metadata_parser = WorkflowMetadataParser()
+
+    def feed(self, data):
+        """
+        :type data: bytes | memoryview
+        """
+        self.sha256.update(data)
+        self.size += len(data)
+        parser = self.metadata_parser
+        if not (parser.done or parser.failed):
+            # The parser needs bytes, but only a prefix of the content is parsed in most cases
+            parser.feed(data if isinstance(data, bytes) else bytes(data))
+
+    def info(self):
+        name, task_count = self.metadata_parser.close()
+        return ContentInfo(sha256=self.sha256.hexdigest(), size=self.size, name=name, task_count=task_count)
+
+
+def inspect_content(file):
+    """
+    Return the ContentInfo of the given file. Files received by the upload handlers (see uploadhandlers.py)
+    have already been inspected, other files are read in chunks.
+    """
+    info = getattr(file, 'content_info', None)
+    if info:
+        return info
+    if not hasattr(file, 'chunks'):
+        file = File(file)
+    inspector = ContentInspector()
+    for chunk in file.chunks():
+        inspector.feed(chunk)
+    return inspector.info()
+
+
+@contextmanager
+def open_buffer(storage, name):
+    """
+    Context manager providing read-only access to the stored content file with the given name as memoryview.
+    For storages with local files, the file is memory-mapped, so that its content is not copied into the Python heap.
+    Slices of the memoryview must not be used after the context has been left.
+    """
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        with storage.open(name) as f:
+            yield memoryview(f.read())
+        return
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:  # empty files cannot be mapped
+            yield memoryview(b'')
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as buffer:
+                yield buffer
+
+
+def inspect_stored_content(storage, name):
+    """
+    Return the ContentInfo of the stored content file with the given name, which is memory-mapped (see open_buffer).
+    """
+    inspector = ContentInspector()
+    with open_buffer(storage, name) as buffer:
+        for start in range(0, len(buffer), MAPPED_CHUNK_SIZE):
+            inspector.feed(buffer[start:start + MAPPED_CHUNK_SIZE])
+    return inspector.info()
+
+
+def link_content(storage, name, new_name):
+    """
+    Store the stored content file with the given name under new_name as well, without copying its data if possible:
+    For storages with local files, a hard link is created, which is safe, as content files are never modified,
+    and each name can be deleted on its own. Otherwise (or if the filesystem does not support hard links),
+    the file is copied.
+    :return: name of the new file, which differs from new_name if it exists already (see Storage.save)
+    """
+    try:
+        source, target = storage.path(name), storage.path(new_name)
+    except NotImplementedError:
+        pass
+    else:
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.link(source, target)
+            return new_name
+        except FileNotFoundError:
+            raise
+        except OSError:  # e.g. existing name, different filesystems, or not supported
+            pass
+    with storage.open(name, 'rb') as f:
+        return storage.save(new_name, File(f))
@@ -0,0 +1,300 @@
+"""
+Delta updates of workflow contents: instead of the whole content, clients upload a patch against the current content,
+which is identified by its SHA-256 digest (If-Match header, see WorkflowViewSet.patch_content). Two formats are
+supported:
+
+- JSON Patch (RFC 6902, `application/json-patch+json`) for (unencrypted) JSON workflows. The patch is applied to the
+  parsed content, which is therefore limited to JSON_PATCH_MAX_BASE_SIZE.
+- Binary delta (`application/vnd.rehagoal.delta+json`) for any content, e.g. encrypted workflows: a JSON array of
+  instructions, which produce the new content in order. `["copy", <offset>, <length>]` copies a range of the current
+  content, `["insert", "<base64>"]` inserts new data. The delta is applied in a streaming fashion, i.e. the current
+  content is memory-mapped (see content.open_buffer) and copied in chunks.
+
+The new content is written to a temporary file and inspected (see content.ContentInspector) at the same time,
+its size is limited to MAX_FILE_SIZE.
+"""
+import base64
+import binascii
+import copy
+import json
+import re
+import tempfile
+
+from django.core.files import File
+from django.template.defaultfilters import filesizeformat
+from rest_framework.parsers import JSONParser
+
+from .content import ContentInspector, open_buffer
+from .models import MAX_FILE_SIZE
+
+#: Maximum size (bytes) of contents, to which JSON Patches are applied, as they are parsed into memory
+JSON_PATCH_MAX_BASE_SIZE = 32 * 1024 * 1024
+#: Size of the chunks copied from the current content
+COPY_CHUNK_SIZE = 1024 * 1024
+#: Array indices of JSON Pointers (without leading zeros)
+ARRAY_INDEX = re.compile(r'0|[1-9][0-9]*')
+#: New contents are kept in memory up to this size (bytes), larger ones in temporary files
+INLINE_SIZE = 1024 * 1024
+
+
+class JSONPatchParser(JSONParser):
+    media_type = 'application/json-patch+json'
+
+
+class BinaryDeltaParser(JSONParser):
+    media_type = 'application/vnd.rehagoal.delta+json'
+
+
+class DeltaError(ValueError):
+    """
+    Raised if a patch is invalid, cannot be applied to the content, or the result is too large.
+    """
+
+
+class ContentWriter(object):
+    """
+    Writes the new content into a temporary file, while inspecting it and enforcing MAX_FILE_SIZE.
+    """
+
+    def __init__(self, max_size=MAX_FILE_SIZE):
+        self.max_size = max_size
+        self.file = tempfile.SpooledTemporaryFile(INLINE_SIZE)
+        self.inspector = ContentInspector()
+
+    def write(self, data):
+        if self.inspector.size + len(data) > self.max_size:
+            raise DeltaError('The patched content may not be larger than %s.' % filesizeformat(self.max_size))
+        self.inspector.feed(data)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def result(self):
+        """
+        :return: the new content as File, with the `content_info` attribute of inspected uploads
+        """
+        self.file.seek(0)
+        content = File(self.file, name='patched')
+        content.content_info = self.inspector.info()
+        content.size = content.content_info.size
+        return content
+
+
+def apply_binary_delta(storage, name, instructions, max_size=MAX_FILE_SIZE):
+    """
+    Apply the binary delta to the stored content file with the given name.
+    :return: new content (see ContentWriter.result)
+    """
+    if not isinstance(instructions, list):
+        raise DeltaError('A binary delta must be an array of instructions.')
+    writer = ContentWriter(max_size)
+    try:
+        with open_buffer(storage, name) as buffer:
+            _apply_instructions(writer, buffer, instructions)
+    except BaseException:
+        writer.close()
+        raise
+    return writer.result()
+
+
+def _apply_instructions(writer, buffer, instructions):
+    for number, instruction in enumerate(instructions):
+        if not isinstance(instruction, list) or not instruction:
+            raise DeltaError('Instruction %d: an instruction must be a non-empty array.' % number)
+        if instruction[0] == 'copy' and len(instruction) == 3 and all(
+                type(value) is int and value >= 0 for value in instruction[1:]):
+            start, end = instruction[1], instruction[1] + instruction[2]
+            if end > len(buffer):
+                raise DeltaError('Instruction %d: the range exceeds the content (%d bytes).' % (
+                    number, len(buffer)))
+            for chunk_start in range(start, end, COPY_CHUNK_SIZE):
+                writer.write(buffer[chunk_start:min(end, chunk_start + COPY_CHUNK_SIZE)])
+        elif instruction[0] == 'insert' and len(instruction) == 2 and isinstance(instruction[1], str):
+            try:
+                writer.write(base64.b64decode(instruction[1], validate=True))
+            except binascii.Error:
+                raise DeltaError('Instruction %d: invalid base64 data.' % number)
+        else:
+            raise DeltaError('Instruction %d: expected ["copy", <offset>, <length>] or ["insert", "<base64>"].'
+                             % number)
+
+
+def apply_json_patch_to_content(storage, name, operations, max_size=MAX_FILE_SIZE):
+    """
+    Apply the JSON Patch to the stored JSON content file with the given name.
+    :return: new content (compact JSON, see ContentWriter.result)
+    """
+    if storage.size(name) > JSON_PATCH_MAX_BASE_SIZE:
+        raise DeltaError('JSON Patches can only be applied to contents up to %s, use a binary delta instead.'
+                         % filesizeformat(JSON_PATCH_MAX_BASE_SIZE))
+    with open_buffer(storage, name) as buffer:
+        try:
+            document = json.loads(bytes(buffer))
+        except (ValueError, RecursionError):  # including UnicodeDecodeError
+            raise DeltaError('The content is not a JSON document, use a binary delta instead.')
+    document = apply_json_patch(document, operations, max_size)
+    try:
+        data = json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    except UnicodeEncodeError:  # lone surrogates, e.g. "\ud800"
+        raise DeltaError('The patched content contains invalid Unicode characters.')
+    writer = ContentWriter(max_size)
+    try:
+        writer.write(data)
+    except BaseException:
+        writer.close()
+        raise
+    return writer.result()
+
+
+def parse_pointer(pointer):
+    """
+    Parse a JSON Pointer (RFC 6901) into its reference tokens.
+    """
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith('/')):
+        raise DeltaError('Invalid JSON Pointer %r.' % (pointer,))
+    if not pointer:
+        return []
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+
+def _index(container, token, pointer, append=False):
+    if append and token == '-':
+        return len(container)
+    if not ARRAY_INDEX.fullmatch(token):
+        raise DeltaError('Invalid array index in %r.' % pointer)
+    index = int(token)
+    if index > len(container) or (index == len(container) and not append):
+        raise DeltaError('Array index out of range in %r.' % pointer)
+    return index
+
+
+def _resolve(document, tokens, pointer):
+    value = document
+    for token in tokens:
+        if isinstance(value, dict):
+            if token not in value:
+                raise DeltaError('Path %r does not exist.' % pointer)
+            value = value[token]
+        elif isinstance(value, list):
+            value = value[_index(value, token, pointer)]
+        else:
+            raise DeltaError('Path %r does not exist.' % pointer)
+    return value
+
+
+def _json_equal(a, b):
+    # Unlike ==, booleans are not numbers in JSON
+    if isinstance(a, bool) or isinstance(b, bool):
+        return type(a) is type(b) and a == b
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_json_equal(a[key], b[key]) for key in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(_json_equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return a == b
+    return type(a) is type(b) and a == b
+
+
+def _json_size(value, limit):
+    """
+    Estimate the size (bytes) of the value serialized as compact JSON, without serializing it.
+    Stops as soon as the size exceeds the limit.
+    """
+    size = 0
+    values = [value]
+    while values:
+        value = values.pop()
+        if isinstance(value, dict):
+            size += 1 + 3 * len(value) + sum(len(key) for key in value)
+            values.extend(value.values())
+        elif isinstance(value, list):
+            size += 1 + len(value)
+            values.extend(value)
+        elif isinstance(value, str):
+            size += 2 + len(value)
+        else:
+            size += len(str(value))
+        if size > limit:
+            break
+    return size
+
+
+def _add(document, tokens, value, pointer):
+    if not tokens:
+        return value
+    parent = _resolve(document, tokens[:-1], pointer)
+    if isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    elif isinstance(parent, list):
+        parent.insert(_index(parent, tokens[-1], pointer, append=True), value)
+    else:
+        raise DeltaError('Path %r does not exist.' % pointer)
+    return document
+
+
+def _remove(document, tokens, pointer):
+    if not tokens:
+        raise DeltaError('The whole document cannot be removed.')
+    parent = _resolve(document, tokens[:-1], pointer)
+    if isinstance(parent, dict):
+        if tokens[-1] not in parent:
+            raise DeltaError('Path %r does not exist.' % pointer)
+        return parent.pop(tokens[-1])
+    if isinstance(parent, list):
+        return parent.pop(_index(parent, tokens[-1], pointer))
+    raise DeltaError('Path %r does not exist.' % pointer)
+
+
+def apply_json_patch(document, operations, max_size=MAX_FILE_SIZE):
+    """
+    Apply a JSON Patch (RFC 6902) to the parsed JSON document, which is modified in place.
+    The values added by the patch (including copies) may not exceed max_size (bytes) in total, which is checked
+    before each value is added, so that repeated copies cannot exhaust the memory.
+    :return: patched document
+    """
+    remaining = max_size
+    if not isinstance(operations, list):
+        raise DeltaError('A JSON Patch must be an array of operations.')
+    for number, operation in enumerate(operations):
+        if not isinstance(operation, dict) or 'op' not in operation or 'path' not in operation:
+            raise DeltaError('Operation %d: "op" and "path" are required.' % number)
+        op, pointer = operation['op'], operation['path']
+        tokens = parse_pointer(pointer)
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise DeltaError('Operation %d: "value" is required.' % number)
+        if op in ('move', 'copy'):
+            if 'from' not in operation:
+                raise DeltaError('Operation %d: "from" is required.' % number)
+            from_tokens = parse_pointer(operation['from'])
+        if op in ('add', 'replace', 'copy'):
+            value = operation['value'] if op != 'copy' else _resolve(document, from_tokens, operation['from'])
+            remaining -= _json_size(value, remaining)
+            if remaining < 0:
+                raise DeltaError('Operation %d: the patched content may not be larger than %s.' % (
+                    number, filesizeformat(max_size)))
+        if op == 'add':
+            document = _add(document, tokens, operation['value'], pointer)
+        elif op == 'remove':
+            _remove(document, tokens, pointer)
+        elif op == 'replace':
+            _resolve(document, tokens, pointer)
+            if tokens:
+                _remove(document, tokens, pointer)
+            document = _add(document, tokens, operation['value'], pointer)
+        elif op == 'move':
+            if tokens[:len(from_tokens)] == from_tokens and tokens != from_tokens:
+                raise DeltaError('Operation %d: a value cannot be moved into one of its children.' % number)
+            value = _resolve(document, from_tokens, operation['from'])
+            if from_tokens:
+                _remove(document, from_tokens, operation['from'])
+            document = _add(document, tokens, value, pointer)
+        elif op == 'copy':
+            value = copy.deepcopy(_resolve(document, from_tokens, operation['from']))
+            document = _add(document, tokens, value, pointer)
+        elif op == 'test':
+            if not _json_equal(_resolve(document, tokens, pointer), operation['value']):
+                raise DeltaError('Operation %d: test of %r failed.' % (number, pointer))
+        else:
+            raise DeltaError('Operation %d: unknown operation %r.' % (number, op))
+    return document
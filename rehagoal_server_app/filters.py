@@ -0,0 +1,48 @@
+from django.db.models import CharField, Lookup
+from django.db.models.lookups import GreaterThanOrEqual, LessThan, StartsWith
+from rest_framework.filters import SearchFilter
+
+
+@CharField.register_lookup
+class Prefix(Lookup):
+    """
+    Case-sensitive prefix lookup (`field__prefix`), which can be answered by an index on the field: unlike
+    `startswith` (LIKE, which SQLite evaluates case-insensitively and PostgreSQL only indexes with text_pattern_ops),
+    it is a range `field >= prefix AND field < successor` (the prefix with its last character incremented).
+    The exact `startswith` condition is kept for the rows in that range, as the range depends on the collation.
+    """
+    lookup_name = 'prefix'
+
+    @staticmethod
+    def successor(prefix):
+        """
+        :return: the smallest string greater than every string starting with the prefix, None if there is none
+        """
+        prefix = prefix.rstrip(chr(0x10ffff))
+        if not prefix:
+            return None
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def as_sql(self, compiler, connection):
+        conditions = [GreaterThanOrEqual(self.lhs, self.rhs), StartsWith(self.lhs, self.rhs)]
+        successor = self.successor(self.rhs)
+        if successor is not None:
+            conditions.insert(1, LessThan(self.lhs, successor))
+        sqls, params = [], []
+        for condition in conditions:
+            sql, condition_params = compiler.compile(condition)
+            sqls.append(sql)
+            params.extend(condition_params)
+        return '(%s)' % ' AND '.join(sqls), params
+
+
+class PrefixSearchFilter(SearchFilter):
+    """
+    SearchFilter, which matches '^' fields by (case-sensitive) prefix, so that the search can be answered by an
+    index on the field (see Prefix). The whole search parameter is a single prefix, as names contain spaces and commas.
+    """
+    lookup_prefixes = dict(SearchFilter.lookup_prefixes, **{'^': 'prefix'})
+
+    def get_search_terms(self, request):
+        term = request.query_params.get(self.search_param, '').replace('\x00', '').strip()
+        return [term] if term else []
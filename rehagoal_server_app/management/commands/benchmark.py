@@ -0,0 +1,235 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.handlers.base import BaseHandler
+from django.core.management.base import BaseCommand
+from django.http import FileResponse
+from django.test import RequestFactory, override_settings
+
+from rehagoal_server.handlers import APIHandler
+from rehagoal_server_app.content import inspect_stored_content
+from rehagoal_server_app.models import Workflow, pkgen
+from rehagoal_server_app.serializers import WorkflowListSerializer, WorkflowSerializer
+
+# Loads the application and the URLconf, like a worker process before handling its first request.
+# The settings and the URLconf are imported explicitly, as -X importtime does not report importlib.import_module().
+STARTUP_CODE = (
+    "import django; import {settings}; django.setup(); import {urlconf}; "
+    "from django.urls import get_resolver; get_resolver().url_patterns"
+)
+# Output of python -X importtime: "import time: <self µs> | <cumulative µs> | <indented module name>"
+IMPORT_TIME_LINE = re.compile(r'^import time:\s*(?P<self>\d+) \|\s*(?P<cumulative>\d+) \| (?P<module>.*)$')
+
+
+class Command(BaseCommand):
+    help = "Runs micro-benchmarks of performance-critical code paths and prints the timings."
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=sorted(self.benchmarks()), help="Benchmark to run")
+        parser.add_argument('--iterations', type=int,
+                            help="Number of iterations per measurement (default depends on the benchmark)")
+        parser.add_argument('--size', type=int, default=100,
+                            help="Size of the workflow content in MiB for the download benchmark (default: 100)")
+
+    def benchmarks(self):
+        return {
+            'download': self.benchmark_download,
+            'middleware': self.benchmark_middleware,
+            'serializer': self.benchmark_serializer,
+            'startup': self.benchmark_startup,
+        }
+
+    def handle(self, *args, **options):
+        # Do not log the (expected) client errors of benchmarked requests
+        logging.disable(logging.WARNING)
+        try:
+            kwargs = {'iterations': options['iterations']} if options['iterations'] else {}
+            if options['benchmark'] == 'download':
+                kwargs['size'] = options['size']
+            self.benchmarks()[options['benchmark']](**kwargs)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def report(self, label, seconds, iterations):
+        self.stdout.write("%-40s %10.1f µs/iteration" % (label, seconds / iterations * 1e6))
+
+    @staticmethod
+    def measure(func, iterations):
+        func()  # warm up
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        return time.perf_counter() - start
+
+    @override_settings(ALLOWED_HOSTS=['testserver'])
+    def benchmark_middleware(self, iterations=2000):
+        """
+        Per-request overhead of the full middleware stack and the reduced API stack, for a token-authenticated
+        request. The token is invalid, so that neither the database nor the view dominate the measurement.
+        """
+        factory = RequestFactory()
+        full_handler = BaseHandler()
+        full_handler.load_middleware()
+        api_handler = APIHandler()
+        for label, handler in (("full middleware stack", full_handler), ("API middleware stack", api_handler)):
+            def request():
+                handler.get_response(factory.get('/api/v2/workflows/', HTTP_AUTHORIZATION='Bearer invalid'))
+            self.report(label, self.measure(request, iterations), iterations)
+
+    @override_settings(ALLOWED_HOSTS=['testserver'])
+    def benchmark_serializer(self, iterations=20):
+        """
+        Representation of workflow list pages with WorkflowSerializer and with WorkflowListSerializer.
+        The workflows are not stored, so that the database queries are not part of the measurement.
+        """
+        request = RequestFactory().get('/api/v2/workflows/')
+        for rows in (10, 100, 1000):
+            workflows = [
+                Workflow(id=pkgen(), owner_id=pkgen(), content=pkgen(), sha256=hashlib.sha256(b'%d' % i).hexdigest(),
+                         name='Workflow %d' % i, task_count=i % 10, size=1024 + i)
+                for i in range(rows)
+            ]
+            values = [{field: getattr(workflow, field) for field in WorkflowListSerializer.values}
+                      for workflow in workflows]
+            for row in values:
+                row['content'] = row['content'].name
+            serializer_seconds = self.measure(
+                lambda: WorkflowSerializer(workflows, many=True, context={'request': request}).data, iterations)
+            fast_seconds = self.measure(lambda: WorkflowListSerializer(request).to_representation(values), iterations)
+            self.report("WorkflowSerializer, %d rows" % rows, serializer_seconds, iterations)
+            self.report("WorkflowListSerializer, %d rows" % rows, fast_seconds, iterations)
+            self.stdout.write("%-40s %10.1fx" % ("speedup", serializer_seconds / fast_seconds))
+
+    def benchmark_startup(self, iterations=5):
+        """
+        Cold start of a worker process (settings, installed apps and URLconf), measured in fresh interpreters.
+        The import times of the last run (python -X importtime, which adds some overhead) are summarized by package.
+        """
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        code = STARTUP_CODE.format(settings=settings.SETTINGS_MODULE, urlconf=settings.ROOT_URLCONF)
+        command = [sys.executable, '-X', 'importtime', '-c', code]
+        durations = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            result = subprocess.run(command, cwd=settings.BASE_DIR, env=env, check=True, universal_newlines=True,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            durations.append(time.perf_counter() - start)
+        self.stdout.write("%-40s %10.1f ms" % ("cold start (min)", min(durations) * 1e3))
+        self.stdout.write("%-40s %10.1f ms" % ("cold start (median)", statistics.median(durations) * 1e3))
+
+        package_times = Counter()
+        for line in result.stderr.splitlines():
+            match = IMPORT_TIME_LINE.match(line)
+            if not match:
+                continue
+            module = match.group('module').strip()
+            package_times[module.split('.')[0]] += int(match.group('self'))
+            if module in (settings.SETTINGS_MODULE, settings.ROOT_URLCONF):
+                self.stdout.write("%-40s %10.1f ms" % ("import %s" % module, int(match.group('cumulative')) / 1e3))
+        self.stdout.write("Import time by package:")
+        for package, microseconds in package_times.most_common(15):
+            self.stdout.write("  %-38s %10.1f ms" % (package, microseconds / 1e3))
+
+    @staticmethod
+    def measure_peak_memory(func):
+        """
+        Run func in a forked child process, so that its peak memory usage can be measured in isolation.
+        :return: (peak RSS increase in bytes, peak traced Python heap in bytes, seconds)
+        """
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                # ru_maxrss is in KiB on Linux
+                rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+                tracemalloc.start()
+                start = time.perf_counter()
+                func()
+                seconds = time.perf_counter() - start
+                heap_peak = tracemalloc.get_traced_memory()[1]
+                rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+                os.write(write_fd, json.dumps([rss_peak - rss_before, heap_peak, seconds]).encode())
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as result:
+            data = result.read()
+        os.waitpid(pid, 0)
+        return json.loads(data.decode())
+
+    def benchmark_download(self, iterations=1, size=100):
+        """
+        Peak memory usage of reading/hashing and downloading a large workflow content, with the different strategies.
+        Mapped pages of memory-mapped files count towards the RSS, but are shared and can be reclaimed by the kernel,
+        unlike the Python heap.
+        """
+        def read_whole():
+            with open(path, 'rb') as f:
+                hashlib.sha256(f.read())
+
+        def read_chunks():
+            sha256 = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in File(f).chunks():
+                    sha256.update(chunk)
+
+        def read_mapped():
+            inspect_stored_content(storage, name)
+
+        def transmit(send):
+            # Transmit the response of a FileResponse over a local socket, like a WSGI server
+            sender, receiver = socket.socketpair()
+            drain = threading.Thread(target=lambda: all(iter(lambda: receiver.recv(1024 * 1024), b'')))
+            drain.start()
+            response = FileResponse(open(path, 'rb'))
+            try:
+                send(sender, response)
+            finally:
+                response.close()
+                sender.close()
+                drain.join()
+                receiver.close()
+
+        def download_iterated():
+            transmit(lambda sender, response: [sender.sendall(chunk) for chunk in response])
+
+        def download_sendfile():
+            transmit(lambda sender, response: sender.sendfile(response.file_to_stream))
+
+        strategies = (
+            ("read() and hash", read_whole),
+            ("chunked read and hash", read_chunks),
+            ("memory-mapped inspection", read_mapped),
+            ("download, iterated", download_iterated),
+            ("download, sendfile", download_sendfile),
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            storage = FileSystemStorage(location=directory)
+            name = 'benchmark'
+            path = storage.path(name)
+            with open(path, 'wb') as f:
+                for _ in range(size):
+                    f.write(os.urandom(1024 * 1024))
+            self.stdout.write("Workflow content of %d MiB, peak memory usage:" % size)
+            for label, func in strategies:
+                for _ in range(iterations):
+                    rss, heap, seconds = self.measure_peak_memory(func)
+                    self.stdout.write("%-40s RSS +%7.1f MiB, Python heap %7.1f MiB, %8.1f ms" % (
+                        label, rss / 2 ** 20, heap / 2 ** 20, seconds * 1e3))
@@ -0,0 +1,232 @@
+import collections
+import datetime
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F, FilteredRelation, Q
+from django.template.defaultfilters import filesizeformat
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from rehagoal_server_app import archive
+from rehagoal_server_app.models import RehagoalUser, Workflow
+
+#: Contents up to this size (bytes) are read completely by the reader threads, larger ones are streamed
+INLINE_SIZE = 1024 * 1024
+#: Rows are spooled in memory up to this size (bytes), before they are moved to a temporary file
+SPOOL_SIZE = 4 * 1024 * 1024
+#: Incremental exports include workflows modified up to this time before the previous snapshot, so that
+#: transactions which were still running when the previous snapshot was created are not missed
+SINCE_MARGIN = datetime.timedelta(minutes=1)
+ITERATOR_CHUNK_SIZE = 2000
+#: Directory of the storage, which holds the links to the contents of running exports (see SnapshotLinks)
+LINKS_DIR = 'exports'
+
+
+class SnapshotLinks(object):
+    """
+    Hard links to the content files of the exported workflows, which are created while their rows are read,
+    so that contents replaced or deleted during the export are exported nevertheless (content files are never
+    modified). The links are kept in a temporary directory of the storage, i.e. on the same filesystem.
+    Contents of storages without local files are read directly.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        try:
+            parent = storage.path(LINKS_DIR)
+        except NotImplementedError:
+            self.directory = None
+        else:
+            os.makedirs(parent, exist_ok=True)
+            self.directory = tempfile.mkdtemp(dir=parent)
+
+    def add(self, name):
+        if self.directory is None:
+            return
+        try:
+            os.link(self.storage.path(name), os.path.join(self.directory, name))
+        except (FileNotFoundError, FileExistsError):  # missing files are counted by add_contents
+            pass
+
+    def open(self, name):
+        if self.directory is None:
+            return self.storage.open(name, 'rb')
+        return File(open(os.path.join(self.directory, name), 'rb'))
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Command(BaseCommand):
+    help = (
+        "Exports users and their workflows into a tar archive (see rehagoal_server_app/archive.py), "
+        "with bounded memory usage. The rows are read with a single query, i.e. they are a consistent snapshot."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Path of the archive, '-' for the standard output")
+        parser.add_argument('--compression', choices=archive.COMPRESSIONS, help="Compression of the archive")
+        parser.add_argument('--owner', action='append', default=[],
+                            help="Only export the user with the given ID or username and their workflows (repeatable)")
+        parser.add_argument('--since',
+                            help="Only export workflows modified since the given archive (path) was created, "
+                                 "or since the given time (ISO 8601)")
+        parser.add_argument('--threads', type=int, default=4,
+                            help="Number of threads reading workflow contents (default: 4)")
+        parser.add_argument('--read-ahead', type=int, default=16,
+                            help="Maximum number of workflow contents read ahead of the archive (default: 16)")
+
+    def handle(self, *args, **options):
+        since = self.parse_since(options['since'])
+        to_stdout = options['output'] == '-'
+        # Status messages must not be mixed into an archive written to the standard output
+        log = self.stderr if to_stdout else self.stdout
+        start = time.perf_counter()
+        fileobj = sys.stdout.buffer if to_stdout else open(options['output'], 'wb')
+        try:
+            mode = 'w|' + (options['compression'] or '')
+            with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+                stats = self.export(tar, options['owner'], since, options['threads'], options['read_ahead'])
+        finally:
+            if not to_stdout:
+                fileobj.close()
+        seconds = time.perf_counter() - start
+        log.write("Exported %d user(s) and %d workflow(s) with %d content(s) (%s) in %.1f s, %.1f MiB/s." % (
+            stats['users'], stats['workflows'], stats['contents'], filesizeformat(stats['bytes']), seconds,
+            stats['bytes'] / 2 ** 20 / max(seconds, 1e-6)))
+        if stats['missing']:
+            raise CommandError("%d content file(s) are missing, the archive is incomplete." % stats['missing'])
+
+    @staticmethod
+    def parse_since(value):
+        if not value:
+            return None
+        if os.path.exists(value):
+            try:
+                value = archive.read_snapshot(value)['created']
+            except archive.ArchiveError as e:
+                raise CommandError(str(e))
+        since = parse_datetime(value)
+        if since is None:
+            raise CommandError("Invalid --since value %r, expected an archive or an ISO 8601 time" % value)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        return since
+
+    def export(self, tar, owners, since, threads, read_ahead):
+        users = RehagoalUser.objects.all()
+        if owners:
+            users = users.filter(Q(id__in=owners) | Q(user__username__in=owners))
+        # Joined with the exported workflows, so that users without (changed) workflows are exported as well
+        condition = Q() if since is None else Q(workflow__modified__gte=since - SINCE_MARGIN)
+        users = users.annotate(exported=FilteredRelation('workflow', condition=condition))
+        users = users.order_by('id', 'exported__id')
+        created = timezone.now()
+        add_bytes(tar, archive.SNAPSHOT_MEMBER, json.dumps({
+            'version': archive.FORMAT_VERSION,
+            'created': created.isoformat(),
+            'since': since.isoformat() if since is not None else None,
+            'owners': owners or None,
+        }).encode())
+
+        stats = collections.Counter()
+        links = SnapshotLinks(Workflow._meta.get_field('content').storage)
+        rows = users.values('id', 'storage_quota', username=F('user__username'),
+                            **{'workflow_' + field: F('exported__' + field) for field in archive.WORKFLOW_FIELDS})
+        try:
+            self.export_rows(tar, rows, links, threads, read_ahead, stats)
+        finally:
+            links.close()
+        return stats
+
+    def export_rows(self, tar, rows, links, threads, read_ahead, stats):
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as users, \
+                tempfile.SpooledTemporaryFile(SPOOL_SIZE) as workflow_rows:
+            # A single query, so that the rows are consistent: a row per exported workflow joined with its owner,
+            # or a row without workflow for users without exported workflows (ordered by user)
+            user_id = None
+            for row in rows.iterator(chunk_size=ITERATOR_CHUNK_SIZE):
+                if row['id'] != user_id:
+                    user_id = row['id']
+                    users.write(archive.dump_line({field: row[field] for field in archive.USER_FIELDS}))
+                    stats['users'] += 1
+                if row['workflow_id'] is None:
+                    continue
+                workflow_rows.write(archive.dump_line({
+                    field: row['workflow_' + field] for field in archive.WORKFLOW_FIELDS}))
+                if row['workflow_content']:
+                    links.add(row['workflow_content'])
+                stats['workflows'] += 1
+            add_file(tar, archive.USERS_MEMBER, users)
+            add_file(tar, archive.WORKFLOWS_MEMBER, workflow_rows)
+            workflow_rows.seek(0)
+            names = (json.loads(line)['content'] for line in workflow_rows)
+            self.add_contents(tar, filter(None, names), links, threads, read_ahead, stats)
+
+    def add_contents(self, tar, names, links, threads, read_ahead, stats):
+        """
+        Add the given content files (see SnapshotLinks) to the archive. Up to read_ahead files are opened (and read,
+        if they are small) by the thread pool ahead of the archive, which limits the memory usage to
+        read_ahead * INLINE_SIZE.
+        """
+
+        def read(name):
+            try:
+                f = links.open(name)
+            except FileNotFoundError:
+                return name, None, None
+            size = f.size
+            if size <= INLINE_SIZE:
+                with f:
+                    return name, size, io.BytesIO(f.read())
+            return name, size, f
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = collections.deque()
+            for name in names:
+                pending.append(executor.submit(read, name))
+                if len(pending) >= read_ahead:
+                    self.add_content(tar, pending.popleft().result(), stats)
+            while pending:
+                self.add_content(tar, pending.popleft().result(), stats)
+
+    @staticmethod
+    def add_content(tar, result, stats):
+        name, size, f = result
+        if f is None:
+            stats['missing'] += 1
+            return
+        with f:
+            info = tarfile.TarInfo(archive.content_member(name))
+            info.size = size
+            info.mtime = time.time()
+            tar.addfile(info, f)
+        stats['contents'] += 1
+        stats['bytes'] += size
+
+
+def add_bytes(tar, name, data):
+    add_file(tar, name, io.BytesIO(data))
+
+
+def add_file(tar, name, f):
+    """
+    Add the content of the given (binary) file object to the archive, from its start.
+    """
+    f.seek(0, io.SEEK_END)
+    info = tarfile.TarInfo(name)
+    info.size = f.tell()
+    info.mtime = time.time()
+    f.seek(0)
+    tar.addfile(info, f)
@@ -0,0 +1,29 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rest_framework.utils import encoders
+
+from rehagoal_server_app.schema import generate_schema
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates the OpenAPI schema of the API and stores it as JSON file, which is served at /api/v2/schema/ "
+        "(default: settings.API_SCHEMA_FILE). Run this after every deployment."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=settings.API_SCHEMA_FILE,
+                            help="Path of the schema file (default: %s)" % settings.API_SCHEMA_FILE)
+
+    def handle(self, *args, **options):
+        output = options['output']
+        content = json.dumps(generate_schema(), cls=encoders.JSONEncoder, indent=2)
+        # Replace the file atomically, as it might be read by running workers
+        temp_output = '%s.%d.tmp' % (output, os.getpid())
+        with open(temp_output, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_output, output)
+        self.stdout.write("Schema written to %s." % output)
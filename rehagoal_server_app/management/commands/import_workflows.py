@@ -0,0 +1,282 @@
+import collections
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.template.defaultfilters import filesizeformat
+from django.utils import timezone
+
+from rehagoal_server_app import archive
+from rehagoal_server_app.models import (
+    ID_LENGTH, RehagoalUser, Workflow, add_storage_used, content_replaced, delete_content_files,
+    notify_changed_on_commit, pkgen,
+)
+
+#: Contents up to this size (bytes) are kept in memory until they are stored, larger ones in temporary files
+INLINE_SIZE = 1024 * 1024
+#: Rows are spooled in memory up to this size (bytes), before they are moved to a temporary file
+SPOOL_SIZE = 4 * 1024 * 1024
+#: Number of workflows per bulk_create() and transaction
+BATCH_SIZE = 500
+#: Names of content files, as generated for uploads and served by the download view
+CONTENT_NAME = re.compile(r'[A-Za-z0-9]{%d}' % ID_LENGTH)
+
+
+class ImportState(object):
+    """
+    Contents stored by an import, which are appended to a file (one JSON object per line:
+    {"content": <name in the archive>, "stored": <stored name>, "sha256": <digest>}), so that an interrupted import
+    can be resumed without storing them again. Workflows referencing a stored content have already been imported.
+    """
+
+    def __init__(self, path):
+        self.contents = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # incomplete last line of an interrupted import
+                        continue
+                    self.contents[entry['content']] = (entry['stored'], entry['sha256'])
+        self.file = open(path, 'a') if path else None
+
+    def record(self, name, stored_name, sha256):
+        self.contents[name] = (stored_name, sha256)
+        if self.file is not None:
+            self.file.write(json.dumps({'content': name, 'stored': stored_name, 'sha256': sha256}) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports workflows and their owners from an archive of the export_workflows command. Contents are stored "
+        "concurrently, workflows are inserted in batches. Workflow IDs and content file names are preserved, "
+        "unless they are already in use. Existing workflows with the same ID and owner are updated, so that "
+        "incremental archives can be restored after a full one. Interrupted imports can be resumed by running the "
+        "command again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="Path of the archive, '-' for the standard input")
+        parser.add_argument('--state',
+                            help="File recording the progress, for resuming interrupted imports "
+                                 "(default: <input>.import-state, none for the standard input)")
+        parser.add_argument('--new-ids', action='store_true',
+                            help="Assign new IDs to all workflows, instead of preserving them")
+        parser.add_argument('--threads', type=int, default=4,
+                            help="Number of threads storing workflow contents (default: 4)")
+        parser.add_argument('--max-pending', type=int, default=16,
+                            help="Maximum number of workflow contents waiting to be stored (default: 16)")
+
+    def handle(self, *args, **options):
+        from_stdin = options['input'] == '-'
+        state_path = options['state'] or (None if from_stdin else options['input'] + '.import-state')
+        self.storage = Workflow._meta.get_field('content').storage
+        self.stats = collections.Counter()
+        start = time.perf_counter()
+        self.state = ImportState(state_path)
+        try:
+            fileobj = sys.stdin.buffer if from_stdin else open(options['input'], 'rb')
+            try:
+                with tarfile.open(fileobj=fileobj, mode='r|*') as tar, \
+                        tempfile.SpooledTemporaryFile(SPOOL_SIZE) as users, \
+                        tempfile.SpooledTemporaryFile(SPOOL_SIZE) as workflows:
+                    self.read_archive(tar, users, workflows, options['threads'], options['max_pending'])
+                    users.seek(0)
+                    owners = self.import_users(users)
+                    workflows.seek(0)
+                    self.import_workflows(workflows, owners, options['new_ids'])
+            except (tarfile.TarError, archive.ArchiveError) as e:
+                raise CommandError("Invalid archive: %s" % e)
+            finally:
+                if not from_stdin:
+                    fileobj.close()
+        finally:
+            self.state.close()
+        seconds = max(time.perf_counter() - start, 1e-6)
+        stats = self.stats
+        self.stdout.write(
+            "Imported %d workflow(s) (%d with new ID, %d updated, %d skipped) and stored %d content(s) (%s) "
+            "in %.1f s: %.1f workflows/s, %.1f MiB/s. Created %d user(s)." % (
+                stats['workflows'], stats['new_ids'], stats['updated'], stats['skipped'], stats['contents'],
+                filesizeformat(stats['bytes']), seconds, stats['workflows'] / seconds,
+                stats['bytes'] / 2 ** 20 / seconds, stats['users']))
+        if stats['invalid']:
+            raise CommandError("%d workflow(s) were not imported, as their content is missing or corrupted."
+                               % stats['invalid'])
+
+    def read_archive(self, tar, users, workflows, threads, max_pending):
+        member = tar.next()
+        if member is None or member.name != archive.SNAPSHOT_MEMBER:
+            raise archive.ArchiveError("The archive does not start with %s" % archive.SNAPSHOT_MEMBER)
+        snapshot = json.load(tar.extractfile(member))
+        if snapshot.get('version') != archive.FORMAT_VERSION:
+            raise archive.ArchiveError("Unsupported archive format version %r" % snapshot.get('version'))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = collections.deque()
+            for member in tar:
+                if member.name == archive.USERS_MEMBER:
+                    shutil.copyfileobj(tar.extractfile(member), users)
+                elif member.name == archive.WORKFLOWS_MEMBER:
+                    shutil.copyfileobj(tar.extractfile(member), workflows)
+                elif member.name.startswith(archive.CONTENTS_PREFIX):
+                    if not member.isfile():  # e.g. directories or links of a modified archive
+                        continue
+                    name = member.name[len(archive.CONTENTS_PREFIX):]
+                    if name in self.state.contents:  # stored by an interrupted import
+                        continue
+                    pending.append(executor.submit(self.store_content, name, self.read_member(tar, member)))
+                    if len(pending) >= max_pending:
+                        self.content_stored(*pending.popleft().result())
+            while pending:
+                self.content_stored(*pending.popleft().result())
+
+    @staticmethod
+    def read_member(tar, member):
+        """
+        Read the content of the given member (which has to be done in the order of the archive), into memory or into
+        a temporary file, if it is large.
+        """
+        f = tar.extractfile(member)
+        if member.size <= INLINE_SIZE:
+            return ContentFile(f.read())
+        temporary = tempfile.TemporaryFile()
+        shutil.copyfileobj(f, temporary)
+        temporary.seek(0)
+        return File(temporary)
+
+    def store_content(self, name, content):
+        """
+        Store the content under its name in the archive, or under a new name if it is already in use or not a valid
+        content name (e.g. a path into another directory of a modified archive). Runs in a thread of the pool.
+        :return: (archive name, stored name, SHA-256 digest, size)
+        """
+        with content:
+            sha256 = hashlib.sha256()
+            for chunk in content.chunks():
+                sha256.update(chunk)
+            content.seek(0)
+            stored_name = name if CONTENT_NAME.fullmatch(name) else pkgen()
+            while True:
+                if not self.storage.exists(stored_name):
+                    saved_name = self.storage.save(stored_name, content)
+                    if saved_name == stored_name:
+                        return name, stored_name, sha256.hexdigest(), content.size
+                    # Created meanwhile, so the storage chose another name, which the download view does not serve
+                    self.storage.delete(saved_name)
+                    content.seek(0)
+                stored_name = pkgen()
+
+    def content_stored(self, name, stored_name, sha256, size):
+        self.state.record(name, stored_name, sha256)
+        self.stats['contents'] += 1
+        self.stats['bytes'] += size
+
+    def import_users(self, lines):
+        """
+        Map the users of the archive to existing users with the same username, or create them (without password).
+        :return: dict of RehagoalUser IDs in the archive -> RehagoalUser IDs
+        """
+        owners = {}
+        for line in lines:
+            row = json.loads(line)
+            rehagoal_user = RehagoalUser.objects.filter(user__username=row['username']).first()
+            if rehagoal_user is None:
+                user = User(username=row['username'])
+                user.set_unusable_password()
+                user.save()
+                rehagoal_user = user.rehagoal_user
+                if row.get('storage_quota') is not None:
+                    RehagoalUser.objects.filter(pk=rehagoal_user.pk).update(storage_quota=row['storage_quota'])
+                self.stats['users'] += 1
+            owners[row['id']] = rehagoal_user.id
+        return owners
+
+    def import_workflows(self, lines, owners, new_ids):
+        batch = []
+        for line in lines:
+            batch.append(json.loads(line))
+            if len(batch) >= BATCH_SIZE:
+                self.import_batch(batch, owners, new_ids)
+                batch = []
+        if batch:
+            self.import_batch(batch, owners, new_ids)
+
+    def import_batch(self, rows, owners, new_ids):
+        stored = {row['content']: self.state.contents.get(row['content']) for row in rows}
+        # Workflows referencing contents stored by this import have been imported before it was interrupted
+        imported = set(Workflow.objects.filter(
+            content__in=[content[0] for content in stored.values() if content]).values_list('content', flat=True))
+        existing = {} if new_ids else {
+            workflow.id: workflow for workflow in Workflow.objects.filter(id__in=[row['id'] for row in rows]).only(
+                'content', 'sha256', 'size', 'name', 'task_count', 'owner', 'modified')}
+        workflows = []
+        updated = []
+        unused = []
+        for row in rows:
+            content = stored[row['content']]
+            if content is None or (row['sha256'] and content[1] != row['sha256']) or row['owner_id'] not in owners:
+                self.stderr.write("Workflow %s: content %s is missing or corrupted, or its owner is missing"
+                                  % (row['id'], row['content']))
+                self.stats['invalid'] += 1
+                continue
+            if content[0] in imported:
+                self.stats['skipped'] += 1
+                continue
+            workflow = Workflow(
+                id=row['id'], owner_id=owners[row['owner_id']], content=content[0], sha256=content[1],
+                name=row['name'], task_count=row['task_count'], size=row['size'],
+            )
+            old_instance = existing.get(workflow.id)
+            if old_instance is not None and old_instance.owner_id == workflow.owner_id:
+                # The same workflow, e.g. of an incremental archive restored after a full one
+                if old_instance.sha256 == workflow.sha256:
+                    unused.append(workflow.content.name)
+                    self.stats['skipped'] += 1
+                else:
+                    updated.append((workflow, old_instance))
+                continue
+            if new_ids or old_instance is not None:
+                workflow.id = pkgen()
+                self.stats['new_ids'] += 1
+            workflows.append(workflow)
+        # bulk_create() and update() do not send signals, the storage used and the notifications are handled here
+        sizes = collections.Counter()
+        for workflow in workflows:
+            sizes[workflow.owner_id] += workflow.size or 0
+        for workflow, old_instance in updated:
+            sizes[workflow.owner_id] += (workflow.size or 0) - (old_instance.size or 0)
+        with transaction.atomic():
+            Workflow.objects.bulk_create(workflows)
+            for workflow, old_instance in updated:
+                Workflow.objects.filter(pk=workflow.pk).update(
+                    content=workflow.content.name, sha256=workflow.sha256, content_verified=None, name=workflow.name,
+                    task_count=workflow.task_count, size=workflow.size, modified=timezone.now())
+                # e.g. recording the replaced content as revision (see revisions.py), while it still exists
+                content_replaced.send(sender=Workflow, instance=workflow, old_instance=old_instance,
+                                     using=Workflow.objects.db)
+                unused.append(old_instance.content.name)
+            for owner_id, size in sizes.items():
+                add_storage_used(owner_id, size, enforce_quota=False)
+                notify_changed_on_commit(owner_id)
+            transaction.on_commit(lambda: delete_content_files(unused, self.storage))
+        self.stats['workflows'] += len(workflows) + len(updated)
+        self.stats['updated'] += len(updated)
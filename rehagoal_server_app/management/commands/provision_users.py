@@ -0,0 +1,95 @@
+import csv
+import sys
+import time
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.crypto import get_random_string
+
+from rehagoal_server_app.provisioning import BATCH_SIZE, bulk_create_users, hash_passwords
+
+FIELDS = ('username', 'password', 'first_name', 'last_name', 'email')
+GENERATED_PASSWORD_LENGTH = 12
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates regular users from a CSV file with the columns username, password and optionally first_name, "
+        "last_name and email (with header row). Empty passwords are generated and written to the --output file. "
+        "Passwords are hashed in parallel, existing usernames are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="CSV file with the users to create, '-' for the standard input")
+        parser.add_argument('--output', help="CSV file, to which the usernames and generated passwords are written")
+        parser.add_argument('--processes', type=int,
+                            help="Number of processes hashing passwords (default: number of CPUs)")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help="Number of users inserted per query (default: %d)" % BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        rows = self.read_rows(options['input'])
+        generated = [row for row in rows if not row['password']]
+        if generated and not options['output']:
+            raise CommandError("%d user(s) have no password, use --output to generate passwords" % len(generated))
+        for row in generated:
+            row['password'] = get_random_string(GENERATED_PASSWORD_LENGTH)
+
+        existing = set()
+        usernames = [row['username'] for row in rows]
+        for start in range(0, len(usernames), options['batch_size']):
+            existing.update(User.objects.filter(username__in=usernames[start:start + options['batch_size']])
+                            .values_list('username', flat=True))
+        for username in sorted(existing):
+            self.stderr.write("User %s already exists, skipped" % username)
+        rows = [row for row in rows if row['username'] not in existing]
+
+        start = time.perf_counter()
+        passwords = hash_passwords((row['password'] for row in rows), processes=options['processes'])
+        hashed = time.perf_counter()
+        users = [
+            User(username=row['username'], password=password, first_name=row['first_name'] or '',
+                 last_name=row['last_name'] or '', email=row['email'] or '')
+            for row, password in zip(rows, passwords)
+        ]
+        created = bulk_create_users(users, batch_size=options['batch_size'])
+        seconds = max(time.perf_counter() - start, 1e-6)
+
+        if options['output'] and generated:
+            with open(options['output'], 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(('username', 'password'))
+                writer.writerows((row['username'], row['password']) for row in generated
+                                 if row['username'] not in existing)
+        self.stdout.write("Created %d user(s) in %.1f s (%.1f users/s, hashing %.1f s), skipped %d." % (
+            created, seconds, created / seconds, hashed - start, len(existing)))
+
+    @staticmethod
+    def read_rows(path):
+        f = sys.stdin if path == '-' else open(path, newline='')
+        try:
+            reader = csv.DictReader(f)
+            if not reader.fieldnames or 'username' not in reader.fieldnames:
+                raise CommandError("The CSV file must have a header row with (at least) a username column")
+            unknown = set(reader.fieldnames) - set(FIELDS)
+            if unknown:
+                raise CommandError("Unknown column(s): %s" % ', '.join(sorted(unknown)))
+            # Passwords are used as they are, other values without surrounding whitespace
+            rows = [{field: (row.get(field) or '') if field == 'password' else (row.get(field) or '').strip()
+                     for field in FIELDS} for row in reader]
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        seen = set()
+        for line, row in enumerate(rows, start=2):
+            if not row['username']:
+                raise CommandError("Line %d: username is missing" % line)
+            try:
+                User.username_validator(row['username'])
+            except ValidationError as e:
+                raise CommandError("Line %d: invalid username %s: %s" % (line, row['username'], ' '.join(e.messages)))
+            if row['username'] in seen:
+                raise CommandError("Line %d: duplicate username %s" % (line, row['username']))
+            seen.add(row['username'])
+        return rows
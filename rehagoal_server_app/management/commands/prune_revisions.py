@@ -0,0 +1,31 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from rehagoal_server_app.models import Workflow, WorkflowRevision
+from rehagoal_server_app.revisions import delete_orphaned_files, get_config, prune_revisions
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes workflow revisions exceeding the retention policy (settings.WORKFLOW_REVISIONS), including revisions "
+        "of workflows which have not been changed since they expired, and files of revisions which have not been "
+        "recorded (e.g. rolled back). Intended to be run regularly, e.g. via cron."
+    )
+
+    def handle(self, *args, **options):
+        config = get_config()
+        if config is None:
+            self.stdout.write("Workflow revisions are disabled.")
+            return
+        revisions = WorkflowRevision.objects.all()
+        if config['MAX_AGE'] is not None:
+            revisions = revisions.filter(created__lt=timezone.now() - datetime.timedelta(seconds=config['MAX_AGE']))
+        # A subquery instead of a list of ids, which would exceed the maximum number of query parameters (e.g. SQLite)
+        workflows = list(Workflow.objects.filter(pk__in=revisions.values('workflow')).only('pk'))
+        deleted = 0
+        for workflow in workflows:
+            deleted += prune_revisions(workflow, config)
+        self.stdout.write("Deleted %d workflow revision(s)." % deleted)
+        self.stdout.write("Deleted %d orphaned revision file(s)." % delete_orphaned_files(config))
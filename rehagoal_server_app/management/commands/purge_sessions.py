@@ -0,0 +1,39 @@
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes expired sessions from the database in batches, so that the database is not locked for long. "
+        "Intended to be run regularly, e.g. via cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of sessions to delete per query (default: 1000)")
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help="Seconds to sleep after each batch (default: 0)")
+
+    def handle(self, *args, **options):
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        if not hasattr(session_store, 'get_model_class'):
+            # e.g. signed cookies or cache-only sessions, which expire on their own
+            self.stdout.write("Session engine %s does not store sessions in the database." % settings.SESSION_ENGINE)
+            return
+        session_model = session_store.get_model_class()
+        deleted = 0
+        while True:
+            expired_keys = list(session_model.objects.filter(
+                expire_date__lt=timezone.now()
+            ).values_list('pk', flat=True)[:options['batch_size']])
+            if not expired_keys:
+                break
+            session_model.objects.filter(pk__in=expired_keys).delete()
+            deleted += len(expired_keys)
+            if options['pause']:
+                time.sleep(options['pause'])
+        self.stdout.write("Deleted %d expired session(s)." % deleted)
@@ -0,0 +1,40 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rehagoal_server.handlers import get_wsgi_application
+from rehagoal_server.prefork import PreforkServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the pre-forking production server: The application is loaded once and shared by the worker "
+        "processes. Send SIGHUP for a graceful reload, SIGTERM for a graceful shutdown and SIGUSR1 to report the "
+        "memory usage of the workers. Each worker handles one request at a time, so requests for workflow changes "
+        "are answered right away instead of waiting for changes (long-polling)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('addrport', nargs='?', default='127.0.0.1:8000',
+                            help="Address and port to listen on (default: 127.0.0.1:8000)")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Number of worker processes (default: number of CPUs)")
+        parser.add_argument('--graceful-timeout', type=int, default=30,
+                            help="Seconds to wait for workers to finish their current request on shutdown or reload "
+                                 "(default: 30)")
+        parser.add_argument('--timeout', type=int, default=30,
+                            help="Seconds a connection may be idle while reading the request or sending the response, "
+                                 "before it is closed (default: 30)")
+
+    def handle(self, *args, **options):
+        host, _, port = options['addrport'].rpartition(':')
+        if not port.isdigit():
+            raise CommandError("Invalid address and port: %s" % options['addrport'])
+        if options['workers'] < 1:
+            raise CommandError("At least one worker is required.")
+        if options['timeout'] < 1:
+            raise CommandError("The timeout must be at least one second.")
+        server = PreforkServer(get_wsgi_application, (host.strip('[]') or '127.0.0.1', int(port)),
+                               workers=options['workers'], graceful_timeout=options['graceful_timeout'],
+                               stdout=self.stdout, request_timeout=options['timeout'])
+        server.run()
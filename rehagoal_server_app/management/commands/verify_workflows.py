@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from rehagoal_server_app.content import inspect_stored_content
+from rehagoal_server_app.models import Workflow, add_storage_used
+
+
+class Command(BaseCommand):
+    help = (
+        "Verifies the SHA-256 digests of stored workflow contents incrementally: "
+        "Each run checks the workflows which have not been verified for the longest time. "
+        "Missing digests and metadata (e.g. of workflows uploaded before they were introduced) are stored."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=1000,
+                            help="Maximum number of workflows to verify in this run (default: 1000)")
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help="Seconds to sleep after each workflow, to limit the I/O load (default: 0)")
+
+    def handle(self, *args, **options):
+        storage = Workflow._meta.get_field('content').storage
+        workflows = Workflow.objects.order_by(F('content_verified').asc(nulls_first=True), 'id')
+        verified = corrupted = 0
+        rows = workflows.values_list('id', 'content', 'sha256', 'size', 'owner')[:options['limit']]
+        for workflow_id, name, expected_sha256, size, owner_id in rows:
+            update = {'content_verified': timezone.now()}
+            try:
+                info = inspect_stored_content(storage, name)
+            except OSError as e:
+                corrupted += 1
+                self.stderr.write("Workflow %s: content file %s could not be read: %s" % (workflow_id, name, e))
+            else:
+                if expected_sha256 and expected_sha256 != info.sha256:
+                    corrupted += 1
+                    self.stderr.write("Workflow %s: content file %s is corrupted (expected SHA-256 %s, actual %s)"
+                                      % (workflow_id, name, expected_sha256, info.sha256))
+                else:
+                    verified += 1
+                    update.update(sha256=info.sha256, size=info.size, name=info.name or '', task_count=info.task_count)
+            # Corrupted files are marked as verified as well, so that they do not block the verification of others.
+            # Only update the workflow, if its content has not been replaced in the meantime
+            with transaction.atomic():
+                updated = Workflow.objects.filter(id=workflow_id, content=name).update(**update)
+                if updated and 'size' in update:
+                    # Sizes of workflows uploaded before they were stored are not part of the storage used yet
+                    add_storage_used(owner_id, update['size'] - (size or 0), enforce_quota=False)
+            if options['pause']:
+                time.sleep(options['pause'])
+        self.stdout.write("Verified %d workflow(s), %d corrupted or missing." % (verified, corrupted))
+        if corrupted:
+            raise CommandError("%d workflow content file(s) are corrupted or missing." % corrupted)
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:52
+
+from django.db import migrations, models
+import private_storage.fields
+import private_storage.storage.files
+import rehagoal_server_app.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rehagoal_server_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflow',
+            name='content_verified',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='sha256',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='workflow',
+            name='content',
+            field=private_storage.fields.PrivateFileField(db_index=True, storage=private_storage.storage.files.PrivateFileSystemStorage(), upload_to=rehagoal_server_app.models.replace_filename),
+        ),
+    ]
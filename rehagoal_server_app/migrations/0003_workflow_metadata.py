@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rehagoal_server_app', '0002_workflow_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflow',
+            name='name',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='task_count',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:27
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def compute_storage_used(apps, schema_editor):
+    # Workflows without size (uploaded before it was stored) are added by the verify_workflows command
+    RehagoalUser = apps.get_model('rehagoal_server_app', 'RehagoalUser')
+    Workflow = apps.get_model('rehagoal_server_app', 'Workflow')
+    db_alias = schema_editor.connection.alias
+    sizes = Workflow.objects.using(db_alias).order_by().values_list('owner').annotate(size=Sum('size'))
+    for owner_id, size in sizes:
+        RehagoalUser.objects.using(db_alias).filter(pk=owner_id).update(storage_used=size or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rehagoal_server_app', '0003_workflow_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rehagoaluser',
+            name='storage_quota',
+            field=models.PositiveBigIntegerField(blank=True, help_text='Maximum total size of the workflow contents in bytes. Leave empty to use the default (settings.WORKFLOW_STORAGE_QUOTA).', null=True),
+        ),
+        migrations.AddField(
+            model_name='rehagoaluser',
+            name='storage_used',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(compute_storage_used, migrations.RunPython.noop),
+    ]
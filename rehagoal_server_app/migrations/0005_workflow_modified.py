@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rehagoal_server_app', '0004_rehagoaluser_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflow',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-19 08:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+import private_storage.fields
+import private_storage.storage.files
+import rehagoal_server_app.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rehagoal_server_app', '0006_requestprofile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkflowRevision',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('created', models.DateTimeField()),
+                ('sha256', models.CharField(max_length=64)),
+                ('size', models.PositiveBigIntegerField()),
+                ('name', models.CharField(blank=True, max_length=255)),
+                ('task_count', models.PositiveIntegerField(blank=True, null=True)),
+                ('keyframe', models.BooleanField()),
+                ('base_prefix', models.PositiveBigIntegerField(default=0)),
+                ('base_suffix', models.PositiveBigIntegerField(default=0)),
+                ('data', private_storage.fields.PrivateFileField(storage=private_storage.storage.files.PrivateFileSystemStorage(), upload_to=rehagoal_server_app.models.revision_filename)),
+                ('workflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='revisions', to='rehagoal_server_app.workflow')),
+            ],
+            options={
+                'ordering': ['-number'],
+                'unique_together': {('workflow', 'number')},
+            },
+        ),
+    ]
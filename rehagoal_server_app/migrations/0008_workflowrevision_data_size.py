@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-19 08:58
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def compute_data_size(apps, schema_editor):
+    # Existing revisions count towards the storage used by the owner as well
+    RehagoalUser = apps.get_model('rehagoal_server_app', 'RehagoalUser')
+    WorkflowRevision = apps.get_model('rehagoal_server_app', 'WorkflowRevision')
+    db_alias = schema_editor.connection.alias
+    storage = WorkflowRevision._meta.get_field('data').storage
+    revisions = WorkflowRevision.objects.using(db_alias).values_list('pk', 'data', 'workflow__owner')
+    for pk, name, owner_id in revisions.iterator():
+        try:
+            size = storage.size(name)
+        except OSError:  # deleted by the retention policy
+            continue
+        WorkflowRevision.objects.using(db_alias).filter(pk=pk).update(data_size=size)
+        RehagoalUser.objects.using(db_alias).filter(pk=owner_id).update(storage_used=F('storage_used') + size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rehagoal_server_app', '0007_workflowrevision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflowrevision',
+            name='data_size',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(compute_data_size, migrations.RunPython.noop),
+    ]
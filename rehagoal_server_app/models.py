@@ -1,20 +1,35 @@
 from __future__ import unicode_literals
 
+import logging
 import string
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import F, Q, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.db.models.signals import post_save, post_delete, pre_save
-from django.dispatch import receiver
+from django.dispatch import Signal, receiver
 from django.utils.crypto import get_random_string
 from typing import Optional, Any
 from private_storage.fields import PrivateFileField
 
+from .blobcache import blob_cache
+from .content import NAME_MAX_LENGTH, inspect_content, link_content
+from .notifications import notifier
+from .storage import private_storage
+
 
 ID_LENGTH = 12
 FILENAME_STRING_CHARS = string.ascii_letters + string.digits
 MAX_FILE_SIZE = 200 * 1024 * 1024  # 200 MiB
 
+LOG = logging.getLogger(__name__)
+
+#: Sent in the transaction saving a workflow, whose content has been replaced, before the replaced content is deleted.
+#: Arguments: instance (the saved workflow), old_instance (with the replaced content) and using.
+content_replaced = Signal()
+
 
 def pkgen():
     return get_random_string(length=ID_LENGTH)
@@ -24,13 +39,73 @@ def replace_filename(_instance, _filename):
     return get_random_string(length=ID_LENGTH, allowed_chars=FILENAME_STRING_CHARS)
 
 
+# Subdirectory of the revision data, not served by the download view (see ContentFileDownloadView.can_access_file)
+REVISIONS_DIRECTORY = 'revisions/'
+
+
+def revision_filename(_instance, _filename):
+    return REVISIONS_DIRECTORY + replace_filename(_instance, _filename)
+
+
+class StorageQuotaExceeded(Exception):
+    """
+    Raised if saving a workflow would exceed the storage quota of its owner.
+    """
+
+
+def get_default_storage_quota():
+    """
+    Default maximum total size (bytes) of the workflow contents per user, None for unlimited.
+    """
+    return getattr(settings, 'WORKFLOW_STORAGE_QUOTA', None)
+
+
 class RehagoalUser(models.Model):
     id = models.SlugField(max_length=ID_LENGTH, primary_key=True, default=pkgen)
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='rehagoal_user')
+    # Total size of the workflow contents owned by the user, updated incrementally (see add_storage_used)
+    storage_used = models.PositiveBigIntegerField(default=0, editable=False)
+    storage_quota = models.PositiveBigIntegerField(
+        null=True, blank=True,
+        help_text="Maximum total size of the workflow contents in bytes. "
+                  "Leave empty to use the default (settings.WORKFLOW_STORAGE_QUOTA)."
+    )
 
     def __str__(self):
         return "%s (%s)" % (self.user.username, self.id)
 
+    def get_storage_quota(self):
+        return self.storage_quota if self.storage_quota is not None else get_default_storage_quota()
+
+    def get_storage_available(self):
+        """
+        Remaining storage (bytes) according to the loaded storage_used, None for unlimited.
+        """
+        quota = self.get_storage_quota()
+        return None if quota is None else max(quota - self.storage_used, 0)
+
+
+def add_storage_used(owner_id, delta, using=None, enforce_quota=True):
+    """
+    Add delta (bytes, may be negative) to the storage used by the given owner, with a single (conditional) UPDATE.
+    Must be called in the transaction, which creates, updates or deletes the workflow content.
+    :raises StorageQuotaExceeded: if the increase would exceed the storage quota of the owner
+    """
+    if not delta:
+        return
+    owners = RehagoalUser.objects.using(using).filter(pk=owner_id)
+    if delta < 0:
+        owners.update(storage_used=Greatest(F('storage_used') + delta, Value(0)))
+        return
+    if enforce_quota:
+        default_quota = get_default_storage_quota()
+        if default_quota is None:
+            owners = owners.filter(Q(storage_quota__isnull=True) | Q(storage_used__lte=F('storage_quota') - delta))
+        else:
+            owners = owners.filter(storage_used__lte=Coalesce(F('storage_quota'), Value(default_quota)) - delta)
+    if not owners.update(storage_used=F('storage_used') + delta) and enforce_quota:
+        raise StorageQuotaExceeded()
+
 
 # proxy for simple admin interface
 class SimpleUser(User):
@@ -51,36 +126,273 @@ post_save.connect(create_rehagoal_user, sender=User)
 post_save.connect(create_rehagoal_user, sender=SimpleUser)
 
 
+def delete_content_files(names, storage):
+    """
+    Delete the given content files from the storage and the blob cache.
+    Failing deletions are logged, but do not prevent the remaining files from being deleted.
+    """
+    names = [name for name in names if name]
+    for name in names:
+        try:
+            storage.delete(name)
+        except OSError:
+            LOG.exception("Could not delete workflow content file %s", name)
+    blob_cache.delete_many(names)
+
+
+class WorkflowQuerySet(models.QuerySet):
+    def bulk_delete(self):
+        """
+        Delete all workflows of this queryset with a single DELETE query, without loading them into memory.
+        The per-instance delete signals are not sent, instead the content files are deleted
+        once the surrounding transaction has been committed.
+        :return: number of deleted workflows
+        """
+        if self.query.is_sliced:
+            raise TypeError("Cannot use 'limit' or 'offset' with bulk_delete().")
+        storage = self.model._meta.get_field('content').storage
+        with transaction.atomic(using=self.db):
+            names = list(self.values_list('content', flat=True))
+            WorkflowRevision.objects.using(self.db).filter(workflow__in=self.values('pk')).bulk_delete()
+            sizes = list(self.order_by().values_list('owner').annotate(size=Sum('size')))
+            # Clear ordering, as it is not supported in DELETE queries by every database backend
+            deleted = self.order_by()._raw_delete(using=self.db)
+            for owner_id, size in sizes:
+                add_storage_used(owner_id, -(size or 0), using=self.db)
+            transaction.on_commit(lambda: delete_content_files(names, storage), using=self.db)
+            for owner_id, _ in sizes:
+                notify_changed_on_commit(owner_id, using=self.db)
+        return deleted
+
+    bulk_delete.alters_data = True
+
+
 class Workflow(models.Model):
     id = models.SlugField(max_length=ID_LENGTH, primary_key=True, default=pkgen)
     owner = models.ForeignKey(RehagoalUser, on_delete=models.CASCADE)
-    content = PrivateFileField(upload_to=replace_filename, max_file_size=MAX_FILE_SIZE)
+    content = PrivateFileField(upload_to=replace_filename, max_file_size=MAX_FILE_SIZE, db_index=True,
+                               storage=private_storage)
+    sha256 = models.CharField(max_length=64, blank=True, editable=False)
+    content_verified = models.DateTimeField(null=True, blank=True, editable=False)
+    # Metadata extracted from JSON contents (see content.WorkflowMetadataParser)
+    name = models.CharField(max_length=NAME_MAX_LENGTH, blank=True, db_index=True, editable=False)
+    task_count = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    size = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    # Time of the last save, e.g. for incremental exports (see the export_workflows command)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = WorkflowQuerySet.as_manager()
 
     def __str__(self):
         return "%s by %s" % (self.id, self.owner.user.username)
 
+    def save(self, *args, **kwargs):
+        # The storage used by the owner is updated by the pre_save signal (see account_content_on_pre_save),
+        # which has to run in the same transaction as the save
+        using = kwargs.get('using') or router.db_for_write(Workflow, instance=self)
+        if transaction.get_connection(using).in_atomic_block:
+            super(Workflow, self).save(*args, **kwargs)
+        else:
+            with transaction.atomic(using=using):
+                super(Workflow, self).save(*args, **kwargs)
+
+    def set_content_info(self, info):
+        """
+        Store the digest, size and metadata of the content.
+        :type info: content.ContentInfo
+        """
+        self.sha256 = info.sha256
+        self.size = info.size
+        self.name = info.name or ''
+        self.task_count = info.task_count
+        self.content_verified = None
+
+    def save_linked_content(self, name, info):
+        """
+        Save this workflow with the stored content file of another workflow as content, which is shared as hard link
+        if possible (see content.link_content), instead of copying its data.
+        :type info: content.ContentInfo
+        :raises FileNotFoundError: if the content file does not exist (anymore)
+        :raises StorageQuotaExceeded: if the content exceeds the storage quota of the owner
+        """
+        storage = self.content.storage
+        new_name = link_content(storage, name, replace_filename(self, name))
+        self.content = new_name
+        self.set_content_info(info)
+        try:
+            self.save()
+        except BaseException:
+            storage.delete(new_name)
+            raise
+
     def delete_content(self, save=True):
         if self.content:
+            name = self.content.name
             self.content.delete(save=save)
+            blob_cache.delete(name)
 
     class Meta:
         ordering = ['id']
 
 
+class WorkflowRevisionQuerySet(models.QuerySet):
+    def bulk_delete(self):
+        """
+        Delete all revisions of this queryset with a single DELETE query (like WorkflowQuerySet.bulk_delete),
+        their data files are deleted once the surrounding transaction has been committed.
+        :return: number of deleted revisions
+        """
+        storage = self.model._meta.get_field('data').storage
+        # Without savepoint, as revisions are pruned on every update of a workflow (see revisions.prune_revisions)
+        with transaction.atomic(using=self.db, savepoint=False):
+            names = list(self.order_by().values_list('data', flat=True))
+            if not names:
+                return 0
+            sizes = list(self.order_by().values_list('workflow__owner').annotate(size=Sum('data_size')))
+            deleted = self.order_by()._raw_delete(using=self.db)
+            for owner_id, size in sizes:
+                add_storage_used(owner_id, -(size or 0), using=self.db)
+            transaction.on_commit(lambda: delete_content_files(names, storage), using=self.db)
+        return deleted
+
+    bulk_delete.alters_data = True
+
+
+class WorkflowRevision(models.Model):
+    """
+    Former content of a workflow, stored as keyframe (the whole content) or as delta against the next newer revision
+    or the current content (see revisions.py).
+    """
+    workflow = models.ForeignKey(Workflow, on_delete=models.CASCADE, related_name='revisions')
+    number = models.PositiveIntegerField()
+    # Time the content was saved, i.e. Workflow.modified at that time
+    created = models.DateTimeField()
+    sha256 = models.CharField(max_length=64)
+    size = models.PositiveBigIntegerField()
+    name = models.CharField(max_length=NAME_MAX_LENGTH, blank=True)
+    task_count = models.PositiveIntegerField(null=True, blank=True)
+    keyframe = models.BooleanField()
+    # Deltas: number of bytes copied from the start and the end of the base, the compressed data holds the bytes between
+    base_prefix = models.PositiveBigIntegerField(default=0)
+    base_suffix = models.PositiveBigIntegerField(default=0)
+    data = PrivateFileField(upload_to=revision_filename, storage=private_storage)
+    # Size of the data file, which counts towards the storage used by the owner of the workflow
+    data_size = models.PositiveBigIntegerField(default=0)
+
+    objects = WorkflowRevisionQuerySet.as_manager()
+
+    def __str__(self):
+        return "%s revision %d" % (self.workflow_id, self.number)
+
+    class Meta:
+        ordering = ['-number']
+        unique_together = [('workflow', 'number')]
+
+
+class RequestProfile(models.Model):
+    """
+    Profile of a single request, recorded on demand of a staff user (see profiling.py).
+    """
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=2000)
+    status_code = models.PositiveSmallIntegerField()
+    duration = models.FloatField(help_text="Seconds")
+    sample_count = models.PositiveIntegerField()
+    # Stack samples in the collapsed format of flamegraph.pl (one "frame;frame;... count" per line)
+    stacks = models.TextField(blank=True)
+    query_count = models.PositiveIntegerField()
+    query_duration = models.FloatField(help_text="Seconds")
+    # Executed SQL (without parameters), with the duration of every query
+    queries = models.TextField(blank=True)
+
+    def __str__(self):
+        return "%s %s (%s)" % (self.method, self.path, self.created)
+
+    class Meta:
+        ordering = ['-created']
+
+
 @receiver(post_delete, sender=Workflow)
 def auto_delete_content_file_on_post_delete(instance, **_kwargs):
+    # Content files may be hard links shared with other workflows (see content.link_content),
+    # deleting one name keeps the data of the others
     # Do not save, to prevent model from being persisted again to DB
     instance.delete_content(save=False)
 
 
+@receiver(post_delete, sender=WorkflowRevision)
+def delete_revision_data_on_post_delete(instance, **_kwargs):
+    instance.data.delete(save=False)
+
+
+@receiver(post_delete, sender=WorkflowRevision)
+def release_revision_storage_used_on_post_delete(instance, using, **_kwargs):
+    # Deleted along with their workflow (by cascade), whose owner is not loaded
+    owner = Workflow.objects.using(using).filter(pk=instance.workflow_id).values('owner')[:1]
+    add_storage_used(owner, -instance.data_size, using=using)
+
+
+@receiver(post_delete, sender=Workflow)
+def release_storage_used_on_post_delete(instance, using, **_kwargs):
+    add_storage_used(instance.owner_id, -(instance.size or 0), using=using)
+
+
+def notify_changed_on_commit(owner_id, using=None):
+    """
+    Notify clients waiting for changes of the workflows of the given owner (see notifications.py),
+    once the surrounding transaction has been committed.
+    """
+    transaction.on_commit(lambda: notifier.notify(owner_id), using=using)
+
+
+@receiver(post_save, sender=Workflow)
+@receiver(post_delete, sender=Workflow)
+def notify_changed(instance, using, **_kwargs):
+    notify_changed_on_commit(instance.owner_id, using=using)
+
+
 @receiver(pre_save, sender=Workflow)
-def auto_delete_content_file_on_pre_save(instance: Workflow, raw: bool, using: str, update_fields: Optional[Any], **_kwargs):
-    try:
+def update_content_info_on_pre_save(instance: Workflow, raw: bool, **_kwargs):
+    # Only new content (not yet committed to the storage) needs to be inspected
+    if raw or not instance.content or instance.content._committed:
+        return
+    instance.set_content_info(inspect_content(instance.content.file))
+
+
+@receiver(pre_save, sender=Workflow)
+def account_content_on_pre_save(instance: Workflow, raw: bool, using: str, update_fields: Optional[Any], **_kwargs):
+    """
+    Add the size of new content to the storage used by the owner (enforcing the storage quota),
+    and remember replaced content, which is deleted after the save (see delete_replaced_content_on_post_save).
+    """
+    if raw:
+        return
+    instance._replaced_instance = None
+    old_instance = None
+    if not instance._state.adding:
         # Get old instance (if exists), as new instance already has new filename
-        old_instance = Workflow.objects.get(id=instance.id)
-        # Check that instance content has actually changed, to prevent false deletion (e.g. partial update)
-        if instance.content != old_instance.content:
-            # Do not save, to prevent infinite recursion (FileField.delete calls .save)
-            old_instance.delete_content(save=False)
-    except Workflow.DoesNotExist:  # to handle initial object creation
+        old_instance = Workflow.objects.filter(id=instance.id).only(
+            'content', 'sha256', 'size', 'name', 'task_count', 'owner', 'modified').first()
+    # Check that instance content has actually changed, to prevent false deletion (e.g. partial update)
+    if old_instance is not None and instance.content == old_instance.content:
+        return
+    if old_instance is not None and old_instance.owner_id != instance.owner_id:
+        add_storage_used(old_instance.owner_id, -(old_instance.size or 0), using=using)
+        old_size = 0
+    else:
+        old_size = old_instance.size or 0 if old_instance is not None else 0
+    add_storage_used(instance.owner_id, (instance.size or 0) - old_size, using=using)
+    instance._replaced_instance = old_instance
+
+
+@receiver(post_save, sender=Workflow)
+def delete_replaced_content_on_post_save(instance: Workflow, using: str, **_kwargs):
+    old_instance = instance.__dict__.pop('_replaced_instance', None)
+    if old_instance is None or not old_instance.content:
         return
+    # e.g. recording the replaced content as revision (see revisions.py), while it still exists
+    content_replaced.send(sender=Workflow, instance=instance, old_instance=old_instance, using=using)
+    # Do not save, to prevent infinite recursion (FileField.delete calls .save)
+    old_instance.delete_content(save=False)
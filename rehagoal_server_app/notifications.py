@@ -0,0 +1,105 @@
+"""
+Change notifications of the workflows of a user, for long-polling clients (see WorkflowViewSet.changes).
+
+Worker processes share the notifications through the filesystem: every owner has a file in
+settings.WORKFLOW_CHANGES_DIR, whose modification time (ns) is advanced on every change of its workflows and
+serves as cursor. Waiting clients only stat() this file periodically, i.e. idle connections do not use the database.
+As every waiting client occupies a thread, the number of waiting requests per process is limited (max_waiters),
+further requests are answered right away. Servers handling one request per process at a time (wsgi.multithread is
+false, e.g. the pre-forking server of the serve command) never wait, as a waiting request would block the whole
+process: there, the changes endpoint returns the current cursor right away, and clients poll it (see Retry-After).
+Notifications are sent after the commit of the changes, failing to send them does not fail the change: the clients
+notice the change with their next request.
+"""
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+#: Interval (seconds), in which waiting requests check for changes
+POLL_INTERVAL = 0.5
+#: Default maximum number of waiting requests per process
+MAX_WAITERS = 8
+
+LOG = logging.getLogger(__name__)
+
+
+class ChangeNotifier(object):
+
+    def __init__(self, directory, max_waiters=MAX_WAITERS):
+        self.directory = directory
+        self.max_waiters = max_waiters
+        self.waiters = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(getattr(settings, 'WORKFLOW_CHANGES_DIR', os.path.join(settings.BASE_DIR, 'cache', 'changes')),
+                   getattr(settings, 'WORKFLOW_CHANGES_MAX_WAITERS', MAX_WAITERS))
+
+    def path(self, owner_id):
+        return os.path.join(self.directory, str(owner_id))
+
+    def cursor(self, owner_id):
+        """
+        Return the current cursor (str) of the workflows of the given owner, which changes with every notification.
+        """
+        try:
+            return str(os.stat(self.path(owner_id)).st_mtime_ns)
+        except FileNotFoundError:
+            return '0'
+
+    def notify(self, owner_id):
+        """
+        Notify waiting requests, that workflows of the given owner have changed.
+        Errors are logged, as the change has been committed already (see models.notify_changed_on_commit).
+        """
+        path = self.path(owner_id)
+        try:
+            try:
+                previous = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                os.makedirs(self.directory, exist_ok=True)
+                open(path, 'a').close()
+                previous = 0
+            # The cursor must change, even if the clock has not advanced since the previous notification
+            modified = max(int(time.time() * 1e9), previous + 1)
+            os.utime(path, ns=(modified, modified))
+        except OSError:
+            LOG.exception("Could not notify changes of the workflows of owner %s", owner_id)
+
+    def wait(self, owner_id, cursor, timeout):
+        """
+        Wait up to timeout seconds, until the cursor of the given owner differs from the given cursor.
+        :return: current cursor, or None without waiting, if max_waiters requests of this process are waiting already
+        """
+        with self._lock:
+            if self.waiters >= self.max_waiters:
+                return None
+            self.waiters += 1
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                current = self.cursor(owner_id)
+                remaining = deadline - time.monotonic()
+                if current != cursor or remaining <= 0:
+                    return current
+                time.sleep(min(POLL_INTERVAL, remaining))
+        finally:
+            with self._lock:
+                self.waiters -= 1
+
+
+notifier = ChangeNotifier.from_settings()
+
+
+@receiver(setting_changed)
+def reload_notifier(setting, **_kwargs):
+    # Updated in place, as the notifier is imported by other modules (e.g. override_settings in the tests)
+    if setting in ('WORKFLOW_CHANGES_DIR', 'WORKFLOW_CHANGES_MAX_WAITERS'):
+        reloaded = ChangeNotifier.from_settings()
+        notifier.directory, notifier.max_waiters = reloaded.directory, reloaded.max_waiters
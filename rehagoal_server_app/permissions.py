@@ -13,7 +13,8 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
             return True
 
         # Write permissions are only allowed to the owner of the snippet.
-        return obj.owner == request.user.rehagoal_user
+        # Compare IDs, as the owner does not need to be loaded for that.
+        return obj.owner_id == request.user.rehagoal_user.id
 
 
 class IsAdminOrDenyList(permissions.BasePermission):
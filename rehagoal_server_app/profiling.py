@@ -0,0 +1,190 @@
+"""
+On-demand profiling of single requests, for finding out why an endpoint is slow in production.
+
+Staff users request a profile with the header `X-Profile: 1`. The request is then run under a sampling profiler,
+which records the stack of the request thread every settings.REQUEST_PROFILING['INTERVAL'] seconds from a separate
+thread, and the executed SQL is recorded with a database execute wrapper. The profile is stored as RequestProfile
+(stacks in the collapsed format of flamegraph.pl) and can be downloaded in the admin interface, its ID is returned in
+the `X-Profile-Id` header of the response.
+
+Requests without the header only pay for a dictionary lookup, the middleware is not loaded at all if
+settings.REQUEST_PROFILING is None. The header of other users is ignored.
+"""
+import collections
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .models import RequestProfile
+
+#: Request header (in request.META) enabling the profiler
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+#: Response header with the ID of the stored RequestProfile
+PROFILE_ID_HEADER = 'X-Profile-Id'
+
+#: Default configuration, which can be overridden with settings.REQUEST_PROFILING
+DEFAULT_CONFIG = {
+    'INTERVAL': 0.001,  # seconds between two samples
+    'MAX_PROFILES': 100,  # number of stored profiles, older ones are deleted
+}
+
+
+def get_config():
+    config = getattr(settings, 'REQUEST_PROFILING', {})
+    if config is None:  # disabled
+        return None
+    return dict(DEFAULT_CONFIG, **config)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s:%s' % (frame.f_globals.get('__name__', code.co_filename), getattr(code, 'co_qualname', code.co_name))
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of a thread (by default the current one) in a background thread, which only holds the GIL
+    while taking a sample. Sampling is therefore limited by the switch interval of the interpreter
+    (sys.getswitchinterval(), 5 ms by default), if the profiled thread does not release the GIL (e.g. for I/O).
+    """
+
+    def __init__(self, interval, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        #: collapsed stack (outermost frame first) -> number of samples
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame))
+                frame = frame.f_back
+            del frame
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+    @property
+    def sample_count(self):
+        return sum(self.stacks.values())
+
+    def collapsed(self):
+        return ''.join('%s %d\n' % item for item in self.stacks.most_common())
+
+
+class QueryRecorder(object):
+    """
+    Execute wrapper of all database connections of the current thread, which records the SQL (without parameters,
+    as they may contain personal data) and the duration of every query.
+    """
+
+    def __init__(self):
+        #: list of (database alias, sql, duration in seconds, executemany)
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((context['connection'].alias, sql, time.perf_counter() - start, many))
+
+    def install(self):
+        for connection in connections.all():
+            connection.execute_wrappers.append(self)
+
+    def uninstall(self):
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+    @property
+    def duration(self):
+        return sum(query[2] for query in self.queries)
+
+    def formatted(self):
+        return ''.join('-- %d. %.3f ms (%s%s)\n%s;\n\n' % (
+            number, duration * 1000, alias, ', executemany' if many else '', sql)
+            for number, (alias, sql, duration, many) in enumerate(self.queries, start=1))
+
+
+def get_staff_user(request):
+    """
+    Return the staff user making the request, or None. Token-authenticated API requests are authenticated with the
+    DRF authentication classes, as the user is not known before the view is called.
+    """
+    user = getattr(request, 'user', None)  # session (AuthenticationMiddleware)
+    if user is not None and user.is_authenticated:
+        return user if user.is_staff else None
+    # SessionAuthentication is covered above, and would read the request body for the CSRF check
+    authenticators = [authentication() for authentication in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+                      if not issubclass(authentication, SessionAuthentication)]
+    try:
+        user = Request(request, authenticators=authenticators).user
+    except APIException:  # invalid credentials, handled by the view
+        return None
+    return user if user is not None and user.is_authenticated and user.is_staff else None
+
+
+class RequestProfilingMiddleware(object):
+    """
+    Profiles requests of staff users with the X-Profile header (see above). Should be the last middleware, so that
+    the authenticated user is known for session requests.
+    """
+
+    def __init__(self, get_response):
+        self.config = get_config()
+        if self.config is None:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if PROFILE_HEADER not in request.META:
+            return self.get_response(request)
+        user = get_staff_user(request)
+        if user is None:
+            return self.get_response(request)
+        return self.profile(request, user)
+
+    def profile(self, request, user):
+        profiler = SamplingProfiler(self.config['INTERVAL'])
+        recorder = QueryRecorder()
+        recorder.install()
+        start = time.perf_counter()
+        profiler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.stop()
+            duration = time.perf_counter() - start
+            recorder.uninstall()
+        profile = RequestProfile.objects.create(
+            user=user, method=request.method, path=request.path[:2000], status_code=response.status_code,
+            duration=duration, sample_count=profiler.sample_count, stacks=profiler.collapsed(),
+            query_count=len(recorder.queries), query_duration=recorder.duration, queries=recorder.formatted(),
+        )
+        max_profiles = self.config['MAX_PROFILES']
+        oldest_kept = list(RequestProfile.objects.order_by('-pk').values_list('pk', flat=True)[
+                           max_profiles - 1:max_profiles])
+        if oldest_kept:
+            RequestProfile.objects.filter(pk__lt=oldest_kept[0]).delete()
+        response[PROFILE_ID_HEADER] = str(profile.pk)
+        return response
@@ -0,0 +1,63 @@
+"""
+Bulk provisioning of users (see the provision_users command).
+
+Password hashing (PBKDF2 by default) is deliberately slow, which makes it the bottleneck of creating many users.
+The passwords are therefore hashed by a pool of processes, and the User and RehagoalUser rows are inserted with
+bulk_create() in batches, instead of saving every user (and its RehagoalUser in the post_save signal) one by one.
+"""
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .models import RehagoalUser, pkgen
+
+BATCH_SIZE = 500
+
+
+def _hash_password(settings_module, password):
+    # Processes may be spawned instead of forked (e.g. on macOS), in which case Django is not set up yet.
+    # Set up lazily, as ProcessPoolExecutor supports no initializer before Python 3.7.
+    from django.apps import apps
+    if not apps.ready:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+        import django
+        django.setup()
+    return make_password(password)
+
+
+def hash_passwords(passwords, processes=None):
+    """
+    Hash the given passwords (None for an unusable password) with make_password() in a pool of processes.
+    :param processes: number of processes, defaults to the number of CPUs
+    :return: list of hashed passwords
+    """
+    from django.conf import settings
+    passwords = list(passwords)
+    processes = min(processes or os.cpu_count() or 1, max(len(passwords), 1))
+    if processes <= 1:
+        return [make_password(password) for password in passwords]
+    chunksize = max(1, len(passwords) // (processes * 4))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(functools.partial(_hash_password, settings.SETTINGS_MODULE), passwords,
+                                 chunksize=chunksize))
+
+
+def bulk_create_users(users, batch_size=BATCH_SIZE):
+    """
+    Create the given (unsaved) users along with their RehagoalUser, like saving them one by one would
+    (see create_rehagoal_user), but with two INSERT queries per batch. Passwords must already be hashed.
+    :type users: list[User]
+    :return: number of created users
+    """
+    for start in range(0, len(users), batch_size):
+        batch = users[start:start + batch_size]
+        with transaction.atomic():
+            User.objects.bulk_create(batch)
+            # Primary keys are not returned by bulk_create() on every database backend
+            user_ids = User.objects.filter(username__in=[user.username for user in batch]).values_list('id', flat=True)
+            RehagoalUser.objects.bulk_create([RehagoalUser(id=pkgen(), user_id=user_id) for user_id in user_ids])
+    return len(users)
@@ -0,0 +1,408 @@
+"""
+Revision history of workflow contents: when the content of a workflow is replaced, the former content is kept as
+WorkflowRevision (see record_revision), so that it can be listed and restored (see WorkflowViewSet.revisions).
+
+Revisions are stored as reverse deltas, as only the current content is downloaded regularly: the newest revision is
+stored relative to the current content, every older revision relative to the next newer one. A delta consists of the
+length of the common prefix and suffix with its base, and the (compressed) bytes in between, which covers the usual
+edits and is computed in linear time. It is computed once the transaction replacing the content has been committed,
+so that other writers are not blocked meanwhile. The cost of reconstructing a revision is bounded by keyframes, i.e. revisions
+stored as whole (compressed) content: every KEYFRAME_INTERVAL-th revision is a keyframe, so that at most
+KEYFRAME_INTERVAL - 1 deltas are applied, each in a single pass over its base. Revisions whose delta would not save
+much (e.g. re-encrypted contents) are stored as keyframes as well. Every reconstructed revision is verified by its
+SHA-256 digest.
+
+Revisions are deleted by the retention policy (MAX_REVISIONS per workflow, MAX_AGE), oldest first, as no other
+revision depends on them. Their (compressed) data counts towards the storage quota of the owner, no revisions are
+recorded while it is exceeded. If the replaced content is not recorded (see detach_revisions), the revision recorded
+before it loses its base: it is converted into a keyframe, or deleted together with the revisions depending on it.
+Files in the revisions directory, which are not referenced by any revision (e.g. links to replaced contents, whose
+transaction has been rolled back), are deleted by delete_orphaned_files.
+"""
+import contextlib
+import datetime
+import functools
+import logging
+import operator
+import os
+import tempfile
+import time
+import zlib
+
+from django.conf import settings
+from django.core.files import File
+from django.db import DatabaseError, transaction
+from django.db.models import Q, Subquery
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .delta import COPY_CHUNK_SIZE, ContentWriter
+from .content import link_content, open_buffer
+from .models import (
+    MAX_FILE_SIZE, StorageQuotaExceeded, Workflow, WorkflowRevision, add_storage_used, content_replaced,
+    REVISIONS_DIRECTORY, revision_filename,
+)
+
+DEFAULT_CONFIG = {
+    'MAX_REVISIONS': 3,
+    'MAX_AGE': None,
+    'KEYFRAME_INTERVAL': 8,
+    'ORPHAN_MAX_AGE': 24 * 60 * 60,
+}
+#: Size of the chunks compared when computing deltas
+COMPARE_CHUNK_SIZE = 64 * 1024
+COMPRESSION_LEVEL = 6
+#: Number of files checked per query by delete_orphaned_files
+ORPHAN_CHUNK_SIZE = 500
+
+LOG = logging.getLogger(__name__)
+
+
+def get_config():
+    config = getattr(settings, 'WORKFLOW_REVISIONS', {})
+    if config is None:  # disabled
+        return None
+    return dict(DEFAULT_CONFIG, **config)
+
+
+class RevisionError(Exception):
+    """
+    Raised if a revision cannot be reconstructed, e.g. as its workflow has been changed in the meantime.
+    """
+
+
+def _common_length(a, b, length, from_end=False):
+    # Compares chunks as bytes, which is much faster than comparing memoryviews
+    def chunk(buffer, start, end):
+        if from_end:
+            return bytes(buffer[len(buffer) - end:len(buffer) - start])
+        return bytes(buffer[start:end])
+
+    start = 0
+    while start < length:
+        end = min(start + COMPARE_CHUNK_SIZE, length)
+        if chunk(a, start, end) != chunk(b, start, end):
+            # Binary search for the first difference within the chunk
+            while end - start > 1:
+                middle = (start + end) // 2
+                if chunk(a, start, middle) == chunk(b, start, middle):
+                    start = middle
+                else:
+                    end = middle
+            return start
+        start = end
+    return length
+
+
+def compute_delta(content, base):
+    """
+    Compute the delta of the content against the base (both buffers).
+    :return: (length of the common prefix, length of the common suffix)
+    """
+    length = min(len(content), len(base))
+    prefix = _common_length(content, base, length)
+    suffix = _common_length(content, base, length - prefix, from_end=True)
+    return prefix, suffix
+
+
+def _compressed(chunks):
+    file = tempfile.TemporaryFile()
+    compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    for chunk in chunks:
+        file.write(compressor.compress(chunk))
+    file.write(compressor.flush())
+    file.seek(0)
+    return File(file)
+
+
+@receiver(content_replaced, sender=Workflow)
+def record_revision_on_content_replaced(instance, old_instance, using, **_kwargs):
+    config = get_config()
+    if config is None or old_instance.sha256 == instance.sha256:
+        return
+    # The replaced content is deleted right after the save, a link to it is kept until the revision has been recorded.
+    # If the transaction is rolled back, the link remains until it is deleted by delete_orphaned_files
+    storage = instance.content.storage
+    try:
+        old_name = link_content(storage, old_instance.content.name, revision_filename(None, None))
+    except OSError:
+        # A missing revision must not prevent the update
+        LOG.exception("Could not record revision of workflow %s", instance.id)
+        detach_revisions(instance.id, old_instance, None, using=using)
+        return
+    base_name = instance.content.name
+    transaction.on_commit(lambda: record_revision_after_commit(
+        instance.id, base_name, old_instance, old_name, config, using=using), using=using)
+
+
+def record_revision_after_commit(workflow_id, base_name, old_instance, old_name, config, using=None):
+    try:
+        try:
+            revision = record_revision(workflow_id, base_name, old_instance, old_name, config, using=using)
+        except (OSError, DatabaseError):
+            LOG.exception("Could not record revision of workflow %s", workflow_id)
+            revision = None
+        if revision is None:
+            detach_revisions(workflow_id, old_instance, old_name, using=using)
+    except (OSError, DatabaseError):
+        LOG.exception("Could not detach the revisions of workflow %s", workflow_id)
+    finally:
+        Workflow._meta.get_field('content').storage.delete(old_name)
+
+
+def record_revision(workflow_id, base_name, old_instance, old_name, config, using=None):
+    """
+    Store the replaced content of old_instance (stored as old_name) as newest revision of the workflow, relative to
+    the content base_name which replaced it, and delete revisions according to the retention policy.
+    Called after the transaction saving the workflow: the delta is computed and compressed without holding any lock,
+    only the row is inserted in a transaction. No revision is recorded if the workflow has been changed again
+    in the meantime, as the next newer revision must be the base of the delta.
+    The data counts towards the storage quota of the owner, revisions exceeding it are not recorded.
+    :return: the revision, None if the workflow has been changed or deleted, or the storage quota is exceeded
+    """
+    revisions = WorkflowRevision.objects.using(using).filter(workflow_id=workflow_id)
+    newest = list(revisions.order_by('-number').values_list('keyframe', flat=True)[:config['KEYFRAME_INTERVAL']])
+    # Number of deltas, which are applied to reconstruct the oldest revision depending on the current content
+    deltas = 0
+    for keyframe in newest:
+        if keyframe:
+            break
+        deltas += 1
+    revision = WorkflowRevision(
+        workflow_id=workflow_id, created=old_instance.modified, sha256=old_instance.sha256,
+        size=old_instance.size or 0, name=old_instance.name, task_count=old_instance.task_count,
+    )
+    storage = Workflow._meta.get_field('content').storage
+    with open_buffer(storage, old_name) as content:
+        with contextlib.ExitStack() as stack:
+            try:
+                base = stack.enter_context(open_buffer(storage, base_name))
+            except FileNotFoundError:  # replaced again in the meantime
+                return None
+            prefix, suffix = compute_delta(content, base)
+            revision.keyframe = deltas + 1 >= config['KEYFRAME_INTERVAL'] or prefix + suffix < len(content) // 2
+            if not revision.keyframe:
+                revision.base_prefix, revision.base_suffix = prefix, suffix
+            # Slices must be released before the memory-mapped buffer
+            with content[revision.base_prefix:len(content) - revision.base_suffix] as data:
+                chunks = (data[start:start + COPY_CHUNK_SIZE] for start in range(0, len(data), COPY_CHUNK_SIZE))
+                with _compressed(chunks) as compressed:
+                    revision.data_size = compressed.size
+                    revision.data.save('revision', compressed, save=False)
+    try:
+        with transaction.atomic(using=using):
+            current = Workflow.objects.using(using).select_for_update().filter(pk=workflow_id).values_list(
+                'content', 'owner').first()
+            if current is None or current[0] != base_name:
+                revision.data.delete(save=False)
+                return None
+            number = revisions.order_by('-number').values_list('number', flat=True).first()
+            revision.number = (number or 0) + 1
+            revision.save(using=using)
+            prune_revisions(workflow_id, config, using=using)
+            add_storage_used(current[1], revision.data_size, using=using)
+    except StorageQuotaExceeded:
+        revision.data.delete(save=False)
+        LOG.info("Revision of workflow %s not recorded, as it exceeds the storage quota of the owner", workflow_id)
+        return None
+    except BaseException:
+        if revision.data:
+            revision.data.delete(save=False)
+        raise
+    return revision
+
+
+def detach_revisions(workflow_id, old_instance, old_name, using=None):
+    """
+    Called if the replaced content of old_instance (stored as old_name, None if missing) is not recorded as revision:
+    the newest revision recorded before, which is stored relative to that content, is converted into a keyframe.
+    If its base is missing or the keyframe would exceed the storage quota of the owner, it is deleted together with
+    the older revisions depending on it, so that all remaining revisions can be reconstructed.
+    :return: the converted revision, None if no revision has been converted
+    """
+    revisions = WorkflowRevision.objects.using(using).filter(workflow_id=workflow_id)
+    # Revisions of contents replaced later have been created after the replaced content was saved
+    newest = revisions.filter(created__lt=old_instance.modified).order_by('-number').first()
+    if newest is None or newest.keyframe:
+        return None
+    compressed = new_data = None
+    if old_name is not None:
+        storage = Workflow._meta.get_field('content').storage
+        try:
+            with storage.open(old_name, 'rb') as base:
+                with _reconstruct(newest, base, MAX_FILE_SIZE) as content:
+                    compressed = _compressed(iter(lambda: content.read(COPY_CHUNK_SIZE), b''))
+        except (OSError, RevisionError):
+            LOG.exception("Could not convert revision %s into a keyframe", newest)
+    try:
+        with transaction.atomic(using=using):
+            owner = Workflow.objects.using(using).select_for_update().filter(pk=workflow_id).values_list(
+                'owner', flat=True).first()
+            if owner is None or not revisions.filter(pk=newest.pk, keyframe=False).exists():
+                return None
+            if compressed is not None:
+                try:
+                    with transaction.atomic(using=using):
+                        add_storage_used(owner, compressed.size - newest.data_size, using=using)
+                        old_data = newest.data.name
+                        newest.keyframe, newest.base_prefix, newest.base_suffix = True, 0, 0
+                        newest.data_size = compressed.size
+                        newest.data.save('revision', compressed, save=False)
+                        new_data = newest.data.name
+                        newest.save(using=using, update_fields=[
+                            'keyframe', 'base_prefix', 'base_suffix', 'data', 'data_size'])
+                except StorageQuotaExceeded:
+                    pass
+                else:
+                    transaction.on_commit(lambda: newest.data.storage.delete(old_data), using=using)
+                    return newest
+            keyframe = revisions.filter(number__lt=newest.number, keyframe=True).order_by('-number').values_list(
+                'number', flat=True).first()
+            LOG.info("Revisions of workflow %s deleted, as they cannot be reconstructed", workflow_id)
+            revisions.filter(number__gt=keyframe or 0, number__lte=newest.number).bulk_delete()
+            return None
+    except BaseException:
+        if new_data is not None:
+            newest.data.storage.delete(new_data)
+        raise
+    finally:
+        if compressed is not None:
+            compressed.close()
+
+
+def prune_revisions(workflow, config, using=None):
+    """
+    Delete the revisions of the given workflow, which exceed MAX_REVISIONS or MAX_AGE (seconds).
+    Older revisions depend on newer ones, but not vice versa, and the creation time increases with the number,
+    so the remaining revisions can still be reconstructed.
+    :return: number of deleted revisions
+    """
+    revisions = WorkflowRevision.objects.using(using).filter(workflow=workflow)
+    expired = []
+    if config['MAX_REVISIONS'] is not None:
+        newest = revisions.order_by('-number').values('number')[:1]
+        expired.append(Q(number__lte=Subquery(newest) - config['MAX_REVISIONS']))
+    if config['MAX_AGE'] is not None:
+        expired.append(Q(created__lt=timezone.now() - datetime.timedelta(seconds=config['MAX_AGE'])))
+    if not expired:
+        return 0
+    return revisions.filter(functools.reduce(operator.or_, expired)).bulk_delete()
+
+
+def _created_time(storage, name):
+    try:
+        # The inode change time is updated when a link is created, unlike the modification time of linked contents
+        return os.stat(storage.path(name)).st_ctime
+    except NotImplementedError:
+        return storage.get_modified_time(name).timestamp()
+
+
+def delete_orphaned_files(config, using=None):
+    """
+    Delete the files in the revisions directory, which are not referenced by any revision and are older than
+    ORPHAN_MAX_AGE (seconds): links to replaced contents, whose transaction has been rolled back or whose process has
+    been killed before the revision was recorded, and data of revisions, which could not be saved.
+    :return: number of deleted files
+    """
+    storage = WorkflowRevision._meta.get_field('data').storage
+    try:
+        names = [REVISIONS_DIRECTORY + name for name in storage.listdir(REVISIONS_DIRECTORY)[1]]
+    except FileNotFoundError:
+        return 0
+    created_before = time.time() - config['ORPHAN_MAX_AGE']
+    deleted = 0
+    for start in range(0, len(names), ORPHAN_CHUNK_SIZE):
+        chunk = names[start:start + ORPHAN_CHUNK_SIZE]
+        referenced = set(WorkflowRevision.objects.using(using).filter(data__in=chunk).values_list('data', flat=True))
+        for name in chunk:
+            try:
+                if name not in referenced and _created_time(storage, name) < created_before:
+                    storage.delete(name)
+                    deleted += 1
+            except OSError:
+                LOG.exception("Could not delete orphaned revision file %s", name)
+    return deleted
+
+
+def _copy(source, writer, start, length):
+    source.seek(start)
+    while length > 0:
+        chunk = source.read(min(length, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise RevisionError('The base of a delta is truncated.')
+        writer.write(chunk)
+        length -= len(chunk)
+
+
+def _decompress(revision, writer):
+    decompressor = zlib.decompressobj()
+    with revision.data.open('rb') as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+            # Limit the size of decompressed chunks, which could be much larger
+            while chunk:
+                writer.write(decompressor.decompress(chunk, COPY_CHUNK_SIZE))
+                chunk = decompressor.unconsumed_tail
+    writer.write(decompressor.flush())
+    if not decompressor.eof:
+        raise RevisionError('The data of revision %d is truncated.' % revision.number)
+
+
+def _reconstruct(revision, base, max_size):
+    writer = ContentWriter(max_size)
+    try:
+        if revision.keyframe:
+            _decompress(revision, writer)
+        else:
+            _copy(base, writer, 0, revision.base_prefix)
+            _decompress(revision, writer)
+            base.seek(0, 2)
+            _copy(base, writer, base.tell() - revision.base_suffix, revision.base_suffix)
+        result = writer.result()
+    except BaseException:
+        writer.close()
+        raise
+    if result.content_info.sha256 != revision.sha256:
+        result.close()
+        raise RevisionError('Revision %d could not be reconstructed, its workflow may have been changed.'
+                            % revision.number)
+    return result
+
+
+def reconstruct_revision(revision, max_size=MAX_FILE_SIZE):
+    """
+    Reconstruct the content of the revision from the nearest newer keyframe or the current content,
+    by applying at most KEYFRAME_INTERVAL - 1 deltas.
+    :return: content (see delta.ContentWriter.result)
+    :raises RevisionError: if the content does not match the SHA-256 digest of the revision
+    """
+    chain = []
+    for newer in WorkflowRevision.objects.filter(
+            workflow_id=revision.workflow_id, number__gte=revision.number).order_by('number'):
+        if chain and newer.number != chain[-1].number + 1:
+            raise RevisionError('Revision %d is missing.' % (chain[-1].number + 1))
+        chain.append(newer)
+        if newer.keyframe:
+            break
+    if not chain or chain[0].number != revision.number:
+        raise RevisionError('Revision %d has been deleted.' % revision.number)
+    if chain[-1].keyframe:
+        content = None
+    else:
+        name = Workflow.objects.filter(pk=revision.workflow_id).values_list('content', flat=True).first()
+        try:
+            if not name:
+                raise FileNotFoundError(name)
+            content = Workflow._meta.get_field('content').storage.open(name, 'rb')
+        except OSError:  # e.g. replaced in the meantime
+            raise RevisionError('The current content of the workflow could not be read.')
+    try:
+        for newer in reversed(chain):
+            result = _reconstruct(newer, content, max_size)
+            if content is not None:
+                content.close()
+            content = result
+    except BaseException:
+        if content is not None:
+            content.close()
+        raise
+    return content
@@ -0,0 +1,65 @@
+import hashlib
+import json
+from functools import lru_cache
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.response import Response
+from rest_framework.schemas.views import SchemaView
+
+SCHEMA_TITLE = 'RehaGoal API'
+SCHEMA_VERSION = '2'
+
+
+def generate_schema():
+    """
+    Generate the OpenAPI schema of the API, by introspecting all views and serializers.
+    """
+    from rest_framework.schemas.openapi import SchemaGenerator
+    generator = SchemaGenerator(title=SCHEMA_TITLE, version=SCHEMA_VERSION)
+    return generator.get_schema(request=None, public=True)
+
+
+@lru_cache(maxsize=None)
+def get_schema():
+    """
+    Return the OpenAPI schema stored in settings.API_SCHEMA_FILE (see the generate_schema command),
+    or generate it once per process, if the file does not exist.
+    """
+    schema_file = getattr(settings, 'API_SCHEMA_FILE', None)
+    if schema_file:
+        try:
+            with open(schema_file, 'rb') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+    return generate_schema()
+
+
+@lru_cache(maxsize=None)
+def render_schema(renderer_class):
+    """
+    Return the schema rendered with the given renderer class and the ETag of the rendered content.
+    """
+    content = renderer_class().render(get_schema())
+    return content, quote_etag(hashlib.sha256(content).hexdigest())
+
+
+class CachedSchemaView(SchemaView):
+    """
+    SchemaView, which serves the schema rendered once per process (with ETag), instead of regenerating it
+    on every request. The schema is public, i.e. it is not filtered by the permissions of the requesting user.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if isinstance(request.accepted_renderer, BrowsableAPIRenderer):
+            return Response(get_schema())
+        content, etag = render_schema(type(request.accepted_renderer))
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(content, content_type=request.accepted_renderer.media_type)
+        response['ETag'] = etag
+        return response
@@ -1,5 +1,10 @@
+import time
+
 from rest_framework import serializers
-from .models import RehagoalUser, Workflow
+from rest_framework.reverse import reverse
+
+from . import signing
+from .models import ID_LENGTH, RehagoalUser, Workflow, WorkflowRevision
 from .validators import validate_workflow_content_size
 
 
@@ -33,10 +38,34 @@ class RehagoalUserSerializer(serializers.ModelSerializer):
         fields = ('id', 'username')
 
 
+class DownloadURLField(serializers.FileField):
+    """
+    Read-only representation of Workflow.content by a signed, expiring download URL (see signing.py),
+    or by the plain content URL if signed URLs are disabled.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super(DownloadURLField, self).__init__(**kwargs)
+
+    def to_representation(self, value):
+        url = super(DownloadURLField, self).to_representation(value)
+        if not url:
+            return url
+        workflow = value.instance
+        query = signing.signed_query(value.name, workflow.owner_id, workflow.sha256)
+        return url + '?' + query if query else url
+
+
 class WorkflowSerializer(serializers.ModelSerializer):
     id = serializers.ReadOnlyField()
     owner = serializers.HyperlinkedRelatedField(read_only=True, view_name='rehagoaluser-detail')
     content = serializers.FileField(validators=[validate_workflow_content_size])
+    download_url = DownloadURLField(source='content')
+    sha256 = serializers.ReadOnlyField()
+    name = serializers.ReadOnlyField()
+    task_count = serializers.ReadOnlyField()
+    size = serializers.ReadOnlyField()
 
     def __init__(self, *args, **kwargs):
         many = kwargs.pop('many', True)
@@ -44,4 +73,70 @@ class WorkflowSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Workflow
-        fields = ('id', 'owner', 'content')
+        fields = ('id', 'owner', 'content', 'download_url', 'sha256', 'name', 'task_count', 'size')
+
+
+class WorkflowListSerializer(object):
+    """
+    Fast, read-only equivalent of WorkflowSerializer for lists of workflows, which produces the same representation
+    from rows of Workflow.objects.values(*WorkflowListSerializer.values). The URLs of owners and contents are
+    built from templates computed once per request, instead of reversing and building absolute URLs per row.
+    """
+    values = ('id', 'owner_id', 'content', 'sha256', 'name', 'task_count', 'size')
+    # Valid ID and content file name, which is replaced by the actual ones in the URL templates
+    placeholder = 'X' * 12
+
+    def __init__(self, request):
+        owner_url = reverse('rehagoaluser-detail', kwargs={'pk': self.placeholder}, request=request)
+        self.owner_url = owner_url.split(self.placeholder)
+        storage = Workflow._meta.get_field('content').storage
+        content_url = request.build_absolute_uri(storage.url(self.placeholder))
+        self.content_url = content_url.split(self.placeholder)
+
+    @staticmethod
+    def supports(request, format_kwarg=None):
+        """
+        Whether the URL templates can be used for the given request (format suffixes are added to hyperlinks).
+        """
+        return format_kwarg is None and getattr(request, 'version', None) is None
+
+    def to_representation(self, rows):
+        owner_prefix, owner_suffix = self.owner_url
+        content_prefix, content_suffix = self.content_url
+        now = time.time()
+        data = []
+        for row in rows:
+            name = row['content']
+            if name:
+                content = content_prefix + name + content_suffix
+                query = signing.signed_query(name, row['owner_id'], row['sha256'], now=now)
+                download_url = content + '?' + query if query else content
+            else:
+                content = download_url = None
+            data.append({
+                'id': row['id'],
+                'owner': owner_prefix + row['owner_id'] + owner_suffix,
+                'content': content,
+                'download_url': download_url,
+                'sha256': row['sha256'],
+                'name': row['name'],
+                'task_count': row['task_count'],
+                'size': row['size'],
+            })
+        return data
+
+
+class WorkflowRevisionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = WorkflowRevision
+        fields = ('number', 'created', 'sha256', 'size', 'name', 'task_count')
+        read_only_fields = fields
+
+
+class WorkflowPrecheckSerializer(serializers.Serializer):
+    """
+    Item of a pre-check of workflow uploads (see WorkflowViewSet.precheck): the SHA-256 digest of the content,
+    and the ID of the workflow to update (omitted to create a new workflow).
+    """
+    sha256 = serializers.RegexField(r'^[0-9a-f]{64}$')
+    id = serializers.CharField(required=False, max_length=ID_LENGTH)
@@ -0,0 +1,98 @@
+"""
+Signed, expiring download URLs of workflow contents.
+
+The signature covers the name of the content file, the owner and the SHA-256 digest of the workflow, and the expiry
+time, so that the download view can verify access and answer conditional requests without any database query.
+Expiry times are rounded up to multiples of the maximum age, so that all URLs issued for a content within the same
+period are identical, which allows clients to reuse cached downloads.
+"""
+import base64
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signing import BadSignature, SignatureExpired
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+#: Default validity (seconds) of signed download URLs, see settings.WORKFLOW_DOWNLOAD_URL_MAX_AGE
+DEFAULT_MAX_AGE = 60 * 60
+#: Query parameters of signed download URLs
+EXPIRES_PARAM = 'expires'
+OWNER_PARAM = 'owner'
+SHA256_PARAM = 'sha256'
+SIGNATURE_PARAM = 'signature'
+SALT = 'rehagoal_server_app.signing.download'
+
+
+def get_max_age():
+    """
+    Validity of signed download URLs in seconds, None if signed URLs are disabled.
+    """
+    return getattr(settings, 'WORKFLOW_DOWNLOAD_URL_MAX_AGE', DEFAULT_MAX_AGE)
+
+
+@lru_cache(maxsize=4)
+def get_hmac(secret_key):
+    """
+    HMAC keyed by the secret key, which is copied for every signature instead of deriving the key again.
+    """
+    return salted_hmac(SALT, '', secret=secret_key, algorithm='sha256')
+
+
+def get_signature(name, owner_id, sha256, expires):
+    mac = get_hmac(settings.SECRET_KEY).copy()
+    mac.update(('%s:%s:%s:%d' % (name, owner_id, sha256, expires)).encode())
+    return base64.urlsafe_b64encode(mac.digest()).rstrip(b'=').decode()
+
+
+def signed_query(name, owner_id, sha256, now=None):
+    """
+    Return the query string (without '?') granting access to the content file with the given name,
+    or an empty string if signed URLs are disabled.
+    The URL is valid for at least the maximum age, but less than twice the maximum age.
+    """
+    max_age = get_max_age()
+    if not max_age:
+        return ''
+    now = time.time() if now is None else now
+    expires = (int(now) // max_age + 2) * max_age
+    # All values are URL-safe (owner IDs are slugs, digests are hexadecimal, signatures URL-safe base64),
+    # formatting them directly is much faster than urlencode(), which matters for workflow lists
+    return '%s=%d&%s=%s&%s=%s&%s=%s' % (
+        EXPIRES_PARAM, expires,
+        OWNER_PARAM, owner_id,
+        SHA256_PARAM, sha256 or '',
+        SIGNATURE_PARAM, get_signature(name, owner_id, sha256 or '', expires),
+    )
+
+
+def is_signed(params):
+    """
+    Whether the given query parameters contain a download signature.
+    """
+    return SIGNATURE_PARAM in params
+
+
+def verify(name, params, now=None):
+    """
+    Verify the signature of a download URL of the content file with the given name.
+    :param params: query parameters of the URL
+    :return: (sha256, expires) of the signed URL, sha256 is an empty string if the workflow has no digest
+    :raises BadSignature: if the signature is missing or invalid
+    :raises SignatureExpired: if the URL has expired
+    """
+    if not get_max_age():
+        raise BadSignature('Signed download URLs are disabled')
+    try:
+        expires = int(params[EXPIRES_PARAM])
+        owner_id = params[OWNER_PARAM]
+        sha256 = params[SHA256_PARAM]
+        signature = params[SIGNATURE_PARAM]
+    except (KeyError, ValueError):
+        raise BadSignature('Incomplete download signature')
+    if not constant_time_compare(signature, get_signature(name, owner_id, sha256, expires)):
+        raise BadSignature('Download signature does not match')
+    now = time.time() if now is None else now
+    if expires <= now:
+        raise SignatureExpired('Download URL expired')
+    return sha256, expires
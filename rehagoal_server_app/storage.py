@@ -0,0 +1,32 @@
+"""
+Private storage of the workflow contents and revisions.
+
+Like private_storage.storage.private_storage, but its location follows settings.PRIVATE_STORAGE_ROOT when the setting
+changes (e.g. by override_settings in the tests), while the location of the former is fixed when it is imported.
+"""
+from django.conf import settings
+from django.utils.deconstruct import deconstructible
+from django.utils.functional import cached_property
+from private_storage.storage.files import PrivateFileSystemStorage
+
+
+# Deconstructed like the storage it replaces, which does not change the migrations
+@deconstructible(path='private_storage.storage.files.PrivateFileSystemStorage')
+class PrivateStorage(PrivateFileSystemStorage):
+
+    def __init__(self, location=None, base_url=None, **kwargs):
+        super(PrivateStorage, self).__init__(location=location, base_url=base_url, **kwargs)
+        self._location = location  # resolved by base_location instead
+
+    def _clear_cached_properties(self, setting, **kwargs):
+        super(PrivateStorage, self)._clear_cached_properties(setting, **kwargs)
+        if setting == 'PRIVATE_STORAGE_ROOT':
+            self.__dict__.pop('base_location', None)
+            self.__dict__.pop('location', None)
+
+    @cached_property
+    def base_location(self):
+        return self._value_or_setting(self._location, settings.PRIVATE_STORAGE_ROOT)
+
+
+private_storage = PrivateStorage()
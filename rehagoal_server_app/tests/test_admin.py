@@ -0,0 +1,206 @@
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from ..admin import EstimatedCountPaginator, UserAdmin
+from ..models import RehagoalUser, Workflow
+
+
+class WorkflowBulkDeleteTestCase(TestCase):
+    """
+    Tests bulk deletion of workflows (WorkflowQuerySet.bulk_delete) and its use in the admin interface.
+    """
+
+    def setUp(self):
+        self.admin_password = "adminpassword"
+        self.admin = User.objects.create_superuser("superadmin", "superadmin@localhost", self.admin_password)
+        self.owner = User.objects.create_user("owner", password="ownerpassword")
+        self.other = User.objects.create_user("other", password="otherpassword")
+        for user, count in ((self.owner, 3), (self.other, 1)):
+            for i in range(count):
+                Workflow.objects.create(
+                    owner=user.rehagoal_user,
+                    content=ContentFile(b"content %d" % i, name="upload")
+                )
+        self.owned_files = list(Workflow.objects.filter(owner__user=self.owner).values_list("content", flat=True))
+        self.storage = Workflow._meta.get_field("content").storage
+
+    def tearDown(self):
+        super(WorkflowBulkDeleteTestCase, self).tearDown()
+        Workflow.objects.all().delete()
+
+    def assertOwnedWorkflowsDeleted(self):
+        self.assertFalse(Workflow.objects.filter(owner__user=self.owner).exists())
+        for name in self.owned_files:
+            self.assertFalse(self.storage.exists(name), "Workflow content file should have been deleted")
+        self.assertEqual(Workflow.objects.filter(owner__user=self.other).count(), 1)
+
+    def test_bulk_delete(self):
+        """
+        Should delete workflow rows and their content files, but only after commit.
+        """
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            deleted = Workflow.objects.filter(owner__user=self.owner).bulk_delete()
+        self.assertEqual(deleted, 3)
+        self.assertFalse(Workflow.objects.filter(owner__user=self.owner).exists())
+        for name in self.owned_files:
+            self.assertTrue(self.storage.exists(name), "Content files should be kept until commit")
+        for callback in callbacks:
+            callback()
+        self.assertOwnedWorkflowsDeleted()
+
+    def test_bulk_delete_sliced(self):
+        """
+        Should refuse bulk deletion of sliced querysets.
+        """
+
+        with self.assertRaises(TypeError):
+            Workflow.objects.all()[:1].bulk_delete()
+
+    def test_admin_delete_user(self):
+        """
+        Should delete the owned workflows when deleting a user in the admin interface.
+        """
+
+        self.client.login(username=self.admin.username, password=self.admin_password)
+        with self.captureOnCommitCallbacks(execute=True):
+            r = self.client.post("/admin/auth/user/%d/delete/" % self.owner.id, {"post": "yes"})
+        self.assertEqual(r.status_code, 302)
+        self.assertFalse(User.objects.filter(id=self.owner.id).exists())
+        self.assertFalse(RehagoalUser.objects.filter(user_id=self.owner.id).exists())
+        self.assertOwnedWorkflowsDeleted()
+
+    def test_admin_delete_selected_workflows(self):
+        """
+        Should bulk delete workflows selected in the admin interface.
+        """
+
+        self.client.login(username=self.admin.username, password=self.admin_password)
+        with self.captureOnCommitCallbacks(execute=True):
+            r = self.client.post("/admin/rehagoal_server_app/workflow/", {
+                "action": "delete_selected",
+                "_selected_action": Workflow.objects.filter(owner__user=self.owner).values_list("id", flat=True),
+                "post": "yes",
+            })
+        self.assertEqual(r.status_code, 302)
+        self.assertOwnedWorkflowsDeleted()
+
+    def test_admin_delete_confirmation_summary(self):
+        """
+        Should only summarize the number of related workflows, if there are too many to list.
+        """
+
+        self.client.login(username=self.admin.username, password=self.admin_password)
+        with mock.patch.object(UserAdmin, "max_listed_workflows", 1):
+            r = self.client.get("/admin/auth/user/%d/delete/" % self.owner.id)
+        self.assertEqual(r.status_code, 200)
+        self.assertContains(r, "3 workflows")
+        for workflow_id in Workflow.objects.filter(owner__user=self.owner).values_list("id", flat=True):
+            self.assertNotContains(r, workflow_id)
+        # The other related objects are still listed
+        self.assertContains(r, "/admin/rehagoal_server_app/rehagoaluser/%s/change/" % self.owner.rehagoal_user.id)
+
+    def test_admin_delete_selected_confirmation_summary_queries(self):
+        """
+        Should count the related workflows of all selected objects at once, instead of per object.
+        """
+
+        self.client.login(username=self.admin.username, password=self.admin_password)
+
+        def count_confirmation_queries(users):
+            with mock.patch.object(UserAdmin, "max_listed_workflows", 1), \
+                    CaptureQueriesContext(connection) as queries:
+                r = self.client.post("/admin/auth/user/", {
+                    "action": "delete_selected",
+                    "_selected_action": [user.id for user in users],
+                })
+            self.assertEqual(r.status_code, 200)
+            self.assertContains(r, "3 workflows")
+            return len(queries)
+
+        expected_queries = count_confirmation_queries([self.owner])
+        self.assertEqual(count_confirmation_queries([self.owner, self.other]), expected_queries)
+
+
+class AdminChangelistTestCase(TestCase):
+    """
+    Tests the changelists of the Workflow and RehagoalUser admin.
+    """
+
+    def setUp(self):
+        self.admin_password = "adminpassword"
+        self.admin = User.objects.create_superuser("superadmin", "superadmin@localhost", self.admin_password)
+        self.client.login(username=self.admin.username, password=self.admin_password)
+
+    def tearDown(self):
+        super(AdminChangelistTestCase, self).tearDown()
+        Workflow.objects.all().delete()
+
+    def create_workflows(self, count):
+        for i in range(count):
+            user = User.objects.create_user("user%d" % User.objects.count(), password="password")
+            Workflow.objects.create(owner=user.rehagoal_user, content=ContentFile(b"content", name="upload"))
+
+    def count_changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        return len(queries)
+
+    def test_changelist_queries_constant(self):
+        """
+        Should not issue additional queries per listed row.
+        """
+
+        for url in ("/admin/rehagoal_server_app/workflow/", "/admin/rehagoal_server_app/rehagoaluser/"):
+            self.create_workflows(2)
+            expected_queries = self.count_changelist_queries(url)
+            self.create_workflows(3)
+            self.assertEqual(self.count_changelist_queries(url), expected_queries)
+
+    def test_changelist_search_owner(self):
+        """
+        Should find workflows by the username prefix of their owner.
+        """
+
+        self.create_workflows(2)
+        workflow = Workflow.objects.select_related("owner__user").first()
+        r = self.client.get("/admin/rehagoal_server_app/workflow/", {"q": workflow.owner.user.username})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(list(r.context["cl"].result_list), [workflow])
+
+    @skipUnless(connection.vendor == "sqlite", "Requires SQLite query plans")
+    def test_changelist_search_uses_index(self):
+        """
+        Should search the username prefix with the unique username index, instead of scanning the table.
+        """
+
+        self.create_workflows(2)
+        for url in ("/admin/rehagoal_server_app/workflow/", "/admin/rehagoal_server_app/rehagoaluser/"):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url, {"q": "user1"}).status_code, 200)
+            sql = next(query["sql"] for query in queries if '"username" >=' in query["sql"])
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+                plan = [row[-1] for row in cursor.fetchall()]
+            self.assertIn("USING COVERING INDEX sqlite_autoindex_auth_user_1 (username>? AND username<?)",
+                          " ".join(plan))
+            self.assertFalse([step for step in plan if step.startswith("SCAN")], plan)
+
+    @skipUnless(connection.vendor == "sqlite", "Requires SQLite table statistics")
+    def test_paginator_estimated_count(self):
+        """
+        Should use the table statistics for large unfiltered querysets, and count filtered querysets.
+        """
+
+        self.create_workflows(2)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+            cursor.execute("UPDATE sqlite_stat1 SET stat = '50000 1' WHERE tbl = %s", [Workflow._meta.db_table])
+        self.assertEqual(EstimatedCountPaginator(Workflow.objects.all(), 10).count, 50000)
+        self.assertEqual(EstimatedCountPaginator(Workflow.objects.filter(id__startswith=""), 10).count, 2)
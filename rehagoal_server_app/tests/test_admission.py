@@ -0,0 +1,167 @@
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..admission import AdmissionController
+from ..models import Workflow
+
+
+class AdmissionControllerTestCase(SimpleTestCase):
+    """
+    Tests the concurrency limits and token buckets of the admission control (admission.py).
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'admission.sqlite3')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def controller(self, **kwargs):
+        return AdmissionController(self.path, **kwargs)
+
+    def test_concurrent_transfers(self):
+        controller = self.controller(max_concurrent_transfers=2)
+        first, _ = controller.acquire('user')
+        second, _ = controller.acquire('user')
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertEqual(controller.acquire('user'), (None, 1))
+        self.assertIsNotNone(controller.acquire('other')[0])
+        controller.release(first)
+        self.assertIsNotNone(controller.acquire('user')[0])
+
+    def test_shared_state(self):
+        # Controllers of different worker processes share the database
+        self.assertIsNotNone(self.controller(max_concurrent_transfers=1).acquire('user')[0])
+        self.assertIsNone(self.controller(max_concurrent_transfers=1).acquire('user')[0])
+
+    def test_transfers_of_dead_processes_released(self):
+        controller = self.controller(max_concurrent_transfers=1)
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        controller.connection.execute('INSERT INTO lease (key, pid) VALUES (?, ?)', ('user', process.pid))
+        self.assertIsNotNone(controller.acquire('user')[0])
+        self.assertIsNone(controller.acquire('user')[0])
+
+    def test_request_rate(self):
+        controller = self.controller(request_rate=0.5, request_burst=2)
+        for _ in range(2):
+            lease, _ = controller.acquire('user')
+            controller.release(lease)
+        lease, retry_after = controller.acquire('user')
+        self.assertIsNone(lease)
+        self.assertEqual(retry_after, 2)
+        self.assertIsNotNone(controller.acquire('other')[0])
+
+    def test_byte_rate(self):
+        controller = self.controller(byte_rate=100, byte_burst=1000)
+        self.assertIsNotNone(controller.acquire('user', 800)[0])
+        lease, retry_after = controller.acquire('user', 500)
+        self.assertIsNone(lease)
+        self.assertEqual(retry_after, 3)
+        self.assertIsNotNone(controller.acquire('user', 100)[0])
+
+    def test_transfer_larger_than_burst(self):
+        controller = self.controller(byte_rate=100, byte_burst=1000)
+        self.assertIsNotNone(controller.acquire('user', 5000)[0])
+        self.assertIsNone(controller.acquire('user', 1)[0])
+
+    def test_rejected_transfer_not_charged(self):
+        controller = self.controller(max_concurrent_transfers=1, request_rate=0.01, request_burst=2)
+        lease, _ = controller.acquire('user')
+        self.assertIsNone(controller.acquire('user')[0])
+        controller.release(lease)
+        self.assertIsNotNone(controller.acquire('user')[0])
+
+
+class TransferThrottleTestCase(APIAuthTestCase):
+    """
+    Tests the admission control of workflow uploads and downloads.
+    """
+
+    def setUp(self):
+        super(TransferThrottleTestCase, self).setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.controller = AdmissionController(os.path.join(self.directory.name, 'admission.sqlite3'),
+                                              max_concurrent_transfers=1, byte_rate=1, byte_burst=100)
+        patcher = mock.patch('rehagoal_server_app.admission.admission_controller', self.controller)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super(TransferThrottleTestCase, self).tearDown()
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().delete()
+        self.directory.cleanup()
+
+    def upload(self):
+        return self.client.post(API_ROOT + "workflows/", {"content": ContentFile(b"new", name="upload")})
+
+    def test_upload_concurrency(self):
+        lease, _ = self.controller.acquire('user:%s' % self.rehagoal_user.id)
+        r = self.upload()
+        self.assertEqual(r.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(r["Retry-After"], "1")
+        self.assertFalse(Workflow.objects.exists())
+        self.controller.release(lease)
+        self.assertEqual(self.upload().status_code, status.HTTP_201_CREATED)
+
+    def test_transfer_released(self):
+        self.controller.buckets = []  # no rate limits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.upload().status_code, status.HTTP_201_CREATED)
+        workflow = Workflow.objects.get()
+        r = self.client.get(API_ROOT + "files/%s" % workflow.content.name)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(b"".join(r), b"new")
+        self.assertEqual(self.controller.connection.execute('SELECT COUNT(*) FROM lease').fetchone()[0], 0)
+
+    def test_transfer_released_on_uncaught_exception(self):
+        self.controller.buckets = []  # no rate limits
+        with mock.patch('rehagoal_server_app.api.WorkflowViewSet.perform_create', side_effect=OSError):
+            with self.assertRaises(OSError):
+                self.upload()
+        self.assertEqual(self.controller.connection.execute('SELECT COUNT(*) FROM lease').fetchone()[0], 0)
+        self.assertEqual(self.upload().status_code, status.HTTP_201_CREATED)
+
+    def test_byte_rate(self):
+        # The upload (Content-Length) exceeds the burst and empties the bucket
+        self.assertEqual(self.upload().status_code, status.HTTP_201_CREATED)
+        r = self.upload()
+        self.assertEqual(r.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreater(int(r["Retry-After"]), 1)
+
+    def test_other_requests_not_throttled(self):
+        lease, _ = self.controller.acquire('user:%s' % self.rehagoal_user.id)
+        self.assertEqual(self.client.get(API_ROOT + "workflows/").status_code, status.HTTP_200_OK)
+        self.controller.release(lease)
+
+    def test_throttled_per_user(self):
+        self.controller.acquire('user:%s' % self.rehagoal_user.id)
+        self.auth(self.regular_user2)
+        self.assertEqual(self.upload().status_code, status.HTTP_201_CREATED)
+
+    def test_signed_download_throttled_per_owner(self):
+        self.controller.buckets = []  # no rate limits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload()
+        url = self.client.get(API_ROOT + "workflows/%s/" % Workflow.objects.get().id).data["download_url"]
+        self.auth()
+        lease, _ = self.controller.acquire('user:%s' % self.rehagoal_user.id)
+        # The client address can be chosen by the client
+        r = self.client.get(url, HTTP_X_FORWARDED_FOR="192.0.2.1", REMOTE_ADDR="192.0.2.2")
+        self.assertEqual(r.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.controller.release(lease)
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        r.close()
+        self.assertEqual(self.controller.connection.execute('SELECT COUNT(*) FROM lease').fetchone()[0], 0)
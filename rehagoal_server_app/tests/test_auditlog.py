@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..auditlog import LOGGER_NAME, JSONLinesFormatter, QueuedRotatingFileHandler
+from ..models import Workflow
+
+
+class QueuedRotatingFileHandlerTestCase(SimpleTestCase):
+    """
+    Tests the queued JSON lines handler of the audit log (auditlog.py).
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'logs', 'audit.jsonl')
+        self.logger = logging.getLogger('rehagoal_server_app.tests.audit')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+        self.directory.cleanup()
+
+    def handler(self, **kwargs):
+        handler = QueuedRotatingFileHandler(self.filename, **kwargs)
+        handler.setFormatter(JSONLinesFormatter())
+        self.logger.addHandler(handler)
+        return handler
+
+    def read(self, filename=None):
+        with open(filename or self.filename) as f:
+            return [json.loads(line) for line in f]
+
+    def test_json_lines(self):
+        handler = self.handler()
+        self.logger.info("workflow.create", extra={'audit': {'event': 'workflow.create', 'user': 1}})
+        self.logger.info("line\nbreak")
+        handler.flush()
+        first, second = self.read()
+        self.assertEqual(first['message'], 'workflow.create')
+        self.assertEqual(first['user'], 1)
+        self.assertEqual(first['level'], 'INFO')
+        self.assertIn('time', first)
+        self.assertEqual(second['message'], 'line\nbreak')
+
+    def test_close_writes_queued_records(self):
+        handler = self.handler()
+        for i in range(100):
+            self.logger.info("record %d", i)
+        self.logger.removeHandler(handler)
+        handler.close()
+        self.assertEqual([entry['message'] for entry in self.read()], ["record %d" % i for i in range(100)])
+
+    def test_rotation(self):
+        handler = self.handler(max_bytes=1000, backup_count=2)
+        for i in range(60):
+            self.logger.info("record %d", i)
+            handler.flush()
+        for filename in (self.filename, self.filename + '.1', self.filename + '.2'):
+            self.assertLessEqual(os.path.getsize(filename), 1000)
+        self.assertFalse(os.path.exists(self.filename + '.3'))
+        self.assertEqual(self.read()[-1]['message'], "record 59")
+
+    def test_rotated_by_other_process(self):
+        handler = self.handler()
+        self.logger.info("before")
+        handler.flush()
+        os.replace(self.filename, self.filename + '.1')
+        self.logger.info("after")
+        handler.flush()
+        self.assertEqual([entry['message'] for entry in self.read()], ["after"])
+
+    def test_slow_disk_does_not_block(self):
+        handler = self.handler(queue_size=10)
+        written = threading.Event()
+        write = handler._write
+
+        def slow_write(data):
+            written.wait(5)
+            write(data)
+
+        handler._write = slow_write
+        for i in range(100):
+            self.logger.info("record %d", i)
+        self.assertGreater(handler.dropped, 0)
+        written.set()
+        handler.flush()
+        self.logger.info("last")
+        handler.flush()
+        messages = [entry['message'] for entry in self.read()]
+        self.assertEqual(messages[0], "record 0")
+        self.assertTrue(any(message.endswith("record(s) dropped, the log queue was full") for message in messages))
+        self.assertEqual(messages[-1], "last")
+
+
+class AuditLogTestCase(APIAuthTestCase):
+    """
+    Tests the audit log records of the workflow API and content downloads.
+    """
+
+    def tearDown(self):
+        super(AuditLogTestCase, self).tearDown()
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().delete()
+
+    def records(self, logs):
+        return [record.audit for record in logs.records]
+
+    def test_workflow_events(self):
+        user_id = self.rehagoal_user.user_id
+        with self.assertLogs(LOGGER_NAME, logging.INFO) as logs:
+            r = self.client.post(API_ROOT + "workflows/", {"content": ContentFile(b"new", name="upload")})
+            self.assertEqual(r.status_code, status.HTTP_201_CREATED)
+            workflow_id = r.data["id"]
+            self.client.get(API_ROOT + "workflows/%s/" % workflow_id)
+            self.client.delete(API_ROOT + "workflows/%s/" % workflow_id)
+        create, retrieve, destroy = self.records(logs)
+        self.assertEqual(create['event'], 'workflow.create')
+        self.assertEqual((create['user'], create['workflow'], create['status']), (user_id, workflow_id, 201))
+        self.assertEqual((create['sha256'], create['size']), (r.data['sha256'], 3))
+        self.assertGreater(create['duration_ms'], 0)
+        self.assertEqual((retrieve['event'], retrieve['workflow'], retrieve['status']),
+                         ('workflow.retrieve', workflow_id, 200))
+        self.assertEqual((destroy['event'], destroy['method'], destroy['status']), ('workflow.destroy', 'DELETE', 204))
+
+    def test_unauthenticated(self):
+        self.auth()
+        with self.assertLogs(LOGGER_NAME, logging.INFO) as logs:
+            self.client.get(API_ROOT + "workflows/")
+        record, = self.records(logs)
+        self.assertEqual((record['event'], record['user'], record['status']), ('workflow.list', None, 403))
+
+    def test_signed_download(self):
+        workflow = Workflow.objects.create(owner=self.rehagoal_user, content=ContentFile(b"content", name="upload"))
+        url = self.client.get(API_ROOT + "workflows/%s/" % workflow.id).data["download_url"]
+        self.auth()
+        with self.assertLogs(LOGGER_NAME, logging.INFO) as logs:
+            with self.assertNumQueries(0):
+                r = self.client.get(url)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        record, = self.records(logs)
+        self.assertEqual(record['event'], 'content.get')
+        self.assertEqual(record['path'], API_ROOT + "files/%s" % workflow.content.name)
+        self.assertEqual((record['content'], record['signed'], record['owner'], record['user'], record['bytes']),
+                         (workflow.content.name, True, self.rehagoal_user.id, None, 7))
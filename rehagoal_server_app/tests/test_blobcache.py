@@ -0,0 +1,112 @@
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..blobcache import BlobCache, blob_cache
+from ..models import Workflow
+
+
+class BlobCacheTestCase(SimpleTestCase):
+    """
+    Tests the size-limited LRU cache of workflow contents.
+    """
+
+    def test_lru_eviction(self):
+        """
+        Should evict the least recently used entries, once the total size is exceeded.
+        """
+        cache = BlobCache(max_size=10, max_entry_size=5)
+        cache.set("a", b"aaaa", 1.0)
+        cache.set("b", b"bbbb", 2.0)
+        self.assertEqual(cache.get("a").content, b"aaaa")
+        cache.set("c", b"cccc", 3.0)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a").modified_time, 1.0)
+        self.assertEqual(cache.get("c").content, b"cccc")
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["size"], 8)
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_max_entry_size(self):
+        """
+        Should not cache contents larger than the maximum entry size.
+        """
+        cache = BlobCache(max_size=10, max_entry_size=5)
+        self.assertFalse(cache.accepts(6))
+        cache.set("a", b"aaaaaa", 1.0)
+        self.assertIsNone(cache.get("a"))
+        self.assertFalse(BlobCache(max_size=0, max_entry_size=5).accepts(1))
+
+    def test_delete(self):
+        """
+        Should remove deleted entries and their size.
+        """
+        cache = BlobCache(max_size=10, max_entry_size=5)
+        cache.set("a", b"aaaa", 1.0)
+        cache.set("b", b"bbbb", 2.0)
+        cache.delete_many(["a", "unknown"])
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["size"], 4)
+
+
+class BlobCacheDownloadTestCase(APIAuthTestCase):
+    """
+    Tests downloads of workflow contents through the blob cache.
+    """
+
+    def setUp(self):
+        super(BlobCacheDownloadTestCase, self).setUp()
+        blob_cache.clear()
+        self.addCleanup(blob_cache.clear)
+        self.workflow = Workflow.objects.create(
+            owner=self.rehagoal_user, content=ContentFile(b'{"name":"cached"}', name="upload"))
+
+    def tearDown(self):
+        super(BlobCacheDownloadTestCase, self).tearDown()
+        Workflow.objects.all().delete()
+
+    def download(self):
+        r = self.client.get(self.workflow.content.url)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(r.getvalue(), b'{"name":"cached"}')
+        return r
+
+    def test_download_cached(self):
+        """
+        Should serve repeated downloads from the cache, with the same headers.
+        """
+        first = self.download()
+        second = self.download()
+        self.assertEqual(blob_cache.stats()["hits"], 1)
+        self.assertEqual(blob_cache.stats()["misses"], 1)
+        for header in ("Content-Type", "Content-Length", "Content-Disposition", "Last-Modified", "ETag",
+                       "Cache-Control"):
+            self.assertEqual(first[header], second[header])
+        r = self.client.get(self.workflow.content.url, HTTP_IF_MODIFIED_SINCE=second["Last-Modified"])
+        self.assertEqual(r.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_delete_invalidates(self):
+        """
+        Should remove the content from the cache, when the workflow is deleted.
+        """
+        self.download()
+        name = self.workflow.content.name
+        self.assertIsNotNone(blob_cache.get(name))
+        self.workflow.delete()
+        self.assertIsNone(blob_cache.get(name))
+
+    def test_stats_staff_only(self):
+        """
+        Should expose the cache counters to staff users only.
+        """
+        self.download()
+        r = self.client.get(API_ROOT + "blob-cache/")
+        self.assertEqual(r.status_code, status.HTTP_403_FORBIDDEN)
+        self.auth(self.staff_user)
+        r = self.client.get(API_ROOT + "blob-cache/")
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(r.data["entries"], 1)
+        self.assertEqual(r.data["misses"], 1)
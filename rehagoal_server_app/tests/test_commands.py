@@ -0,0 +1,435 @@
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+
+from .. import archive
+from ..management.commands.export_workflows import Command as ExportCommand
+from ..models import RehagoalUser, Workflow, WorkflowRevision
+
+
+class VerifyWorkflowsCommandTestCase(TestCase):
+    """
+    Tests the verify_workflows management command.
+    """
+
+    def setUp(self):
+        owner = User.objects.create_user("owner", password="ownerpassword").rehagoal_user
+        self.workflows = [
+            Workflow.objects.create(owner=owner, content=ContentFile(b"content %d" % i, name="upload"))
+            for i in range(3)
+        ]
+        self.storage = Workflow._meta.get_field("content").storage
+
+    def tearDown(self):
+        super(VerifyWorkflowsCommandTestCase, self).tearDown()
+        Workflow.objects.all().delete()
+
+    def verify(self, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command("verify_workflows", *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_verify_all(self):
+        """
+        Should verify all workflows and mark them as verified.
+        """
+
+        stdout, stderr = self.verify()
+        self.assertIn("Verified 3 workflow(s), 0 corrupted", stdout)
+        self.assertEqual(stderr, "")
+        self.assertFalse(Workflow.objects.filter(content_verified=None).exists())
+
+    def test_verify_incremental(self):
+        """
+        Should verify the workflows which have not been verified for the longest time first.
+        """
+
+        self.verify("--limit", "2")
+        self.assertEqual(Workflow.objects.filter(content_verified=None).count(), 1)
+        unverified = Workflow.objects.get(content_verified=None)
+        self.verify("--limit", "1")
+        self.assertIsNotNone(Workflow.objects.get(id=unverified.id).content_verified)
+
+    def test_verify_missing_digest(self):
+        """
+        Should compute and store missing digests and metadata.
+        """
+
+        Workflow.objects.update(sha256="", size=None)
+        self.verify()
+        for workflow in Workflow.objects.all():
+            with workflow.content as content_file:
+                content = content_file.read()
+                self.assertEqual(workflow.sha256, hashlib.sha256(content).hexdigest())
+                self.assertEqual(workflow.size, len(content))
+
+    def test_verify_corrupted(self):
+        """
+        Should report corrupted and missing content files.
+        """
+
+        corrupted, missing = self.workflows[:2]
+        with open(self.storage.path(corrupted.content.name), "wb") as content_file:
+            content_file.write(b"corrupted")
+        self.storage.delete(missing.content.name)
+        with self.assertRaises(CommandError):
+            self.verify()
+        self.assertEqual(Workflow.objects.get(id=corrupted.id).sha256, corrupted.sha256)
+
+
+class PurgeSessionsCommandTestCase(TestCase):
+    """
+    Tests the purge_sessions management command.
+    """
+
+    def test_purge_expired(self):
+        """
+        Should delete expired sessions in batches, and keep valid ones.
+        """
+
+        now = timezone.now()
+        for i in range(5):
+            Session.objects.create(session_key="expired%d" % i, session_data="", expire_date=now - timedelta(days=1))
+        Session.objects.create(session_key="valid", session_data="", expire_date=now + timedelta(days=1))
+        stdout = StringIO()
+        call_command("purge_sessions", "--batch-size", "2", stdout=stdout)
+        self.assertIn("Deleted 5 expired session(s).", stdout.getvalue())
+        self.assertEqual(list(Session.objects.values_list("session_key", flat=True)), ["valid"])
+
+
+class ExportWorkflowsCommandTestCase(TestCase):
+    """
+    Tests the export_workflows management command.
+    """
+
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="ownerpassword").rehagoal_user
+        self.other = User.objects.create_user("other", password="otherpassword").rehagoal_user
+        self.workflows = [
+            Workflow.objects.create(owner=owner, content=ContentFile(b"content %d" % i, name="upload"))
+            for i, owner in enumerate((self.owner, self.owner, self.other))
+        ]
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        super(ExportWorkflowsCommandTestCase, self).tearDown()
+        Workflow.objects.all().delete()
+        self.directory.cleanup()
+
+    def export(self, *args, name="export.tar"):
+        path = os.path.join(self.directory.name, name)
+        stdout = StringIO()
+        call_command("export_workflows", path, "--read-ahead", "2", *args, stdout=stdout, stderr=StringIO())
+        with tarfile.open(path) as tar:
+            members = {member.name: tar.extractfile(member).read() for member in tar.getmembers()}
+        return path, members, stdout.getvalue()
+
+    @staticmethod
+    def rows(members, name):
+        return [json.loads(line) for line in members[name].splitlines()]
+
+    def test_export_all(self):
+        _, members, stdout = self.export()
+        self.assertIn("Exported 2 user(s) and 3 workflow(s) with 3 content(s)", stdout)
+        self.assertEqual(json.loads(members[archive.SNAPSHOT_MEMBER])["version"], archive.FORMAT_VERSION)
+        self.assertCountEqual([row["username"] for row in self.rows(members, archive.USERS_MEMBER)], ["owner", "other"])
+        workflows = {row["id"]: row for row in self.rows(members, archive.WORKFLOWS_MEMBER)}
+        for workflow in self.workflows:
+            self.assertEqual(workflows[workflow.id]["sha256"], workflow.sha256)
+            self.assertEqual(workflows[workflow.id]["owner_id"], workflow.owner_id)
+            with workflow.content.open("rb") as f:
+                self.assertEqual(members[archive.content_member(workflow.content.name)], f.read())
+
+    def test_export_owner_compressed(self):
+        # Larger contents are streamed from the opened file
+        with patch("rehagoal_server_app.management.commands.export_workflows.INLINE_SIZE", 4):
+            _, members, _ = self.export("--owner", "other", "--compression", "gz", name="export.tar.gz")
+        self.assertEqual([row["id"] for row in self.rows(members, archive.WORKFLOWS_MEMBER)], [self.workflows[2].id])
+        contents = {name: data for name, data in members.items() if name.startswith(archive.CONTENTS_PREFIX)}
+        self.assertEqual(list(contents.values()), [b"content 2"])
+
+    def test_export_incremental(self):
+        Workflow.objects.update(modified=timezone.now() - timedelta(days=1))
+        path, _, _ = self.export()
+        self.workflows[1].content = ContentFile(b"changed", name="upload")
+        self.workflows[1].save()
+        _, members, stdout = self.export("--since", path, name="incremental.tar")
+        self.assertIn("1 workflow(s)", stdout)
+        self.assertEqual([row["id"] for row in self.rows(members, archive.WORKFLOWS_MEMBER)], [self.workflows[1].id])
+        self.assertEqual(members[archive.content_member(self.workflows[1].content.name)], b"changed")
+
+    def test_export_replaced_during_export(self):
+        """
+        Should export the contents of the snapshot, even if they are replaced before they are read.
+        """
+
+        workflow = self.workflows[0]
+        old_name = workflow.content.name
+        add_contents = ExportCommand.add_contents
+
+        def replace_and_add_contents(command, *args):
+            workflow.content = ContentFile(b"replaced", name="upload")
+            with self.captureOnCommitCallbacks(execute=True):
+                workflow.save()
+            return add_contents(command, *args)
+
+        with patch.object(ExportCommand, "add_contents", replace_and_add_contents):
+            _, members, _ = self.export()
+        self.assertFalse(workflow.content.storage.exists(old_name))
+        self.assertEqual(members[archive.content_member(old_name)], b"content 0")
+        # The links have been deleted
+        self.assertEqual(workflow.content.storage.listdir("exports"), ([], []))
+
+    def test_export_missing_content(self):
+        workflow = self.workflows[0]
+        workflow.content.storage.delete(workflow.content.name)
+        with self.assertRaises(CommandError):
+            self.export()
+
+    def test_export_invalid_since(self):
+        with self.assertRaises(CommandError):
+            self.export("--since", "yesterday")
+
+
+class ImportWorkflowsCommandTestCase(TestCase):
+    """
+    Tests the import_workflows management command with archives of the export_workflows command.
+    """
+
+    def setUp(self):
+        owner = User.objects.create_user("owner", password="ownerpassword").rehagoal_user
+        self.contents = {}
+        for i in range(3):
+            workflow = Workflow.objects.create(owner=owner, content=ContentFile(b"content %d" % i, name="upload"))
+            self.contents[workflow.id] = b"content %d" % i
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = os.path.join(self.directory.name, "export.tar")
+        call_command("export_workflows", self.archive, stdout=StringIO())
+
+    def tearDown(self):
+        super(ImportWorkflowsCommandTestCase, self).tearDown()
+        Workflow.objects.all().delete()
+        self.directory.cleanup()
+
+    def import_workflows(self, *args):
+        stdout = StringIO()
+        call_command("import_workflows", self.archive, "--threads", "2", *args, stdout=stdout, stderr=StringIO())
+        return stdout.getvalue()
+
+    def assertImported(self, workflows):
+        self.assertEqual(len(workflows), len(self.contents))
+        for workflow in workflows:
+            with workflow.content.open("rb") as f:
+                self.assertEqual(hashlib.sha256(f.read()).hexdigest(), workflow.sha256)
+
+    def test_restore(self):
+        """
+        Should restore workflows, their IDs and owners.
+        """
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().delete()
+        User.objects.all().delete()
+        # Larger contents are buffered in temporary files
+        with patch("rehagoal_server_app.management.commands.import_workflows.INLINE_SIZE", 4):
+            stdout = self.import_workflows()
+        self.assertIn("Imported 3 workflow(s) (0 with new ID, 0 updated, 0 skipped) and stored 3 content(s)", stdout)
+        self.assertIn("Created 1 user(s)", stdout)
+        workflows = list(Workflow.objects.all())
+        self.assertImported(workflows)
+        self.assertEqual({workflow.id for workflow in workflows}, set(self.contents))
+        owner = User.objects.get(username="owner")
+        self.assertFalse(owner.has_usable_password())
+        self.assertEqual(owner.rehagoal_user.storage_used, sum(len(content) for content in self.contents.values()))
+
+    def test_restore_user_without_workflows(self):
+        """
+        Should restore users without workflows, along with their storage quota.
+        """
+
+        User.objects.create_user("empty", password="emptypassword")
+        RehagoalUser.objects.filter(user__username="empty").update(storage_quota=1234)
+        call_command("export_workflows", self.archive, stdout=StringIO())
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().delete()
+        User.objects.all().delete()
+        self.assertIn("Created 2 user(s)", self.import_workflows())
+        self.assertEqual(User.objects.get(username="empty").rehagoal_user.storage_quota, 1234)
+        self.assertEqual(Workflow.objects.count(), len(self.contents))
+
+    def test_import_collisions(self):
+        """
+        Should assign new IDs and content file names, if they are already in use (by workflows of other users).
+        """
+
+        other = User.objects.create_user("other", password="otherpassword").rehagoal_user
+        Workflow.objects.update(owner=other)
+        stdout = self.import_workflows()
+        self.assertIn("Imported 3 workflow(s) (3 with new ID, 0 updated, 0 skipped)", stdout)
+        self.assertIn("Created 0 user(s)", stdout)
+        imported = list(Workflow.objects.exclude(id__in=self.contents))
+        self.assertImported(imported)
+        self.assertFalse(Workflow.objects.filter(id__in=self.contents, content__in=[w.content for w in imported]))
+
+    def test_resume(self):
+        """
+        Should skip contents and workflows, which have been imported by a previous (interrupted) run.
+        """
+
+        self.import_workflows("--new-ids")
+        stdout = self.import_workflows("--new-ids")
+        self.assertIn("Imported 0 workflow(s) (0 with new ID, 0 updated, 3 skipped) and stored 0 content(s)", stdout)
+        self.assertEqual(Workflow.objects.count(), 6)
+
+    def test_restore_incremental(self):
+        """
+        Should update the workflows restored from a full archive with those of an incremental one, without duplicates.
+        """
+
+        changed_id = next(iter(self.contents))
+        workflow = Workflow.objects.get(pk=changed_id)
+        workflow.content = ContentFile(b"changed", name="upload")
+        with self.captureOnCommitCallbacks(execute=True):
+            workflow.save()
+        incremental = os.path.join(self.directory.name, "incremental.tar")
+        call_command("export_workflows", incremental, "--since", self.archive, stdout=StringIO())
+        self.contents[changed_id] = b"changed"
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().delete()
+        User.objects.all().delete()
+        self.import_workflows()
+        storage = workflow.content.storage
+        files = set(storage.listdir("")[1])
+        replaced = Workflow.objects.get(pk=changed_id).content.name
+        self.archive = incremental
+        with self.captureOnCommitCallbacks(execute=True):
+            stdout = self.import_workflows()
+        self.assertIn("Imported 1 workflow(s) (0 with new ID, 1 updated, 2 skipped)", stdout)
+        workflows = list(Workflow.objects.all())
+        self.assertImported(workflows)
+        for workflow in workflows:
+            with workflow.content.open("rb") as f:
+                self.assertEqual(f.read(), self.contents[workflow.id])
+        # The replaced content and the contents of unchanged workflows are deleted
+        self.assertEqual(set(storage.listdir("")[1]) ^ files,
+                         {replaced, Workflow.objects.get(pk=changed_id).content.name})
+        # The replaced content is kept as revision, which counts towards the storage used
+        revision = WorkflowRevision.objects.get(workflow=changed_id)
+        owner = User.objects.get(username="owner")
+        self.assertEqual(owner.rehagoal_user.storage_used,
+                         sum(len(content) for content in self.contents.values()) + revision.data_size)
+
+    def test_modified_archive_content_names(self):
+        """
+        Should store contents with names, which are not valid content names, under new names, and skip contents which
+        are not regular files.
+        """
+
+        renamed = {name: "revisions/" + name for name in Workflow.objects.values_list("content", flat=True)[:2]}
+        modified = os.path.join(self.directory.name, "modified.tar")
+        with tarfile.open(self.archive) as source, tarfile.open(modified, "w") as target:
+            for member in source:
+                data = source.extractfile(member).read()
+                if member.name == archive.WORKFLOWS_MEMBER:
+                    rows = [json.loads(line) for line in data.splitlines()]
+                    for row in rows:
+                        row["content"] = renamed.get(row["content"], row["content"])
+                    data = b"".join(archive.dump_line(row) for row in rows)
+                elif member.name.startswith(archive.CONTENTS_PREFIX):
+                    name = member.name[len(archive.CONTENTS_PREFIX):]
+                    member.name = archive.content_member(renamed.get(name, name))
+                member.size = len(data)
+                target.addfile(member, BytesIO(data))
+            link = tarfile.TarInfo(archive.content_member("linkedlinked"))
+            link.type, link.linkname = tarfile.SYMTYPE, "/etc/passwd"
+            target.addfile(link)
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().delete()
+        self.archive = modified
+        self.assertIn("stored 3 content(s)", self.import_workflows())
+        workflows = list(Workflow.objects.all())
+        self.assertImported(workflows)
+        for workflow in workflows:
+            self.assertRegex(workflow.content.name, r"^[A-Za-z0-9]{12}$")
+        self.assertFalse(workflows[0].content.storage.exists("linkedlinked"))
+
+    def test_invalid_archive(self):
+        with open(self.archive, "wb") as f:
+            f.write(b"no archive")
+        with self.assertRaises(CommandError):
+            self.import_workflows()
+
+
+class ProvisionUsersCommandTestCase(TestCase):
+    """
+    Tests the provision_users management command.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        User.objects.create_user("existing", password="existingpassword")
+
+    def tearDown(self):
+        super(ProvisionUsersCommandTestCase, self).tearDown()
+        self.directory.cleanup()
+
+    def provision(self, csv_content, *args):
+        path = os.path.join(self.directory.name, "users.csv")
+        with open(path, "w") as f:
+            f.write(csv_content)
+        stdout = StringIO()
+        call_command("provision_users", path, *args, stdout=stdout, stderr=StringIO())
+        return stdout.getvalue()
+
+    def test_provision(self):
+        """
+        Should create users with hashed passwords and a RehagoalUser, like creating them one by one.
+        """
+
+        output = os.path.join(self.directory.name, "passwords.csv")
+        stdout = self.provision(
+            "username,password,email\n"
+            "user1,password1,user1@localhost\n"
+            "user2,password2,\n"
+            "existing,password3,\n"
+            "user4,,\n",
+            "--processes", "2", "--batch-size", "2", "--output", output,
+        )
+        self.assertIn("Created 3 user(s)", stdout)
+        self.assertIn("skipped 1", stdout)
+        self.assertTrue(User.objects.get(username="user1").check_password("password1"))
+        self.assertEqual(User.objects.get(username="user1").email, "user1@localhost")
+        self.assertTrue(User.objects.get(username="user2").check_password("password2"))
+        self.assertTrue(User.objects.get(username="existing").check_password("existingpassword"))
+        with open(output) as f:
+            rows = f.read().splitlines()
+        self.assertEqual(rows[0], "username,password")
+        username, password = rows[1].split(",")
+        self.assertEqual(username, "user4")
+        self.assertTrue(User.objects.get(username="user4").check_password(password))
+        for user in User.objects.all():
+            self.assertIsNotNone(user.rehagoal_user)
+            self.assertFalse(user.is_staff)
+
+    def test_generated_passwords_require_output(self):
+        with self.assertRaises(CommandError):
+            self.provision("username,password\nuser1,\n")
+        self.assertFalse(User.objects.filter(username="user1").exists())
+
+    def test_invalid_rows(self):
+        for csv_content in ("name\nuser1\n", "username\nuser 1\n", "username,password\nuser1,a\nuser1,b\n"):
+            with self.assertRaises(CommandError):
+                self.provision(csv_content)
@@ -0,0 +1,98 @@
+import hashlib
+import tempfile
+from io import BytesIO
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase
+
+from ..content import NAME_MAX_LENGTH, WorkflowMetadataParser, inspect_content, inspect_stored_content, open_buffer
+
+
+class WorkflowMetadataParserTestCase(SimpleTestCase):
+    """
+    Tests the incremental metadata extraction of JSON workflow contents.
+    """
+
+    @staticmethod
+    def parse(content, chunk_size=None):
+        parser = WorkflowMetadataParser()
+        chunk_size = chunk_size or max(len(content), 1)
+        for start in range(0, len(content), chunk_size):
+            parser.feed(content[start:start + chunk_size])
+        return parser.close()
+
+    def assertMetadata(self, content, expected_metadata):
+        for chunk_size in (None, 1, 2, 7):
+            self.assertEqual(self.parse(content, chunk_size), expected_metadata, "chunk size %s" % chunk_size)
+
+    def test_name(self):
+        self.assertMetadata(b'{"name":"mocked file","meta":"nothing"}', ("mocked file", None))
+
+    def test_name_and_tasks(self):
+        self.assertMetadata(
+            b' {"meta": {"name": "nested", "tasks": [1]}, "tasks": [1, [2, 3], {"a": "],\\""}, "x"],'
+            b' "name": "W\\u00e4 \\"quoted\\" \xc3\xa4"}',
+            ('W\xe4 "quoted" \xe4', 4)
+        )
+
+    def test_empty_tasks(self):
+        self.assertMetadata(b'{"tasks": [ ]}', (None, 0))
+
+    def test_no_json_object(self):
+        for content in (b'', b'[{"name": "array"}]', b'"name"', b'\x00\xff encrypted', b'{"name": "incomplete"'):
+            self.assertMetadata(content, (None, None))
+
+    def test_name_not_a_string(self):
+        self.assertMetadata(b'{"name": {"name": "nested"}}', (None, None))
+
+    def test_long_name_truncated(self):
+        name, task_count = self.parse(b'{"name": "' + b'\\u00e4' * 1000 + b'", "tasks": []}')
+        self.assertEqual(name, "\xe4" * NAME_MAX_LENGTH)
+        self.assertEqual(task_count, 0)
+
+    def test_stops_when_metadata_known(self):
+        parser = WorkflowMetadataParser()
+        parser.feed(b'{"name": "early", "tasks": [], "rest": ')
+        self.assertTrue(parser.done)
+        parser.feed(b'x' * 1024)
+        self.assertEqual(parser.close(), ("early", 0))
+
+
+class StoredContentTestCase(SimpleTestCase):
+    """
+    Tests the memory-mapped access to stored workflow contents.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = FileSystemStorage(location=directory.name)
+
+    def test_inspect_stored_content(self):
+        """
+        Should compute the same ContentInfo as inspecting the content in chunks.
+        """
+        content = b'{"tasks": [' + b'{"x": 1}, ' * 300000 + b'{}], "name": "mapped"}'
+        name = self.storage.save("mapped", ContentFile(content))
+        with mock.patch("rehagoal_server_app.content.MAPPED_CHUNK_SIZE", 4096):
+            info = inspect_stored_content(self.storage, name)
+        self.assertEqual(info, inspect_content(BytesIO(content)))
+        self.assertEqual(info.sha256, hashlib.sha256(content).hexdigest())
+        self.assertEqual((info.name, info.task_count), ("mapped", 300001))
+
+    def test_open_buffer(self):
+        """
+        Should provide read-only access to the content, also for empty files and storages without local paths.
+        """
+        name = self.storage.save("mapped", ContentFile(b"content"))
+        with open_buffer(self.storage, name) as buffer:
+            self.assertEqual(buffer.tobytes(), b"content")
+            self.assertTrue(buffer.readonly)
+        empty_name = self.storage.save("empty", ContentFile(b""))
+        with open_buffer(self.storage, empty_name) as buffer:
+            self.assertEqual(len(buffer), 0)
+        remote_storage = mock.Mock(path=mock.Mock(side_effect=NotImplementedError), open=self.storage.open)
+        with open_buffer(remote_storage, name) as buffer:
+            self.assertEqual(buffer.tobytes(), b"content")
@@ -0,0 +1,94 @@
+import os
+
+from django.core.files.base import ContentFile
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..models import RehagoalUser, Workflow
+
+
+class CopyWorkflowTestCase(APIAuthTestCase):
+    """
+    Tests copies of workflows (POST /workflows/<id>/copy/), which share the content file with the original.
+    """
+
+    def setUp(self):
+        super(CopyWorkflowTestCase, self).setUp()
+        self.content = b'{"name": "Template", "tasks": [{}]}'
+        self.template = Workflow.objects.create(owner=self.rehagoal_user,
+                                                content=ContentFile(self.content, name="upload"))
+        self.storage = self.template.content.storage
+
+    def tearDown(self):
+        super(CopyWorkflowTestCase, self).tearDown()
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().delete()
+
+    def copy(self, workflow_id=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(API_ROOT + "workflows/%s/copy/" % (workflow_id or self.template.id))
+
+    def read(self, workflow):
+        with Workflow.objects.get(pk=workflow.pk).content.open("rb") as f:
+            return f.read()
+
+    def storage_used(self, user=None):
+        return RehagoalUser.objects.get(user__username=(user or self.regular_user).username).storage_used
+
+    def test_copy(self):
+        r = self.copy()
+        self.assertEqual(r.status_code, status.HTTP_201_CREATED)
+        copy = Workflow.objects.get(pk=r.data["id"])
+        self.assertNotEqual(copy.pk, self.template.pk)
+        self.assertEqual((copy.owner, copy.sha256, copy.name, copy.task_count, copy.size),
+                         (self.rehagoal_user, self.template.sha256, "Template", 1, len(self.content)))
+        self.assertEqual((r.data["sha256"], r.data["name"]), (self.template.sha256, "Template"))
+        self.assertNotEqual(copy.content.name, self.template.content.name)
+        self.assertTrue(os.path.samestat(os.stat(self.storage.path(copy.content.name)),
+                                         os.stat(self.storage.path(self.template.content.name))))
+        self.assertEqual(self.storage_used(), 2 * len(self.content))
+
+    def test_copy_of_other_user(self):
+        self.auth(self.regular_user2)
+        r = self.copy()
+        self.assertEqual(r.status_code, status.HTTP_201_CREATED)
+        copy = Workflow.objects.get(pk=r.data["id"])
+        self.assertEqual(copy.owner.user.username, self.regular_user2.username)
+        self.assertEqual(self.read(copy), self.content)
+        self.assertEqual(Workflow.objects.get(pk=self.template.pk).owner.user.username, self.regular_user.username)
+        self.assertEqual(self.storage_used(self.regular_user2), len(self.content))
+
+    def test_copies_diverge(self):
+        copy = Workflow.objects.get(pk=self.copy().data["id"])
+        copy.content = ContentFile(b"changed", name="upload")
+        with self.captureOnCommitCallbacks(execute=True):
+            copy.save()
+        self.assertEqual(self.read(self.template), self.content)
+        self.assertEqual(self.read(copy), b"changed")
+
+    def test_delete_original(self):
+        copy = Workflow.objects.get(pk=self.copy().data["id"])
+        name = self.template.content.name
+        with self.captureOnCommitCallbacks(execute=True):
+            self.template.delete()
+        self.assertFalse(self.storage.exists(name))
+        self.assertEqual(self.read(copy), self.content)
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.filter(pk=copy.pk).bulk_delete()
+        self.assertFalse(self.storage.exists(copy.content.name))
+
+    def test_storage_quota(self):
+        RehagoalUser.objects.filter(pk=self.rehagoal_user.pk).update(storage_quota=len(self.content) + 1)
+        files = set(self.storage.listdir("")[1])
+        r = self.copy()
+        self.assertEqual(r.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(Workflow.objects.count(), 1)
+        self.assertEqual(set(self.storage.listdir("")[1]), files)
+
+    def test_not_found(self):
+        self.assertEqual(self.copy("X" * 12).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_unauthenticated(self):
+        self.auth()
+        self.assertEqual(self.copy().status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(Workflow.objects.count(), 1)
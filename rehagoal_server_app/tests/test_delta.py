@@ -0,0 +1,187 @@
+import base64
+import hashlib
+import json
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase
+from django.utils.http import quote_etag
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..delta import DeltaError, apply_json_patch
+from ..models import RehagoalUser, Workflow, WorkflowRevision
+
+
+class JSONPatchTestCase(SimpleTestCase):
+    """
+    Tests the JSON Patch (RFC 6902) implementation of delta updates (delta.py), with examples of the RFC.
+    """
+
+    def assertPatched(self, document, operations, expected):
+        self.assertEqual(apply_json_patch(document, operations), expected)
+
+    def test_add(self):
+        self.assertPatched({"foo": "bar"}, [{"op": "add", "path": "/baz", "value": "qux"}],
+                           {"foo": "bar", "baz": "qux"})
+        self.assertPatched({"foo": ["bar", "baz"]}, [{"op": "add", "path": "/foo/1", "value": "qux"}],
+                           {"foo": ["bar", "qux", "baz"]})
+        self.assertPatched({"foo": ["bar"]}, [{"op": "add", "path": "/foo/-", "value": ["abc"]}],
+                           {"foo": ["bar", ["abc"]]})
+        self.assertPatched({"foo": "bar"}, [{"op": "add", "path": "", "value": [1]}], [1])
+
+    def test_remove_replace(self):
+        self.assertPatched({"baz": "qux", "foo": "bar"}, [{"op": "remove", "path": "/baz"}], {"foo": "bar"})
+        self.assertPatched({"foo": ["bar", "qux", "baz"]}, [{"op": "remove", "path": "/foo/1"}],
+                           {"foo": ["bar", "baz"]})
+        self.assertPatched({"baz": "qux", "foo": "bar"}, [{"op": "replace", "path": "/baz", "value": "boo"}],
+                           {"baz": "boo", "foo": "bar"})
+        self.assertPatched({"tasks": [1, 2]}, [{"op": "replace", "path": "/tasks/0", "value": 3}], {"tasks": [3, 2]})
+
+    def test_move_copy(self):
+        self.assertPatched({"foo": {"bar": "baz", "waldo": "fred"}, "qux": {"corge": "grault"}},
+                           [{"op": "move", "from": "/foo/waldo", "path": "/qux/thud"}],
+                           {"foo": {"bar": "baz"}, "qux": {"corge": "grault", "thud": "fred"}})
+        self.assertPatched({"foo": ["all", "grass", "cows", "eat"]}, [{"op": "move", "from": "/foo/1", "path": "/foo/3"}],
+                           {"foo": ["all", "cows", "eat", "grass"]})
+        document = {"a": {"b": 1}}
+        patched = apply_json_patch(document, [{"op": "copy", "from": "/a", "path": "/c"}])
+        patched["c"]["b"] = 2
+        self.assertEqual(patched["a"], {"b": 1})
+
+    def test_escaped_pointer(self):
+        self.assertPatched({"a/b": 1, "m~n": 2}, [{"op": "remove", "path": "/a~1b"}, {"op": "remove", "path": "/m~0n"}],
+                           {})
+
+    def test_test(self):
+        document = {"baz": "qux", "foo": ["a", 2, "c"], "flag": True}
+        apply_json_patch(document, [{"op": "test", "path": "/baz", "value": "qux"},
+                                    {"op": "test", "path": "/foo/1", "value": 2},
+                                    {"op": "test", "path": "/flag", "value": True}])
+        for operation in ({"op": "test", "path": "/baz", "value": "bar"},
+                          {"op": "test", "path": "/flag", "value": 1}):
+            with self.assertRaises(DeltaError):
+                apply_json_patch(document, [operation])
+
+    def test_errors(self):
+        for operations in (
+                {"op": "add"},
+                [{"op": "add", "path": "/baz/bat", "value": "qux"}],
+                [{"op": "remove", "path": "/missing"}],
+                [{"op": "add", "path": "/list/5", "value": 1}],
+                [{"op": "add", "path": "/list/01", "value": 1}],
+                [{"op": "add", "path": "missing-slash", "value": 1}],
+                [{"op": "add", "path": "/value"}],
+                [{"op": "move", "from": "/list", "path": "/list/0"}],
+                [{"op": "invalid", "path": "/list"}],
+        ):
+            with self.assertRaises(DeltaError, msg=operations):
+                apply_json_patch({"list": [1]}, operations)
+
+    def test_max_size(self):
+        # Every copy doubles the document, which is rejected before it is copied
+        operations = [{"op": "copy", "from": "", "path": "/%d" % number} for number in range(64)]
+        with self.assertRaisesRegex(DeltaError, "Operation 9:"):
+            apply_json_patch({"a": "x" * 100}, operations, max_size=100000)
+        with self.assertRaises(DeltaError):
+            apply_json_patch({}, [{"op": "add", "path": "/a", "value": "x" * 1000}], max_size=1000)
+        self.assertEqual(apply_json_patch({}, [{"op": "add", "path": "/a", "value": "x" * 100}], max_size=1000),
+                         {"a": "x" * 100})
+
+
+class PatchContentTestCase(APIAuthTestCase):
+    """
+    Tests delta updates of workflow contents (PATCH /workflows/<id>/content/).
+    """
+
+    JSON_PATCH = "application/json-patch+json"
+    BINARY_DELTA = "application/vnd.rehagoal.delta+json"
+
+    def setUp(self):
+        super(PatchContentTestCase, self).setUp()
+        self.content = json.dumps({"name": "Workflow", "tasks": [{"name": "Task 1"}]}).encode()
+        self.workflow = Workflow.objects.create(owner=self.rehagoal_user, content=ContentFile(self.content, name="upload"))
+        self.url = API_ROOT + "workflows/%s/content/" % self.workflow.id
+
+    def tearDown(self):
+        super(PatchContentTestCase, self).tearDown()
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().delete()
+
+    def patch(self, data, content_type, etag=None):
+        etag = quote_etag(self.workflow.sha256) if etag is None else etag
+        return self.client.generic("PATCH", self.url, json.dumps(data), content_type=content_type, HTTP_IF_MATCH=etag)
+
+    def stored_content(self):
+        with Workflow.objects.get(pk=self.workflow.pk).content.open("rb") as f:
+            return f.read()
+
+    def test_json_patch(self):
+        old_name = self.workflow.content.name
+        storage = self.workflow.content.storage
+        with self.captureOnCommitCallbacks(execute=True):
+            r = self.patch([{"op": "add", "path": "/tasks/-", "value": {"name": "Task 2"}}], self.JSON_PATCH)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        expected = {"name": "Workflow", "tasks": [{"name": "Task 1"}, {"name": "Task 2"}]}
+        self.assertEqual(json.loads(self.stored_content()), expected)
+        workflow = Workflow.objects.get(pk=self.workflow.pk)
+        self.assertEqual(workflow.sha256, hashlib.sha256(self.stored_content()).hexdigest())
+        self.assertEqual((workflow.task_count, workflow.size), (2, len(self.stored_content())))
+        self.assertEqual((r.data["sha256"], r.data["task_count"]), (workflow.sha256, 2))
+        self.assertNotEqual(workflow.content.name, old_name)
+        self.assertFalse(storage.exists(old_name))
+        # The replaced content is kept as revision, which counts towards the storage used
+        revision = WorkflowRevision.objects.get(workflow=workflow)
+        self.assertEqual(RehagoalUser.objects.get(pk=self.rehagoal_user.pk).storage_used,
+                         workflow.size + revision.data_size)
+
+    def test_binary_delta(self):
+        # Replace "Task 1" by "Task A"
+        offset = self.content.index(b"Task 1") + len(b"Task ")
+        r = self.patch([["copy", 0, offset], ["insert", base64.b64encode(b"A").decode()],
+                        ["copy", offset + 1, len(self.content) - offset - 1]], self.BINARY_DELTA)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stored_content(), self.content.replace(b"Task 1", b"Task A"))
+        self.assertEqual(r.data["sha256"], hashlib.sha256(self.stored_content()).hexdigest())
+
+    def test_binary_delta_invalid(self):
+        for instructions in ([["copy", 0, len(self.content) + 1]], [["copy", -1, 1]], [["insert", "%%%"]],
+                             [["delete", 0]], {"copy": [0, 1]}):
+            r = self.patch(instructions, self.BINARY_DELTA)
+            self.assertEqual(r.status_code, status.HTTP_400_BAD_REQUEST, instructions)
+            self.assertIn("patch", r.data)
+        self.assertEqual(self.stored_content(), self.content)
+
+    def test_json_patch_not_json(self):
+        self.workflow.content = ContentFile(b"\x00encrypted", name="upload")
+        self.workflow.save()
+        r = self.patch([{"op": "remove", "path": "/name"}], self.JSON_PATCH)
+        self.assertEqual(r.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_json_patch_lone_surrogate(self):
+        r = self.patch([{"op": "replace", "path": "/name", "value": "\ud800"}], self.JSON_PATCH)
+        self.assertEqual(r.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("patch", r.data)
+        self.assertEqual(self.stored_content(), self.content)
+
+    def test_precondition(self):
+        r = self.patch([["copy", 0, 1]], self.BINARY_DELTA, etag="")
+        self.assertEqual(r.status_code, status.HTTP_428_PRECONDITION_REQUIRED)
+        r = self.patch([["copy", 0, 1]], self.BINARY_DELTA, etag=quote_etag("0" * 64))
+        self.assertEqual(r.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.stored_content(), self.content)
+
+    def test_unsupported_media_type(self):
+        r = self.patch([["copy", 0, 1]], "application/json")
+        self.assertEqual(r.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_other_owner(self):
+        self.auth(self.regular_user2)
+        r = self.patch([["copy", 0, 1]], self.BINARY_DELTA)
+        self.assertEqual(r.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_storage_quota(self):
+        RehagoalUser.objects.filter(pk=self.rehagoal_user.pk).update(storage_quota=len(self.content) + 10)
+        r = self.patch([["copy", 0, len(self.content)], ["insert", base64.b64encode(b"x" * 20).decode()]],
+                       self.BINARY_DELTA)
+        self.assertEqual(r.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(self.stored_content(), self.content)
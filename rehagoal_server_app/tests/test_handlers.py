@@ -0,0 +1,63 @@
+from django.test import RequestFactory
+from rest_framework import status
+
+from rehagoal_server.handlers import APIFastPathWSGIHandler, is_token_api_request
+from .setup import APIAuthTestCase, API_ROOT
+
+
+class APIFastPathHandlerTestCase(APIAuthTestCase):
+    """
+    Tests the reduced middleware stack for token-authenticated REST API requests.
+    """
+
+    def setUp(self):
+        super(APIFastPathHandlerTestCase, self).setUp()
+        self.handler = APIFastPathWSGIHandler()
+        self.factory = RequestFactory()
+        self.authorization = self.client._credentials["HTTP_AUTHORIZATION"]
+
+    def test_is_token_api_request(self):
+        """
+        Should only use the fast path for authenticated API requests, which are not rendered as browsable API.
+        """
+
+        self.assertTrue(is_token_api_request(
+            self.factory.get(API_ROOT + "workflows/", HTTP_AUTHORIZATION=self.authorization)))
+        self.assertFalse(is_token_api_request(self.factory.get(API_ROOT + "workflows/")))
+        self.assertFalse(is_token_api_request(
+            self.factory.get("/admin/", HTTP_AUTHORIZATION=self.authorization)))
+        self.assertFalse(is_token_api_request(
+            self.factory.get(API_ROOT, HTTP_AUTHORIZATION=self.authorization, HTTP_ACCEPT="text/html")))
+        self.assertFalse(is_token_api_request(
+            self.factory.get(API_ROOT, {"format": "api"}, HTTP_AUTHORIZATION=self.authorization)))
+
+    def test_fast_path_skips_sessions(self):
+        """
+        Should process token-authenticated API requests without session middleware.
+        """
+
+        request = self.factory.get(API_ROOT + "workflows/", HTTP_AUTHORIZATION=self.authorization)
+        response = self.handler.get_response(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(hasattr(request, "session"))
+        self.assertNotIn("X-Frame-Options", response)
+
+    def test_fast_path_post_without_csrf(self):
+        """
+        Should accept token-authenticated unsafe requests without CSRF token.
+        """
+
+        request = self.factory.post(API_ROOT + "workflows/", {"content": b""}, HTTP_AUTHORIZATION=self.authorization)
+        response = self.handler.get_response(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_full_stack_for_other_requests(self):
+        """
+        Should process other requests with the full middleware stack.
+        """
+
+        request = self.factory.get("/admin/login/")
+        response = self.handler.get_response(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(hasattr(request, "session"))
+        self.assertIn("X-Frame-Options", response)
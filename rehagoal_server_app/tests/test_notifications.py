@@ -0,0 +1,180 @@
+import os
+import tempfile
+import threading
+import time
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, override_settings
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..models import Workflow
+from ..notifications import ChangeNotifier, notifier
+
+
+class ChangeNotifierTestCase(SimpleTestCase):
+    """
+    Tests the filesystem-based change notifications (notifications.py).
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.notifier = ChangeNotifier(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_follows_settings(self):
+        original = notifier.directory
+        with override_settings(WORKFLOW_CHANGES_DIR=self.directory.name, WORKFLOW_CHANGES_MAX_WAITERS=3):
+            self.assertEqual((notifier.directory, notifier.max_waiters), (self.directory.name, 3))
+        self.assertEqual(notifier.directory, original)
+
+    def test_cursor(self):
+        initial = self.notifier.cursor('owner')
+        self.notifier.notify('owner')
+        first = self.notifier.cursor('owner')
+        self.notifier.notify('owner')
+        second = self.notifier.cursor('owner')
+        self.assertEqual(len({initial, first, second}), 3)
+        self.assertEqual(self.notifier.cursor('other'), initial)
+
+    def test_wait_changed(self):
+        cursor = self.notifier.cursor('owner')
+        self.notifier.notify('owner')
+        start = time.monotonic()
+        self.assertNotEqual(self.notifier.wait('owner', cursor, 10), cursor)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_wait_timeout(self):
+        cursor = self.notifier.cursor('owner')
+        self.notifier.notify('other')
+        self.assertEqual(self.notifier.wait('owner', cursor, 0.2), cursor)
+
+    def test_wait_notified(self):
+        cursor = self.notifier.cursor('owner')
+        timer = threading.Timer(0.2, self.notifier.notify, ['owner'])
+        timer.start()
+        try:
+            self.assertNotEqual(self.notifier.wait('owner', cursor, 10), cursor)
+        finally:
+            timer.cancel()
+
+    def test_max_waiters(self):
+        notifier = ChangeNotifier(self.directory.name, max_waiters=1)
+        cursor = notifier.cursor('owner')
+        waiting = threading.Thread(target=notifier.wait, args=('owner', cursor, 0.5))
+        waiting.start()
+        try:
+            time.sleep(0.1)
+            start = time.monotonic()
+            self.assertIsNone(notifier.wait('owner', cursor, 10))
+            self.assertLess(time.monotonic() - start, 0.1)
+        finally:
+            waiting.join()
+        self.assertEqual(notifier.wait('owner', cursor, 0), cursor)
+        self.assertEqual(notifier.waiters, 0)
+
+    def test_notify_error_logged(self):
+        with open(os.path.join(self.directory.name, 'file'), 'w'):
+            pass
+        notifier = ChangeNotifier(os.path.join(self.directory.name, 'file', 'changes'))
+        with self.assertLogs('rehagoal_server_app.notifications', 'ERROR'):
+            notifier.notify('owner')
+
+
+class WorkflowChangesTestCase(APIAuthTestCase):
+    """
+    Tests the long-polling endpoint for workflow changes (/workflows/changes/).
+    """
+
+    URL = API_ROOT + "workflows/changes/"
+
+    def setUp(self):
+        super(WorkflowChangesTestCase, self).setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.original_directory = notifier.directory
+        notifier.directory = self.directory.name
+
+    def tearDown(self):
+        super(WorkflowChangesTestCase, self).tearDown()
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().delete()
+        notifier.directory = self.original_directory
+        self.directory.cleanup()
+
+    def test_authentication_required(self):
+        self.auth()
+        self.assertEqual(self.client.get(self.URL).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_changes(self):
+        r = self.client.get(self.URL)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertFalse(r.data["changed"])
+        cursor = r.data["cursor"]
+        r = self.client.get(self.URL, {"since": cursor, "timeout": 0})
+        self.assertEqual(r.data, {"cursor": cursor, "changed": False})
+        with self.captureOnCommitCallbacks(execute=True):
+            r = self.client.post(API_ROOT + "workflows/", {"content": ContentFile(b"new", name="upload")})
+        self.assertEqual(r.status_code, status.HTTP_201_CREATED)
+        r = self.client.get(self.URL, {"since": cursor, "timeout": 0})
+        self.assertTrue(r.data["changed"])
+        self.assertNotEqual(r.data["cursor"], cursor)
+
+    def test_notify_error_does_not_fail_change(self):
+        # The notification is sent after the commit, where an exception would turn the saved change into an error
+        with open(os.path.join(self.directory.name, "file"), "w"):
+            pass
+        notifier.directory = os.path.join(self.directory.name, "file", "changes")
+        with self.assertLogs("rehagoal_server_app.notifications", "ERROR"):
+            with self.captureOnCommitCallbacks(execute=True):
+                r = self.client.post(API_ROOT + "workflows/", {"content": ContentFile(b"new", name="upload")})
+        self.assertEqual(r.status_code, status.HTTP_201_CREATED)
+        notifier.directory = self.directory.name  # for the deletion in tearDown
+
+    def test_changes_bulk_delete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.create(owner=self.rehagoal_user, content=ContentFile(b"new", name="upload"))
+        cursor = self.client.get(self.URL).data["cursor"]
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().bulk_delete()
+        self.assertTrue(self.client.get(self.URL, {"since": cursor, "timeout": 0}).data["changed"])
+
+    def test_changes_other_owner(self):
+        cursor = self.client.get(self.URL).data["cursor"]
+        self.auth(self.regular_user2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(API_ROOT + "workflows/", {"content": ContentFile(b"new", name="upload")})
+        self.auth(self.regular_user)
+        self.assertFalse(self.client.get(self.URL, {"since": cursor, "timeout": 0}).data["changed"])
+
+    def test_wait_threaded(self):
+        cursor = self.client.get(self.URL).data["cursor"]
+        start = time.monotonic()
+        r = self.client.get(self.URL, {"since": cursor, "timeout": 0.3}, **{"wsgi.multithread": True})
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertEqual(r.data, {"cursor": cursor, "changed": False})
+        self.assertFalse(r.has_header("Retry-After"))
+
+    def test_no_wait_single_threaded(self):
+        # e.g. the prefork server of the serve command, where a waiting request would block the whole process
+        cursor = self.client.get(self.URL).data["cursor"]
+        start = time.monotonic()
+        r = self.client.get(self.URL, {"since": cursor, "timeout": 10}, **{"wsgi.multithread": False})
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(r.data, {"cursor": cursor, "changed": False})
+        self.assertEqual(r["Retry-After"], "10")
+
+    def test_no_wait_max_waiters(self):
+        cursor = self.client.get(self.URL).data["cursor"]
+        notifier.max_waiters, max_waiters = 0, notifier.max_waiters
+        try:
+            r = self.client.get(self.URL, {"since": cursor, "timeout": 10}, **{"wsgi.multithread": True})
+        finally:
+            notifier.max_waiters = max_waiters
+        self.assertEqual(r.data, {"cursor": cursor, "changed": False})
+        self.assertEqual(r["Retry-After"], "10")
+
+    def test_invalid_timeout(self):
+        r = self.client.get(self.URL, {"since": "0", "timeout": "soon"})
+        self.assertEqual(r.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import sqlite3
+from unittest import mock, skipUnless
+
+from django.core.files.base import ContentFile
+from django.db import connection
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..api import MAX_PRECHECK_ITEMS
+from ..models import RehagoalUser, Workflow, WorkflowRevision
+from ..serializers import WorkflowPrecheckSerializer
+
+
+class PrecheckTestCase(APIAuthTestCase):
+    """
+    Tests the pre-check of workflow uploads (POST /workflows/precheck/), which avoids uploads of known contents.
+    """
+
+    url = API_ROOT + "workflows/precheck/"
+
+    def setUp(self):
+        super(PrecheckTestCase, self).setUp()
+        self.content = b'{"name": "Known", "tasks": [{}, {}]}'
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+        self.workflow = Workflow.objects.create(owner=self.rehagoal_user,
+                                                content=ContentFile(self.content, name="upload"))
+
+    def tearDown(self):
+        super(PrecheckTestCase, self).tearDown()
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().delete()
+
+    def precheck(self, *items):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(self.url, list(items), format="json")
+
+    def storage_used(self):
+        return RehagoalUser.objects.get(pk=self.rehagoal_user.pk).storage_used
+
+    def test_create_known(self):
+        r = self.precheck({"sha256": self.sha256})
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        result, = r.data
+        self.assertEqual(result["status"], "created")
+        created = Workflow.objects.get(pk=result["workflow"]["id"])
+        self.assertEqual((created.owner, created.sha256, created.name, created.task_count, created.size),
+                         (self.rehagoal_user, self.sha256, "Known", 2, len(self.content)))
+        self.assertNotEqual(created.content.name, self.workflow.content.name)
+        with created.content.open("rb") as f:
+            self.assertEqual(f.read(), self.content)
+        # Hard link, the contents can be deleted independently
+        storage = created.content.storage
+        self.assertTrue(os.path.samestat(os.stat(storage.path(created.content.name)),
+                                         os.stat(storage.path(self.workflow.content.name))))
+        self.assertEqual(self.storage_used(), 2 * len(self.content))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.workflow.delete()
+        with Workflow.objects.get(pk=created.pk).content.open("rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_update_known(self):
+        other = Workflow.objects.create(owner=self.rehagoal_user, content=ContentFile(b"other", name="upload"))
+        r = self.precheck({"sha256": self.sha256, "id": other.id}, {"sha256": self.sha256, "id": self.workflow.id})
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual([result["status"] for result in r.data], ["updated", "unchanged"])
+        self.assertEqual(r.data[0]["workflow"]["sha256"], self.sha256)
+        other = Workflow.objects.get(pk=other.pk)
+        with other.content.open("rb") as f:
+            self.assertEqual(f.read(), self.content)
+        revision = WorkflowRevision.objects.get(workflow=other)
+        self.assertEqual(self.storage_used(), 2 * len(self.content) + revision.data_size)
+
+    def test_unknown(self):
+        unknown = hashlib.sha256(b"unknown").hexdigest()
+        r = self.precheck({"sha256": unknown}, {"sha256": unknown, "id": self.workflow.id})
+        self.assertEqual([(result["status"], result["workflow"]) for result in r.data],
+                         [("upload_required", None)] * 2)
+        self.assertEqual(Workflow.objects.count(), 1)
+
+    def test_contents_of_other_users(self):
+        self.auth(self.regular_user2)
+        r = self.precheck({"sha256": self.sha256}, {"sha256": self.sha256, "id": self.workflow.id})
+        self.assertEqual([result["status"] for result in r.data], ["upload_required", "not_found"])
+        self.assertEqual(Workflow.objects.count(), 1)
+
+    def test_storage_quota(self):
+        RehagoalUser.objects.filter(pk=self.rehagoal_user.pk).update(storage_quota=len(self.content) + 1)
+        storage = self.workflow.content.storage
+        files = set(storage.listdir("")[1])
+        r = self.precheck({"sha256": self.sha256})
+        self.assertEqual(r.data[0]["status"], "storage_quota_exceeded")
+        self.assertEqual(Workflow.objects.count(), 1)
+        self.assertEqual(set(storage.listdir("")[1]), files)
+
+    def test_invalid(self):
+        for data in ([{"sha256": "XYZ"}], [{}], {"sha256": self.sha256},
+                     [{"sha256": self.sha256}] * (MAX_PRECHECK_ITEMS + 1)):
+            r = self.client.post(self.url, data, format="json")
+            self.assertEqual(r.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @skipUnless(connection.vendor == "sqlite" and hasattr(sqlite3.Connection, "setlimit"),
+                "Requires limits of SQLite connections (Python 3.11)")
+    def test_max_items(self):
+        # The maximum number of query parameters of SQLite before 3.32
+        connection.ensure_connection()
+        limit = connection.connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        self.addCleanup(connection.connection.setlimit, sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit)
+        items = [{"sha256": "%064x" % i, "id": "%012d" % i} for i in range(MAX_PRECHECK_ITEMS)]
+        r = self.precheck(*items)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(r.data), MAX_PRECHECK_ITEMS)
+
+    def test_too_many_items(self):
+        # Rejected before the items are validated
+        with mock.patch.object(WorkflowPrecheckSerializer, "run_validation") as run_validation:
+            r = self.client.post(self.url, [{"sha256": "XYZ"}] * (MAX_PRECHECK_ITEMS + 1), format="json")
+        self.assertEqual(r.status_code, status.HTTP_400_BAD_REQUEST)
+        run_validation.assert_not_called()
@@ -0,0 +1,195 @@
+import os
+import re
+import select
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from django.conf import settings
+from django.test import SimpleTestCase
+
+from rehagoal_server.prefork import SendfileServerHandler, WorkerServer, memory_usage
+
+
+# Settings of the server subprocess, which keep its state out of the project directory (like the test runner)
+SERVER_SETTINGS = """
+from rehagoal_server.settings import *  # noqa: F401,F403
+
+CACHES['sessions']['LOCATION'] = os.path.join(%(directory)r, 'sessions')
+WORKFLOW_CHANGES_DIR = os.path.join(%(directory)r, 'changes')
+WORKFLOW_ADMISSION_CONTROL = dict(WORKFLOW_ADMISSION_CONTROL, DATABASE=os.path.join(%(directory)r, 'admission.sqlite3'))
+AUDIT_LOG_FILE = LOGGING['handlers']['audit']['filename'] = os.path.join(%(directory)r, 'audit.jsonl')
+"""
+
+
+@skipUnless(hasattr(os, "fork"), "Requires os.fork")
+class PreforkServerTestCase(SimpleTestCase):
+    """
+    Tests the pre-forking server (serve command) in a subprocess.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings_file = os.path.join(directory.name, "server_settings.py")
+        with open(self.settings_file, "w") as f:
+            f.write(SERVER_SETTINGS % {"directory": directory.name})
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE="server_settings",
+                   PYTHONPATH=os.pathsep.join([directory.name, settings.BASE_DIR]))
+        self.server = subprocess.Popen(
+            [sys.executable, "manage.py", "serve", "127.0.0.1:0", "--workers", "2", "--graceful-timeout", "5"],
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True)
+        self.addCleanup(self.server.wait)
+        self.addCleanup(self.server.stdout.close)
+        self.addCleanup(self.server.kill)
+
+    def wait_for_output(self, pattern, count=1, timeout=30):
+        deadline = time.monotonic() + timeout
+        matches = []
+        while len(matches) < count:
+            remaining = deadline - time.monotonic()
+            self.assertGreater(remaining, 0, "Timeout waiting for output matching %r" % pattern)
+            if select.select([self.server.stdout], [], [], remaining)[0]:
+                line = self.server.stdout.readline()
+                self.assertTrue(line, "Server exited unexpectedly")
+                match = re.search(pattern, line)
+                if match:
+                    matches.append(match)
+        return matches
+
+    def request_status(self, port):
+        try:
+            with urlopen("http://127.0.0.1:%d/api/v1/" % port, timeout=10) as response:
+                return response.status
+        except HTTPError as e:
+            return e.code
+
+    def test_serve_reload_shutdown(self):
+        """
+        Should serve requests with the workers, keep the PID and the listening socket on reload,
+        and exit on SIGTERM.
+        """
+        port = int(self.wait_for_output(r"listening on 127\.0\.0\.1:(\d+) \(master PID (\d+)\)")[0].group(1))
+        old_workers = {m.group(1) for m in self.wait_for_output(r"Worker (\d+) ready", count=2)}
+        self.assertEqual(self.request_status(port), 410)
+
+        self.server.send_signal(signal.SIGHUP)
+        self.wait_for_output(r"listening on 127\.0\.0\.1:%d \(master PID %d\)" % (port, self.server.pid))
+        new_workers = {m.group(1) for m in self.wait_for_output(r"Worker (\d+) ready", count=2)}
+        self.assertFalse(old_workers & new_workers)
+        self.assertEqual(self.request_status(port), 410)
+
+        self.server.send_signal(signal.SIGTERM)
+        self.assertEqual(self.server.wait(timeout=30), 0)
+
+    def test_reload_failure(self):
+        """
+        Should keep the current workers serving, if the application fails to load on reload.
+        """
+        port = int(self.wait_for_output(r"listening on 127\.0\.0\.1:(\d+) \(master PID (\d+)\)")[0].group(1))
+        workers = {m.group(1) for m in self.wait_for_output(r"Worker (\d+) ready", count=2)}
+        with open(self.settings_file, "a") as f:
+            f.write("raise ImportError('invalid settings')\n")
+
+        self.server.send_signal(signal.SIGHUP)
+        self.wait_for_output(r"Reload failed: the application did not load \(exit status 1")
+        self.assertEqual(self.request_status(port), 410)
+        self.assertEqual(self.request_status(port), 410)
+        self.server.send_signal(signal.SIGUSR1)
+        reported = {m.group(1) for m in self.wait_for_output(r"Worker (\d+): ", count=2)}
+        self.assertEqual(reported, workers)
+
+        self.server.send_signal(signal.SIGTERM)
+        self.assertEqual(self.server.wait(timeout=30), 0)
+
+    @skipUnless(os.path.exists("/proc/self/smaps_rollup"), "Requires /proc/<pid>/smaps_rollup")
+    def test_memory_usage(self):
+        """
+        Should report the memory usage of a process.
+        """
+        usage = memory_usage(os.getpid())
+        self.assertGreater(usage["Rss"], 0)
+        self.assertGreater(usage["Pss"], 0)
+
+
+class WorkerServerTestCase(SimpleTestCase):
+    """
+    Tests the connection handling of the workers.
+    """
+
+    def test_idle_connection_timeout(self):
+        """
+        Should close connections which do not send a request within the timeout, and then serve the next one.
+        """
+        listen_socket = socket.socket()
+        self.addCleanup(listen_socket.close)
+        listen_socket.bind(("127.0.0.1", 0))
+        listen_socket.listen()
+        listen_socket.setblocking(False)
+
+        def application(environ, start_response):
+            start_response("200 OK", [("Content-Length", "2")])
+            return [b"ok"]
+
+        server = WorkerServer(listen_socket, application, request_timeout=0.5)
+        stopped = threading.Event()
+        worker = threading.Thread(target=server.serve_until, args=(stopped.is_set,))
+        worker.start()
+        self.addCleanup(worker.join)
+        self.addCleanup(stopped.set)
+        with socket.create_connection(listen_socket.getsockname(), timeout=10) as idle:
+            start = time.monotonic()
+            with self.assertLogs("django.server", "INFO") as logs:
+                self.assertEqual(idle.recv(1), b"")  # closed by the server
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertIn("timed out", logs.output[0])
+        with self.assertLogs("django.server", "INFO"):
+            with urlopen("http://127.0.0.1:%d/" % listen_socket.getsockname()[1], timeout=10) as response:
+                self.assertEqual(response.read(), b"ok")
+
+
+class SendfileServerHandlerTestCase(SimpleTestCase):
+    """
+    Tests the transmission of file responses with sendfile.
+    """
+
+    def test_sendfile(self):
+        """
+        Should transmit wsgi.file_wrapper responses with socket.sendfile, starting at the current file position.
+        """
+        content = os.urandom(256 * 1024)
+        server_socket, client_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        received = []
+        reader = threading.Thread(target=lambda: received.extend(iter(lambda: client_socket.recv(65536), b"")))
+        reader.start()
+        with tempfile.TemporaryFile() as f:
+            f.write(b"skipped" + content)
+            f.seek(len(b"skipped"))
+
+            def application(environ, start_response):
+                start_response("200 OK", [("Content-Length", str(len(content)))])
+                return environ["wsgi.file_wrapper"](f)
+
+            connection = mock.Mock(wraps=server_socket)
+            handler = SendfileServerHandler(
+                BytesIO(), server_socket.makefile("wb", buffering=0), StringIO(),
+                {"REQUEST_METHOD": "GET", "SERVER_PROTOCOL": "HTTP/1.0"}, multithread=False)
+            handler.request_handler = mock.Mock(connection=connection)
+            handler.run(application)
+        server_socket.shutdown(socket.SHUT_WR)
+        server_socket.close()
+        reader.join()
+        connection.sendfile.assert_called_once()
+        headers, _, body = b"".join(received).partition(b"\r\n\r\n")
+        self.assertTrue(headers.startswith(b"HTTP/1.0 200 OK"))
+        self.assertEqual(body, content)
@@ -0,0 +1,122 @@
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..models import RequestProfile
+from ..profiling import PROFILE_ID_HEADER, QueryRecorder, SamplingProfiler
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SamplingProfilerTestCase(SimpleTestCase):
+    """
+    Tests the stack sampling of the request profiler (profiling.py).
+    """
+
+    def test_samples(self):
+        profiler = SamplingProfiler(0.001)
+        profiler.start()
+        busy(0.2)
+        profiler.stop()
+        self.assertGreater(profiler.sample_count, 0)
+        # Collapsed stacks: outermost frame first, followed by the number of samples
+        stack = __name__ + ':SamplingProfilerTestCase.test_samples;' + __name__ + ':busy '
+        lines = profiler.collapsed().splitlines()
+        self.assertTrue(any(stack in line and int(line.rsplit(' ', 1)[1]) > 0 for line in lines), lines)
+
+
+class QueryRecorderTestCase(TestCase):
+    """
+    Tests the recording of executed SQL by the request profiler.
+    """
+
+    def test_queries(self):
+        recorder = QueryRecorder()
+        recorder.install()
+        try:
+            User.objects.filter(username="nobody").exists()
+        finally:
+            recorder.uninstall()
+        User.objects.exists()
+        self.assertEqual(len(recorder.queries), 1)
+        self.assertNotIn(recorder, connection.execute_wrappers)
+        formatted = recorder.formatted()
+        self.assertTrue(formatted.startswith("-- 1. "))
+        self.assertIn('FROM "auth_user"', formatted)
+        self.assertNotIn("nobody", formatted)
+
+
+class RequestProfilingTestCase(APIAuthTestCase):
+    """
+    Tests on-demand profiling of requests with the X-Profile header.
+    """
+
+    URL = API_ROOT + "workflows/"
+
+    def test_staff_profile(self):
+        self.auth(self.staff_user)
+        r = self.client.get(self.URL, HTTP_X_PROFILE="1")
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        profile = RequestProfile.objects.get()
+        self.assertEqual(r[PROFILE_ID_HEADER], str(profile.pk))
+        self.assertEqual(profile.user.username, self.staff_user.username)
+        self.assertEqual((profile.method, profile.path, profile.status_code), ("GET", self.URL, 200))
+        self.assertGreater(profile.query_count, 0)
+        self.assertIn('"rehagoal_server_app_workflow"', profile.queries)
+        self.assertGreater(profile.duration, 0)
+
+    def test_regular_user_ignored(self):
+        r = self.client.get(self.URL, HTTP_X_PROFILE="1")
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertFalse(r.has_header(PROFILE_ID_HEADER))
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_invalid_credentials_ignored(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Basic invalid")
+        r = self.client.get(self.URL, HTTP_X_PROFILE="1")
+        self.assertFalse(r.has_header(PROFILE_ID_HEADER))
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_without_header(self):
+        self.auth(self.staff_user)
+        r = self.client.get(self.URL)
+        self.assertFalse(r.has_header(PROFILE_ID_HEADER))
+        self.assertFalse(RequestProfile.objects.exists())
+
+    @override_settings(REQUEST_PROFILING={'MAX_PROFILES': 2})
+    def test_max_profiles(self):
+        self.auth(self.staff_user)
+        ids = [self.client.get(self.URL, HTTP_X_PROFILE="1")[PROFILE_ID_HEADER] for _ in range(3)]
+        self.assertEqual(sorted(str(pk) for pk in RequestProfile.objects.values_list("pk", flat=True)), ids[1:])
+
+    @override_settings(REQUEST_PROFILING=None)
+    def test_disabled(self):
+        self.auth(self.staff_user)
+        r = self.client.get(self.URL, HTTP_X_PROFILE="1")
+        self.assertFalse(r.has_header(PROFILE_ID_HEADER))
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_admin_download(self):
+        self.auth(self.staff_user)
+        profile_id = self.client.get(self.URL, HTTP_X_PROFILE="1")[PROFILE_ID_HEADER]
+        self.auth()
+        User.objects.create_superuser("superadmin", "superadmin@localhost", "adminpassword")
+        self.client.login(username="superadmin", password="adminpassword")
+        url = "/admin/rehagoal_server_app/requestprofile/%s/" % profile_id
+        self.assertEqual(self.client.get(url + "change/").status_code, status.HTTP_200_OK)
+        r = self.client.get(url + "download/sql/")
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(r["Content-Disposition"], 'attachment; filename="profile-%s.sql"' % profile_id)
+        self.assertIn(b'"rehagoal_server_app_workflow"', r.content)
+        r = self.client.get(url + "download/stacks/")
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(r.content.decode(), RequestProfile.objects.get().stacks)
+        self.assertEqual(self.client.get(url + "download/other/").status_code, status.HTTP_404_NOT_FOUND)
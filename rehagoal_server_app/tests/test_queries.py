@@ -0,0 +1,88 @@
+from django.core.files.base import ContentFile
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..models import RehagoalUser, Workflow
+
+
+class QueryCountTestCase(APIAuthTestCase):
+    """
+    Pins the number of database queries per API endpoint. Authentication (HTTP basic) loads the user
+    together with its RehagoalUser in a single query, ownership checks require no further queries.
+    """
+
+    def setUp(self):
+        super(QueryCountTestCase, self).setUp()
+        self.workflow = Workflow.objects.create(
+            owner=self.rehagoal_user,
+            content=ContentFile(b"content", name="upload")
+        )
+
+    def tearDown(self):
+        super(QueryCountTestCase, self).tearDown()
+        Workflow.objects.all().delete()
+
+    @staticmethod
+    def api(path=""):
+        return API_ROOT + "workflows/" + path
+
+    def test_list(self):
+        # authentication, count, page
+        with self.assertNumQueries(3):
+            self.client.get(self.api())
+
+    def test_list_jwt(self):
+        # blacklisted token check, authentication, count, page
+        r = self.client.post("/api-token-auth/", {
+            "username": self.regular_user.username,
+            "password": self.regular_user.password,
+        })
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + r.data["token"])
+        with self.assertNumQueries(4):
+            r = self.client.get(self.api())
+        self.assertEqual(r.data["count"], 1)
+
+    def test_retrieve(self):
+        # authentication, workflow
+        with self.assertNumQueries(2):
+            self.client.get(self.api("%s/" % self.workflow.id))
+
+    def test_create(self):
+        # authentication, insert, storage used
+        with self.assertNumQueries(3):
+            self.client.post(self.api(), {"content": ContentFile(b"new", name="upload")})
+
+    def test_partial_update(self):
+        # authentication, workflow, previous content, storage used, update
+        # (the revision is recorded after the commit)
+        with self.assertNumQueries(5):
+            self.client.patch(self.api("%s/" % self.workflow.id), {"content": ContentFile(b"new", name="upload")})
+
+    def test_delete(self):
+        # authentication, workflow, revisions, delete, storage used
+        with self.assertNumQueries(5):
+            self.client.delete(self.api("%s/" % self.workflow.id))
+
+    def test_delete_not_owned(self):
+        # authentication, workflow (not found)
+        other_workflow = Workflow.objects.create(
+            owner=RehagoalUser.objects.get(user__username=self.regular_user2.username),
+            content=ContentFile(b"content", name="upload")
+        )
+        with self.assertNumQueries(2):
+            self.client.delete(self.api("%s/" % other_workflow.id))
+
+    def test_download(self):
+        # authentication, digest (ETag)
+        with self.assertNumQueries(2):
+            self.client.get(self.workflow.content.url).close()
+
+    def test_list_users(self):
+        # authentication, count, page
+        self.auth(self.staff_user)
+        with self.assertNumQueries(3):
+            self.client.get(API_ROOT + "users/")
+
+    def test_retrieve_user(self):
+        # authentication, user
+        with self.assertNumQueries(2):
+            self.client.get(API_ROOT + "users/%s/" % self.rehagoal_user.id)
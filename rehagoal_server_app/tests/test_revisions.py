@@ -0,0 +1,291 @@
+import datetime
+import hashlib
+import json
+from io import StringIO
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..models import RehagoalUser, Workflow, WorkflowRevision
+from ..revisions import COMPARE_CHUNK_SIZE, compute_delta, reconstruct_revision
+
+
+class ComputeDeltaTestCase(SimpleTestCase):
+    """
+    Tests the deltas of workflow revisions (revisions.py).
+    """
+
+    def test_compute_delta(self):
+        self.assertEqual(compute_delta(b"abcXdef", b"abcYYdef"), (3, 3))
+        self.assertEqual(compute_delta(b"abc", b"abc"), (3, 0))
+        self.assertEqual(compute_delta(b"", b"abc"), (0, 0))
+        self.assertEqual(compute_delta(b"aaa", b"aaaa"), (3, 0))
+        self.assertEqual(compute_delta(b"xbc", b"abc"), (0, 2))
+
+    def test_compute_delta_chunks(self):
+        base = bytes(range(200)) * (3 * COMPARE_CHUNK_SIZE // 200)
+        for offset in (0, 1, COMPARE_CHUNK_SIZE - 1, COMPARE_CHUNK_SIZE, 2 * COMPARE_CHUNK_SIZE + 7, len(base) - 1):
+            content = base[:offset] + b"\xff\xfe" + base[offset + 1:]
+            prefix, suffix = compute_delta(memoryview(content), memoryview(base))
+            self.assertEqual(prefix, offset)
+            self.assertEqual(content[:prefix] + content[prefix:len(content) - suffix] + base[len(base) - suffix:],
+                             content)
+            self.assertEqual(suffix, len(base) - offset - 1)
+
+
+@override_settings(WORKFLOW_REVISIONS={'MAX_REVISIONS': 20, 'MAX_AGE': None, 'KEYFRAME_INTERVAL': 3})
+class WorkflowRevisionTestCase(APIAuthTestCase):
+    """
+    Tests the revision history of workflow contents (list and restore).
+    """
+
+    def setUp(self):
+        super(WorkflowRevisionTestCase, self).setUp()
+        self.workflow = Workflow.objects.create(owner=self.rehagoal_user, content=ContentFile(
+            self.version(0), name="upload"))
+        self.url = API_ROOT + "workflows/%s/revisions/" % self.workflow.id
+
+    def tearDown(self):
+        super(WorkflowRevisionTestCase, self).tearDown()
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().delete()
+
+    @staticmethod
+    def version(number):
+        tasks = [{"name": "Task %d" % i, "done": i < number} for i in range(100)]
+        return json.dumps({"name": "Workflow %d" % number, "tasks": tasks}).encode()
+
+    def update(self, content):
+        self.workflow.content = ContentFile(content, name="upload")
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.workflow.save()
+        # Revisions are recorded after the commit, in a transaction deleting pruned revision data after its commit
+        while callbacks:
+            with self.captureOnCommitCallbacks() as nested:
+                for callback in callbacks:
+                    callback()
+            callbacks = nested
+
+    def stored_content(self):
+        with Workflow.objects.get(pk=self.workflow.pk).content.open("rb") as f:
+            return f.read()
+
+    def test_update_records_revision(self):
+        old_name = self.workflow.content.name
+        storage = self.workflow.content.storage
+        self.update(self.version(1))
+        self.assertFalse(storage.exists(old_name))
+        r = self.client.get(self.url)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        revision, = r.data
+        self.assertEqual((revision["number"], revision["name"], revision["task_count"]), (1, "Workflow 0", 100))
+        self.assertEqual((revision["sha256"], revision["size"]), (Workflow.objects.get(pk=self.workflow.pk).revisions
+                                                                   .get().sha256, len(self.version(0))))
+        stored = WorkflowRevision.objects.get()
+        self.assertFalse(stored.keyframe)
+        self.assertTrue(stored.data.name.startswith("revisions/"))
+        self.assertLess(stored.data.size, len(self.version(0)) // 4)
+
+    def test_recorded_after_commit(self):
+        storage = self.workflow.content.storage
+        files = set(storage.listdir("revisions")[1]) if storage.exists("revisions") else set()
+        self.workflow.content = ContentFile(self.version(1), name="upload")
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.workflow.save()
+        self.assertFalse(WorkflowRevision.objects.exists())
+        # Changed again before the revision is recorded, whose delta would not apply to the current content
+        self.update(self.version(2))
+        for callback in callbacks:
+            callback()
+        revision = WorkflowRevision.objects.get()
+        self.assertEqual(revision.sha256, hashlib.sha256(self.version(1)).hexdigest())
+        with reconstruct_revision(revision) as content:
+            self.assertEqual(content.read(), self.version(1))
+        # The links to the replaced contents have been deleted
+        self.assertEqual({"revisions/" + name for name in set(storage.listdir("revisions")[1]) - files},
+                         {revision.data.name})
+
+    def test_unchanged_content(self):
+        self.update(self.version(0))
+        self.assertFalse(WorkflowRevision.objects.exists())
+
+    def test_keyframes(self):
+        for number in range(1, 8):
+            self.update(self.version(number))
+        revisions = list(WorkflowRevision.objects.order_by('number'))
+        self.assertEqual([revision.keyframe for revision in revisions], [False, False, True, False, False, True, False])
+        for revision in revisions:
+            with reconstruct_revision(revision) as content:
+                self.assertEqual(content.read(), self.version(revision.number - 1))
+
+    def test_dissimilar_content_is_keyframe(self):
+        self.update(b"\x00encrypted")
+        self.assertTrue(WorkflowRevision.objects.get().keyframe)
+        with reconstruct_revision(WorkflowRevision.objects.get()) as content:
+            self.assertEqual(content.read(), self.version(0))
+
+    def test_restore(self):
+        for number in range(1, 5):
+            self.update(self.version(number))
+        with self.captureOnCommitCallbacks(execute=True):
+            r = self.client.post(self.url + "2/restore/")
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stored_content(), self.version(1))
+        self.assertEqual((r.data["name"], r.data["size"]), ("Workflow 1", len(self.version(1))))
+        # The replaced content is a new revision
+        numbers = [revision["number"] for revision in self.client.get(self.url).data]
+        self.assertEqual(numbers, [5, 4, 3, 2, 1])
+        with reconstruct_revision(WorkflowRevision.objects.get(number=5)) as content:
+            self.assertEqual(content.read(), self.version(4))
+
+    def test_restore_missing(self):
+        r = self.client.post(self.url + "1/restore/")
+        self.assertEqual(r.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_restore_changed_base(self):
+        self.update(self.version(1))
+        # Simulate a concurrent update, which replaced the base of the delta
+        self.workflow.content.storage.delete(self.workflow.content.name)
+        self.workflow.content.storage.save(self.workflow.content.name, ContentFile(self.version(2)))
+        r = self.client.post(self.url + "1/restore/")
+        self.assertEqual(r.status_code, status.HTTP_409_CONFLICT)
+
+    def test_other_owner(self):
+        self.update(self.version(1))
+        self.auth(self.regular_user2)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.post(self.url + "1/restore/").status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(WORKFLOW_REVISIONS={'MAX_REVISIONS': 2, 'KEYFRAME_INTERVAL': 3})
+    def test_max_revisions(self):
+        names = set()
+        for number in range(1, 6):
+            self.update(self.version(number))
+            names.update(WorkflowRevision.objects.values_list('data', flat=True))
+        revisions = list(WorkflowRevision.objects.order_by('number'))
+        self.assertEqual([revision.number for revision in revisions], [4, 5])
+        storage = revisions[0].data.storage
+        self.assertEqual({name for name in names if storage.exists(name)},
+                         {revision.data.name for revision in revisions})
+        with reconstruct_revision(revisions[0]) as content:
+            self.assertEqual(content.read(), self.version(3))
+
+    @override_settings(WORKFLOW_REVISIONS={'MAX_AGE': 60})
+    def test_prune_revisions_command(self):
+        for number in range(1, 4):
+            self.update(self.version(number))
+        WorkflowRevision.objects.filter(number__lte=2).update(created=timezone.now() - datetime.timedelta(hours=1))
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("prune_revisions", stdout=StringIO())
+        self.assertEqual(list(WorkflowRevision.objects.values_list('number', flat=True)), [3])
+
+    def test_prune_revisions_command_subquery(self):
+        # The workflows are selected by a subquery, as a parameter per workflow would exceed the maximum of SQLite
+        self.update(self.version(1))
+        with CaptureQueriesContext(connection) as queries:
+            call_command("prune_revisions", stdout=StringIO())
+        workflow_table = connection.ops.quote_name(Workflow._meta.db_table)
+        sql, = [query["sql"] for query in queries if query["sql"].startswith("SELECT %s." % workflow_table)]
+        self.assertIn("IN (SELECT", sql)
+
+    def test_prune_revisions_command_orphaned_files(self):
+        storage = WorkflowRevision._meta.get_field("data").storage
+        self.update(self.version(1))
+        revision = WorkflowRevision.objects.get()
+        files = set(storage.listdir("revisions")[1])
+        with self.assertRaises(RuntimeError), self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                self.workflow.content = ContentFile(self.version(2), name="upload")
+                self.workflow.save()
+                raise RuntimeError("rolled back")
+        self.assertFalse(callbacks)
+        orphaned = set(storage.listdir("revisions")[1]) - files
+        self.assertEqual(len(orphaned), 1)
+        # Kept until ORPHAN_MAX_AGE, as the revision may still be recorded by a concurrent transaction
+        call_command("prune_revisions", stdout=StringIO())
+        self.assertEqual(set(storage.listdir("revisions")[1]) - files, orphaned)
+        stdout = StringIO()
+        with override_settings(WORKFLOW_REVISIONS={'MAX_AGE': None, 'ORPHAN_MAX_AGE': -1}):
+            call_command("prune_revisions", stdout=stdout)
+        self.assertIn("orphaned revision file(s).", stdout.getvalue())
+        self.assertFalse(set(storage.listdir("revisions")[1]) & orphaned)
+        self.assertTrue(storage.exists(revision.data.name))
+
+    def storage_used(self):
+        return RehagoalUser.objects.get(pk=self.rehagoal_user.pk).storage_used
+
+    def test_storage_used(self):
+        self.update(self.version(1))
+        revision = WorkflowRevision.objects.get()
+        self.assertEqual(revision.data_size, revision.data.size)
+        self.assertEqual(self.storage_used(), len(self.version(1)) + revision.data_size)
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.get(pk=self.workflow.pk).delete()
+        self.assertEqual(self.storage_used(), 0)
+
+    @override_settings(WORKFLOW_REVISIONS={'MAX_REVISIONS': 1, 'KEYFRAME_INTERVAL': 3})
+    def test_storage_used_pruned(self):
+        for number in range(1, 4):
+            self.update(self.version(number))
+        revision = WorkflowRevision.objects.get()
+        self.assertEqual(self.storage_used(), len(self.version(3)) + revision.data_size)
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.filter(pk=self.workflow.pk).bulk_delete()
+        self.assertEqual(self.storage_used(), 0)
+
+    def test_storage_quota(self):
+        RehagoalUser.objects.filter(pk=self.rehagoal_user.pk).update(storage_quota=len(self.version(1)) + 10)
+        self.update(self.version(1))
+        self.assertFalse(WorkflowRevision.objects.exists())
+        self.assertEqual(self.storage_used(), len(self.version(1)))
+
+    def test_storage_quota_keeps_revisions_reconstructable(self):
+        self.update(self.version(1))
+        # The revision of version 1 exceeds the quota, revision 1 (stored relative to version 1) loses its base
+        RehagoalUser.objects.filter(pk=self.rehagoal_user.pk).update(storage_quota=self.storage_used())
+        self.update(self.version(1).replace(b"Workflow 1", b"Workflow X"))
+        self.assertFalse(WorkflowRevision.objects.exists())
+        self.assertEqual(self.client.get(self.url).data, [])
+        self.assertEqual(self.storage_used(), len(self.version(1)))
+
+    def test_skipped_revision_converts_keyframe(self):
+        self.update(self.version(1))
+        self.workflow.content = ContentFile(self.version(2), name="upload")
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.workflow.save()
+        self.update(self.version(3))
+        # The revision of version 1 is skipped, as the workflow has been changed again
+        for callback in callbacks:
+            callback()
+        revisions = list(WorkflowRevision.objects.order_by('number'))
+        self.assertEqual([(revision.number, revision.keyframe) for revision in revisions], [(1, True), (2, False)])
+        self.assertEqual(self.storage_used(), len(self.version(3)) + sum(r.data_size for r in revisions))
+        for revision, version in zip(revisions, (0, 2)):
+            with reconstruct_revision(revision) as content:
+                self.assertEqual(content.read(), self.version(version))
+
+    @override_settings(WORKFLOW_REVISIONS=None)
+    def test_disabled(self):
+        self.update(self.version(1))
+        self.assertFalse(WorkflowRevision.objects.exists())
+
+    def test_delete_workflow(self):
+        self.update(self.version(1))
+        revision = WorkflowRevision.objects.get()
+        storage = revision.data.storage
+        self.workflow.delete()
+        self.assertFalse(storage.exists(revision.data.name))
+
+    def test_bulk_delete_workflows(self):
+        self.update(self.version(1))
+        revision = WorkflowRevision.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.filter(pk=self.workflow.pk).bulk_delete()
+        self.assertFalse(WorkflowRevision.objects.exists())
+        self.assertFalse(revision.data.storage.exists(revision.data.name))
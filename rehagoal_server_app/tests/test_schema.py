@@ -0,0 +1,75 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import override_settings
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..schema import get_schema, render_schema
+
+SCHEMA_URL = API_ROOT + "schema/"
+
+
+class SchemaTestCase(APIAuthTestCase):
+    """
+    Tests the cached OpenAPI schema (CachedSchemaView) and the generate_schema command.
+    """
+
+    def setUp(self):
+        super(SchemaTestCase, self).setUp()
+        self.schema_dir = tempfile.TemporaryDirectory()
+        self.schema_file = os.path.join(self.schema_dir.name, "schema.json")
+        settings_override = override_settings(API_SCHEMA_FILE=self.schema_file)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.schema_dir.cleanup)
+        self.clear_schema_cache()
+        self.addCleanup(self.clear_schema_cache)
+
+    @staticmethod
+    def clear_schema_cache():
+        get_schema.cache_clear()
+        render_schema.cache_clear()
+
+    def test_schema_staff_only(self):
+        """
+        Should only serve the schema to staff users.
+        """
+        self.auth(self.regular_user)
+        r = self.client.get(SCHEMA_URL, {"format": "openapi-json"})
+        self.assertEqual(r.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_schema_etag(self):
+        """
+        Should serve the schema with ETag, and 304 Not Modified if it matches.
+        """
+        self.auth(self.staff_user)
+        for schema_format in ("openapi", "openapi-json"):
+            r = self.client.get(SCHEMA_URL, {"format": schema_format})
+            self.assertEqual(r.status_code, status.HTTP_200_OK)
+            etag = r.headers["ETag"]
+            r = self.client.get(SCHEMA_URL, {"format": schema_format}, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(r.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(r.headers["ETag"], etag)
+        r = self.client.get(SCHEMA_URL, {"format": "openapi-json"})
+        schema = json.loads(r.content.decode("utf-8"))
+        self.assertEqual(schema["info"]["title"], "RehaGoal API")
+        self.assertIn(API_ROOT + "workflows/", schema["paths"])
+
+    def test_generate_schema(self):
+        """
+        Should serve the schema stored by the generate_schema command.
+        """
+        call_command("generate_schema", stdout=StringIO())
+        with open(self.schema_file) as f:
+            schema = json.load(f)
+        schema["info"]["description"] = "stored schema"
+        with open(self.schema_file, "w") as f:
+            json.dump(schema, f)
+        self.auth(self.staff_user)
+        r = self.client.get(SCHEMA_URL, {"format": "openapi-json"})
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(r.content.decode("utf-8")), schema)
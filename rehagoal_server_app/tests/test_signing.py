@@ -0,0 +1,106 @@
+import time
+
+from django.core.files.base import ContentFile
+from django.core.signing import BadSignature, SignatureExpired
+from django.test import SimpleTestCase, override_settings
+from django.utils.http import quote_etag
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from .. import signing
+from ..models import Workflow
+
+
+class SigningTestCase(SimpleTestCase):
+    """
+    Tests signing and verification of download URLs (signing.py).
+    """
+
+    NAME = 'abcdefABCDEF'
+
+    @staticmethod
+    def params(query):
+        return dict(pair.split('=') for pair in query.split('&'))
+
+    def test_verify(self):
+        params = self.params(signing.signed_query(self.NAME, 'owner', 'digest'))
+        sha256, expires = signing.verify(self.NAME, params)
+        self.assertEqual(sha256, 'digest')
+        self.assertGreaterEqual(expires, time.time() + signing.DEFAULT_MAX_AGE)
+        self.assertLess(expires, time.time() + 2 * signing.DEFAULT_MAX_AGE)
+
+    def test_stable_within_period(self):
+        now = 10 * signing.DEFAULT_MAX_AGE
+        self.assertEqual(signing.signed_query(self.NAME, 'owner', 'digest', now=now),
+                         signing.signed_query(self.NAME, 'owner', 'digest', now=now + signing.DEFAULT_MAX_AGE - 1))
+
+    def test_verify_tampered(self):
+        params = self.params(signing.signed_query(self.NAME, 'owner', 'digest'))
+        for key, value in (('owner', 'other'), ('sha256', 'other'), ('expires', str(int(params['expires']) + 1))):
+            with self.assertRaises(BadSignature):
+                signing.verify(self.NAME, dict(params, **{key: value}))
+        with self.assertRaises(BadSignature):
+            signing.verify('abcdefABCDEG', params)
+        with self.assertRaises(BadSignature):
+            signing.verify(self.NAME, {'signature': params['signature']})
+
+    def test_verify_expired(self):
+        params = self.params(signing.signed_query(self.NAME, 'owner', 'digest', now=time.time() - 3 * 60 * 60))
+        with self.assertRaises(SignatureExpired):
+            signing.verify(self.NAME, params)
+
+    @override_settings(WORKFLOW_DOWNLOAD_URL_MAX_AGE=None)
+    def test_disabled(self):
+        self.assertEqual(signing.signed_query(self.NAME, 'owner', 'digest'), '')
+        with self.assertRaises(BadSignature):
+            signing.verify(self.NAME, {})
+
+
+class SignedDownloadTestCase(APIAuthTestCase):
+    """
+    Tests downloads of workflow contents with the signed URLs returned by the workflow API.
+    """
+
+    CONTENT = b"signed content"
+
+    def setUp(self):
+        super(SignedDownloadTestCase, self).setUp()
+        self.workflow = Workflow.objects.create(owner=self.rehagoal_user, content=ContentFile(self.CONTENT, name="upload"))
+        self.url = self.client.get(API_ROOT + "workflows/%s/" % self.workflow.id).data["download_url"]
+
+    def tearDown(self):
+        super(SignedDownloadTestCase, self).tearDown()
+        Workflow.objects.all().delete()
+
+    def test_download_without_authentication(self):
+        self.auth()
+        with self.assertNumQueries(0):
+            r = self.client.get(self.url)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(r.getvalue(), self.CONTENT)
+        self.assertEqual(r["ETag"], quote_etag(self.workflow.sha256))
+        self.assertTrue(r["Cache-Control"].startswith("private, max-age="))
+        self.assertFalse(r.has_header("Expires"))
+
+    def test_download_not_modified(self):
+        self.auth()
+        with self.assertNumQueries(0):
+            r = self.client.get(self.url, HTTP_IF_NONE_MATCH=quote_etag(self.workflow.sha256))
+        self.assertEqual(r.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_download_other_file(self):
+        other = Workflow.objects.create(owner=self.rehagoal_user, content=ContentFile(b"other", name="upload"))
+        self.auth()
+        r = self.client.get(self.url.replace(self.workflow.content.name, other.content.name))
+        self.assertEqual(r.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_download_invalid_signature(self):
+        self.auth()
+        r = self.client.get(self.url[:-1] + ("A" if self.url[-1] != "A" else "B"))
+        self.assertEqual(r.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_download_unsigned_requires_authentication(self):
+        unsigned_url = self.url.split("?")[0]
+        self.assertEqual(self.client.get(unsigned_url).status_code, status.HTTP_200_OK)
+        self.auth()
+        self.assertEqual(self.client.get(unsigned_url).status_code, status.HTTP_403_FORBIDDEN)
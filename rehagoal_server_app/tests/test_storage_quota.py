@@ -0,0 +1,111 @@
+from django.core.files.base import ContentFile
+from django.test import override_settings
+from rest_framework import status
+
+from .setup import APIAuthTestCase, API_ROOT
+from ..models import RehagoalUser, StorageQuotaExceeded, Workflow
+
+
+class StorageQuotaTestCase(APIAuthTestCase):
+    """
+    Tests the accounting of the storage used per user (RehagoalUser.storage_used) and the storage quotas.
+    """
+
+    def setUp(self):
+        super(StorageQuotaTestCase, self).setUp()
+        self.workflow = Workflow.objects.create(owner=self.rehagoal_user, content=ContentFile(b"0123456789", name="upload"))
+
+    def tearDown(self):
+        super(StorageQuotaTestCase, self).tearDown()
+        Workflow.objects.all().delete()
+
+    @staticmethod
+    def api(path=""):
+        return API_ROOT + "workflows/" + path
+
+    def assertStorageUsed(self, expected, rehagoal_user=None):
+        rehagoal_user = rehagoal_user or self.rehagoal_user
+        self.assertEqual(RehagoalUser.objects.get(pk=rehagoal_user.pk).storage_used, expected)
+
+    def set_quota(self, quota):
+        RehagoalUser.objects.filter(pk=self.rehagoal_user.pk).update(storage_quota=quota)
+
+    def test_storage_used(self):
+        self.assertStorageUsed(10)
+        r = self.client.post(self.api(), {"content": ContentFile(b"abc", name="upload")})
+        self.assertEqual(r.status_code, status.HTTP_201_CREATED)
+        self.assertStorageUsed(13)
+        r = self.client.patch(self.api("%s/" % r.data["id"]), {"content": ContentFile(b"abcdef", name="upload")})
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertStorageUsed(16)
+        r = self.client.delete(self.api("%s/" % self.workflow.id))
+        self.assertEqual(r.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertStorageUsed(6)
+
+    def test_storage_used_bulk_delete(self):
+        other = RehagoalUser.objects.get(user__username=self.regular_user2.username)
+        Workflow.objects.create(owner=other, content=ContentFile(b"abc", name="upload"))
+        self.assertStorageUsed(3, other)
+        with self.captureOnCommitCallbacks(execute=True):
+            Workflow.objects.all().bulk_delete()
+        self.assertStorageUsed(0)
+        self.assertStorageUsed(0, other)
+
+    def test_storage_used_owner_changed(self):
+        other = RehagoalUser.objects.get(user__username=self.regular_user2.username)
+        self.workflow.owner = other
+        self.workflow.content = ContentFile(b"abc", name="upload")
+        self.workflow.save()
+        self.assertStorageUsed(0)
+        self.assertStorageUsed(3, other)
+
+    def test_create_quota_exceeded(self):
+        self.set_quota(12)
+        r = self.client.post(self.api(), {"content": ContentFile(b"abc", name="upload")})
+        self.assertEqual(r.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(r.data["detail"].code, "storage_quota_exceeded")
+        self.assertEqual(Workflow.objects.count(), 1)
+        self.assertStorageUsed(10)
+
+    def test_create_quota_reached(self):
+        self.set_quota(13)
+        r = self.client.post(self.api(), {"content": ContentFile(b"abc", name="upload")})
+        self.assertEqual(r.status_code, status.HTTP_201_CREATED)
+        self.assertStorageUsed(13)
+
+    def test_update_replaced_content_released(self):
+        self.set_quota(12)
+        r = self.client.patch(self.api("%s/" % self.workflow.id), {"content": ContentFile(b"0123456789ab", name="upload")})
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertStorageUsed(12)
+        r = self.client.patch(self.api("%s/" % self.workflow.id), {"content": ContentFile(b"0123456789abc", name="upload")})
+        self.assertEqual(r.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertStorageUsed(12)
+        self.assertEqual(Workflow.objects.get(pk=self.workflow.pk).size, 12)
+
+    def test_content_length_precheck(self):
+        """
+        Uploads, which are larger than the available storage, should be rejected before the request body is parsed.
+        """
+        self.set_quota(1024)
+        r = self.client.post(self.api(), {"content": ContentFile(bytes(256 * 1024), name="upload")})
+        self.assertEqual(r.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(Workflow.objects.count(), 1)
+
+    @override_settings(WORKFLOW_STORAGE_QUOTA=12)
+    def test_default_quota(self):
+        with self.assertRaises(StorageQuotaExceeded):
+            Workflow.objects.create(owner=self.rehagoal_user, content=ContentFile(b"abc", name="upload"))
+        self.assertStorageUsed(10)
+        self.set_quota(20)
+        Workflow.objects.create(owner=self.rehagoal_user, content=ContentFile(b"abc", name="upload"))
+        self.assertStorageUsed(13)
+
+    def test_quota_check_queries(self):
+        # authentication, insert, storage used (conditional update), independent of the number of workflows
+        self.set_quota(1024)
+        for _ in range(5):
+            Workflow.objects.create(owner=self.rehagoal_user, content=ContentFile(b"abc", name="upload"))
+        with self.assertNumQueries(3):
+            r = self.client.post(self.api(), {"content": ContentFile(b"abc", name="upload")})
+        self.assertEqual(r.status_code, status.HTTP_201_CREATED)
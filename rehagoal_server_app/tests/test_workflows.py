@@ -1,11 +1,18 @@
 import os
 import json
+import hashlib
+from django.conf import settings
 from django.core.files import File
 from io import BytesIO
-from unittest.mock import MagicMock
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
+from django.db import connection
+import tempfile
+from django.test.utils import CaptureQueriesContext, override_settings
 from rest_framework import status
 from .setup import APIAuthTestCase, API_ROOT
 from ..models import RehagoalUser, Workflow, MAX_FILE_SIZE
+from ..serializers import WorkflowListSerializer
 
 
 class WorkflowAPITestCase(APIAuthTestCase):
@@ -22,11 +29,20 @@ class WorkflowAPITestCase(APIAuthTestCase):
         return API_ROOT + "workflows/" + path
 
     def assertWorkflowEquals(self, expected_local_workflow: Workflow, actual_remote_workflow: dict):
-        expected_fields = {"id", "content", "owner"}
+        expected_fields = {"id", "content", "download_url", "owner", "sha256", "name", "task_count", "size"}
         self.assertSetEqual(expected_fields, set(actual_remote_workflow.keys()))
         self.assertEqual(expected_local_workflow.id, actual_remote_workflow["id"])
         self.assertIn(expected_local_workflow.owner.id, actual_remote_workflow["owner"])
         self.assertRegex(actual_remote_workflow["content"], r'^.*'+API_ROOT+'files/([A-Za-z0-9]{12}|)$')
+        self.assertTrue(actual_remote_workflow["download_url"].startswith(actual_remote_workflow["content"] + "?"))
+        self.assertEqual(expected_local_workflow.sha256, actual_remote_workflow["sha256"])
+        self.assertEqual(expected_local_workflow.name, actual_remote_workflow["name"])
+        self.assertEqual(expected_local_workflow.task_count, actual_remote_workflow["task_count"])
+        self.assertEqual(expected_local_workflow.size, actual_remote_workflow["size"])
+        self.assertEqual(
+            hashlib.sha256(self.getRemoteWorkflowContent(actual_remote_workflow)).hexdigest(),
+            actual_remote_workflow["sha256"]
+        )
         self.assertLocalAndRemoteWorkflowContentEqual(expected_local_workflow, actual_remote_workflow)
 
     @staticmethod
@@ -66,10 +82,13 @@ class WorkflowAPITestCase(APIAuthTestCase):
         actual_db_content = self.getLocalWorkflowContent(actual_db_workflow)
         self.assertEqual(actual_remote_content, expected_content)
         self.assertEqual(actual_db_content, expected_content)
+        expected_sha256 = hashlib.sha256(expected_content).hexdigest()
+        self.assertEqual(actual_remote_workflow["sha256"], expected_sha256)
+        self.assertEqual(actual_db_workflow.sha256, expected_sha256)
 
     @staticmethod
     def doesWorkflowFileExist(workflow_name: str) -> bool:
-        content_path = os.getcwd() + '/files/%s' % workflow_name
+        content_path = os.path.join(settings.PRIVATE_STORAGE_ROOT, str(workflow_name))
         return os.path.exists(content_path)
 
     @staticmethod
@@ -133,6 +152,68 @@ class WorkflowAPITestCase(APIAuthTestCase):
             ):
                 self.assertWorkflowEquals(expected_workflow, actual_workflow)
 
+    def test_list_search_name(self):
+        """
+        Should filter own workflows by a prefix of their name.
+        """
+
+        self.auth(self.regular_user)
+        expected_content = b'{"name":"Morning routine","tasks":[{},{},{}]}'
+        r = self.client.post(self.api(), {"content": self.generate_mock_file(expected_content)})
+        self.assertEqual(r.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(r.data["name"], "Morning routine")
+        self.assertEqual(r.data["task_count"], 3)
+        self.assertEqual(r.data["size"], len(expected_content))
+        for search, expected_ids in (("Morning", [r.data["id"]]), ("Morning routine", [r.data["id"]]),
+                                     ("Morning r", [r.data["id"]]), (" Morning ", [r.data["id"]]),
+                                     ("Morning,", []), ("Morning routines", []), ("routine", []), ("mocked", [])):
+            response = self.client.get(self.api(), {"search": search})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual([workflow["id"] for workflow in response.data["results"]], expected_ids)
+        self.auth(self.regular_user2)
+        response = self.client.get(self.api(), {"search": "mocked"})
+        self.assertEqual(len(response.data["results"]), 1)
+
+    @skipUnless(connection.vendor == "sqlite", "Requires SQLite query plans")
+    def test_list_search_name_uses_index(self):
+        """
+        Should search the name prefix with the index on the workflow name, instead of scanning the table.
+        """
+
+        self.auth(self.staff_user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.api(), {"search": "Morning"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        sql = next(query["sql"] for query in queries if '"name" >=' in query["sql"])
+        self.assertIn('"rehagoal_server_app_workflow"."name" < \'Morninh\'', sql)
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            plan = " ".join(row[-1] for row in cursor.fetchall())
+        self.assertRegex(plan, r"SEARCH rehagoal_server_app_workflow USING (COVERING )?INDEX "
+                               r"rehagoal_server_app_workflow_name_\w+ \(name>\? AND name<\?\)")
+
+    def test_list_fast_serializer_identical(self):
+        """
+        The fast list representation (WorkflowListSerializer) should produce the same JSON as WorkflowSerializer.
+        """
+
+        for user, params in ((self.regular_user, {}), (self.staff_user, {}), (self.staff_user, {"page": 1})):
+            self.auth(user)
+            fast = self.client.get(self.api(), params)
+            with patch.object(WorkflowListSerializer, "supports", return_value=False):
+                slow = self.client.get(self.api(), params)
+            self.assertEqual(fast.status_code, status.HTTP_200_OK)
+            self.assertEqual(fast.content, slow.content)
+
+    def test_list_format_suffix(self):
+        """
+        Hyperlinks should keep the format suffix, which is not supported by the fast list representation.
+        """
+
+        r = self.client.get(API_ROOT + "workflows.json")
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertTrue(r.data["results"][0]["owner"].endswith(".json"))
+
     def test_retrieve_head_unauthorized(self):
         """
         Should deny HEAD for unauthorized users.
@@ -247,6 +328,18 @@ class WorkflowAPITestCase(APIAuthTestCase):
         self.assertEqual(db_workflow.owner.user.username, self.user.username)
         self.assertWorkflowContentEqual(expected_content, r.data, db_workflow)
 
+    def test_storage_follows_settings(self):
+        """
+        Should store workflow contents in settings.PRIVATE_STORAGE_ROOT, also when it is changed.
+        """
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(PRIVATE_STORAGE_ROOT=directory):
+            workflow = Workflow.objects.create(owner=self.rehagoal_user,
+                                               content=self.generate_mock_file(b"{}"))
+            self.assertTrue(os.path.exists(os.path.join(directory, workflow.content.name)))
+            self.assertTrue(self.doesWorkflowFileExist(workflow.content))
+            workflow.content.delete(save=False)
+
     def test_delete_regular_user(self):
         """
         Should allow deleting self-owned workflows.
@@ -470,3 +563,21 @@ class WorkflowAPITestCase(APIAuthTestCase):
             self.assertEqual(header_content_type, 'application/octet-stream')
             self.assertEqual(header_content_disposition, 'attachment; filename*=UTF-8\'\'%s' % known_workflow.content)
             r.close()
+
+    def test_get_content_etag(self):
+        """
+        Should respond with the SHA-256 digest of the content as ETag, and 304 Not Modified if it matches.
+        """
+        self.auth(self.regular_user)
+        for known_workflow in self.all_workflows:
+            expected_etag = '"%s"' % hashlib.sha256(self.getLocalWorkflowContent(known_workflow)).hexdigest()
+            r = self.client.get(known_workflow.content.url)
+            self.assertEqual(r.status_code, status.HTTP_200_OK)
+            self.assertEqual(r.headers['ETag'], expected_etag)
+            r.close()
+            r = self.client.get(known_workflow.content.url, HTTP_IF_NONE_MATCH=expected_etag)
+            self.assertEqual(r.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(r.headers['ETag'], expected_etag)
+            r = self.client.get(known_workflow.content.url, HTTP_IF_NONE_MATCH='"outdated"')
+            self.assertEqual(r.status_code, status.HTTP_200_OK)
+            r.close()
@@ -0,0 +1,35 @@
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+from .content import ContentInspector
+
+
+class ContentInspectionUploadHandlerMixin(object):
+    """
+    Inspects uploaded files while they are received (see ContentInspector: SHA-256 digest, size and metadata),
+    so that the content does not need to be read again afterwards.
+    The result is stored as `content_info` attribute of the uploaded file.
+    """
+
+    def new_file(self, *args, **kwargs):
+        self.inspector = ContentInspector()
+        super(ContentInspectionUploadHandlerMixin, self).new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # MemoryFileUploadHandler passes the chunks on to the next handler, if it is not activated
+        if getattr(self, 'activated', True):
+            self.inspector.feed(raw_data)
+        return super(ContentInspectionUploadHandlerMixin, self).receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super(ContentInspectionUploadHandlerMixin, self).file_complete(file_size)
+        if file is not None:
+            file.content_info = self.inspector.info()
+        return file
+
+
+class WorkflowMemoryFileUploadHandler(ContentInspectionUploadHandlerMixin, MemoryFileUploadHandler):
+    pass
+
+
+class WorkflowTemporaryFileUploadHandler(ContentInspectionUploadHandlerMixin, TemporaryFileUploadHandler):
+    pass
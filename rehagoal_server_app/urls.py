@@ -2,7 +2,7 @@ from django.urls import re_path, include
 from rest_framework import routers
 
 from . import api
-from .views import ContentFileDownloadView
+from .views import BlobCacheStatsView, ContentFileDownloadView
 from .models import ID_LENGTH
 
 router = routers.DefaultRouter()
@@ -13,5 +13,6 @@ urlpatterns = [
     re_path(r'^', include(router.urls)),
     re_path(r'^files/(?P<path>[A-Za-z0-9]{' + str(ID_LENGTH) + '}|)$',
             ContentFileDownloadView.as_view(),
-            name='serve_private_file')
+            name='serve_private_file'),
+    re_path(r'^blob-cache/$', BlobCacheStatsView.as_view(), name='blob_cache_stats'),
 ]
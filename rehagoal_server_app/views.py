@@ -1,25 +1,156 @@
-from django.http import HttpResponse
+import time
+
+from django.core.signing import BadSignature
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.views.static import was_modified_since
+from private_storage.servers import DjangoServer, add_no_cache_headers
 from private_storage.views import PrivateStorageView
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
 from rest_framework.views import APIView
 from re import fullmatch
 
-from .models import ID_LENGTH
+from . import signing
+from .admission import TransferAdmissionMixin, TransferThrottle
+from .auditlog import AuditLogMixin
+from .blobcache import CachedBlob, blob_cache
+from .models import ID_LENGTH, Workflow
+from .storage import private_storage
 
 
 def index(request):
     return HttpResponse("")
 
 
+class CachedDjangoServer(DjangoServer):
+    """
+    DjangoServer, which serves small content files from the blob cache (see blobcache.py).
+    """
+
+    @staticmethod
+    @add_no_cache_headers
+    def serve(private_file):
+        request = private_file.request
+        blob = blob_cache.get(private_file.relative_name)
+        if blob is None:
+            if request.method == 'HEAD' or not blob_cache.accepts(private_file.size):
+                return DjangoServer.serve(private_file)
+            with private_file.open() as f:
+                blob = CachedBlob(f.read(), private_file.modified_time.timestamp())
+            blob_cache.set(private_file.relative_name, *blob)
+        size = len(blob.content)
+        if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), blob.modified_time, size):
+            return HttpResponseNotModified()
+        response = HttpResponse(b'' if request.method == 'HEAD' else blob.content,
+                                content_type=private_file.content_type)
+        response['Content-Length'] = size
+        response['Last-Modified'] = http_date(blob.modified_time)
+        return response
+
+
 # Download view, not on a per model level, but on a file level
-class ContentFileDownloadView(APIView, PrivateStorageView):
+class ContentFileDownloadView(TransferAdmissionMixin, AuditLogMixin, APIView, PrivateStorageView):
+    """
+    Serves workflow contents to authenticated users, or to anyone with a valid signed URL (see signing.py).
+    Signed URLs are verified without database queries and their responses may be cached until they expire.
+    """
     permission_classes = [IsAuthenticated]
+    throttle_classes = [TransferThrottle]
+    audit_event = 'content'
     content_disposition = 'attachment'
+    server_class = CachedDjangoServer
+    storage = private_storage
 
-    @staticmethod
-    def can_access_file(private_file):
-        # Permissions are managed by DRF permission_classes
-        # Note that this is currently not on a per-object (Workflow) basis
+    def initial(self, request, *args, **kwargs):
+        # (sha256, expires) of a valid signed URL
+        self.signed = None
+        if signing.is_signed(request.query_params):
+            try:
+                self.signed = signing.verify(kwargs.get('path', ''), request.query_params)
+            except BadSignature as e:  # including SignatureExpired
+                raise PermissionDenied(str(e))
+        super(ContentFileDownloadView, self).initial(request, *args, **kwargs)
+
+    def perform_authentication(self, request):
+        # Signed URLs grant access on their own, authentication (and its queries) is skipped
+        if self.signed is None:
+            super(ContentFileDownloadView, self).perform_authentication(request)
+
+    def get_permissions(self):
+        if self.signed is not None:
+            return []
+        return super(ContentFileDownloadView, self).get_permissions()
+
+    def get_transfer_size(self, request):
+        """
+        Size (bytes) of the download for the admission control (see admission.py), None for HEAD requests.
+        Conditional requests are charged with the full size, as the ETag is not checked yet.
+        """
+        if request.method != 'GET':
+            return None
+        try:
+            return self.get_storage().size(self.get_path())
+        except OSError:  # missing file
+            return 0
+
+    def get_audit_user_id(self, request):
+        # Signed downloads are not authenticated, their owner is logged instead
+        if getattr(self, 'signed', None) is not None:
+            return None
+        return super(ContentFileDownloadView, self).get_audit_user_id(request)
+
+    def get_audit_fields(self, request, response):
+        signed = getattr(self, 'signed', None) is not None
+        return {
+            'content': self.kwargs.get('path'),
+            'signed': signed,
+            'owner': request.query_params.get(signing.OWNER_PARAM) if signed else None,
+            'bytes': int(response['Content-Length']) if response.has_header('Content-Length') else None,
+        }
+
+    def can_access_file(self, private_file):
+        # Permissions are managed by DRF permission_classes, or by the signature of the URL.
+        # Note that unsigned access is currently not on a per-object (Workflow) basis
         if fullmatch(r'[a-zA-Z0-9]{' + str(ID_LENGTH) + '}', private_file.relative_name) is None:
             return False
-        return private_file.request.user.is_authenticated
+        return self.signed is not None or private_file.request.user.is_authenticated
+
+    def get_etag(self, private_file):
+        """
+        The SHA-256 digest of the workflow content is used as ETag, so that clients can skip downloads
+        of content they already have. Signed URLs contain the digest.
+        """
+        if self.signed is not None:
+            sha256 = self.signed[0]
+        else:
+            sha256 = Workflow.objects.filter(content=private_file.relative_name).values_list('sha256', flat=True).first()
+        return quote_etag(sha256) if sha256 else None
+
+    def serve_file(self, private_file):
+        etag = self.get_etag(private_file)
+        response = get_conditional_response(self.request, etag=etag)
+        if response is None:
+            response = super(ContentFileDownloadView, self).serve_file(private_file)
+        if etag:
+            response['ETag'] = etag
+        if self.signed is not None:
+            # Content files are never modified, the response is valid as long as the URL. Contents are personal data,
+            # shared caches (e.g. proxies) must not store them
+            max_age = max(int(self.signed[1] - time.time()), 0)
+            response['Cache-Control'] = 'private, max-age=%d, immutable' % max_age
+            if response.has_header('Expires'):
+                del response['Expires']
+        return response
+
+
+class BlobCacheStatsView(APIView):
+    """
+    Counters and size of the blob cache of the worker process serving the request, for tuning
+    settings.WORKFLOW_BLOB_CACHE (staff only).
+    """
+
+    def get(self, request, format=None):
+        return Response(blob_cache.stats())